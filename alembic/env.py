@@ -19,7 +19,7 @@ if config.config_file_name is not None:
 # ! need to set hide_password to False so the DATABASE_URL are correctly injected.
 config.set_main_option(
     "sqlalchemy.url",
-    lesson_1.database_url.render_as_string(hide_password=False),
+    lesson_1.build_database_url().render_as_string(hide_password=False),
 )
 
 # add your model's MetaData object here
@@ -51,6 +51,7 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        transaction_per_migration=True,
     )
 
     with context.begin_transaction():
@@ -71,7 +72,13 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        # * one transaction per migration, so that a migration can leave it
+        # * with autocommit_block(), e.g. for CREATE INDEX CONCURRENTLY.
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            transaction_per_migration=True,
+        )
 
         with context.begin_transaction():
             context.run_migrations()
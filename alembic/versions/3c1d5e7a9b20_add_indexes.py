@@ -0,0 +1,51 @@
+"""add indexes
+
+Revision ID: 3c1d5e7a9b20
+Revises: e85801fcd680
+Create Date: 2026-10-18 10:12:41.208519
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3c1d5e7a9b20"
+down_revision: Union[str, Sequence[str], None] = "e85801fcd680"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = (
+    ("ix_users_created_at_telegram_id", "users", ["created_at", "telegram_id"]),
+    ("ix_users_referrer_id", "users", ["referrer_id"]),
+    ("ix_orders_user_id", "orders", ["user_id"]),
+    ("ix_orderproducts_product_id", "orderproducts", ["product_id"]),
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # ! CONCURRENTLY doesn't lock writes, but can't run in a transaction. An
+    # ! interrupted build leaves an INVALID index to drop before running again.
+    with op.get_context().autocommit_block():
+        for name, table_name, columns in INDEXES:
+            op.create_index(
+                name,
+                table_name,
+                columns,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table_name, _ in reversed(INDEXES):
+            op.drop_index(
+                name,
+                table_name=table_name,
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
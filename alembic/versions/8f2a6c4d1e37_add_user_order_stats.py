@@ -0,0 +1,221 @@
+"""add user order stats
+
+Revision ID: 8f2a6c4d1e37
+Revises: 3c1d5e7a9b20
+Create Date: 2026-10-18 11:03:27.514862
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8f2a6c4d1e37"
+down_revision: Union[str, Sequence[str], None] = "3c1d5e7a9b20"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+FUNCTIONS = (
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_orders_inserted() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO user_order_stats (user_id, orders_count, units_count)
+        SELECT user_id, count(*), 0 FROM new_orders
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id ORDER BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET orders_count = user_order_stats.orders_count + excluded.orders_count;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_orders_updated() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE user_order_stats AS stats
+        SET orders_count = stats.orders_count - moved.orders_count,
+            units_count = stats.units_count - moved.units_count
+        FROM (
+            SELECT old_orders.user_id, count(DISTINCT order_id) AS orders_count,
+                   coalesce(sum(lines.quantity), 0) AS units_count
+            FROM old_orders
+            JOIN new_orders USING (order_id)
+            LEFT JOIN orderproducts AS lines USING (order_id)
+            WHERE old_orders.user_id IS DISTINCT FROM new_orders.user_id
+            GROUP BY old_orders.user_id
+        ) AS moved
+        WHERE stats.user_id = moved.user_id;
+
+        INSERT INTO user_order_stats (user_id, orders_count, units_count)
+        SELECT new_orders.user_id, count(DISTINCT order_id),
+               coalesce(sum(lines.quantity), 0)
+        FROM new_orders
+        JOIN old_orders USING (order_id)
+        LEFT JOIN orderproducts AS lines USING (order_id)
+        WHERE new_orders.user_id IS NOT NULL
+          AND old_orders.user_id IS DISTINCT FROM new_orders.user_id
+        GROUP BY new_orders.user_id ORDER BY new_orders.user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET orders_count = user_order_stats.orders_count + excluded.orders_count,
+            units_count = user_order_stats.units_count + excluded.units_count;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_order_deleted() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE user_order_stats
+        SET orders_count = orders_count - 1,
+            units_count = units_count - coalesce(
+                (SELECT sum(quantity) FROM orderproducts
+                 WHERE order_id = OLD.order_id), 0)
+        WHERE user_id = OLD.user_id;
+        RETURN OLD;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_lines_changed() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO user_order_stats (user_id, orders_count, units_count)
+            SELECT orders.user_id, 0, sum(new_lines.quantity)
+            FROM new_lines JOIN orders USING (order_id)
+            WHERE orders.user_id IS NOT NULL
+            GROUP BY orders.user_id ORDER BY orders.user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET units_count = user_order_stats.units_count + excluded.units_count;
+        END IF;
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE user_order_stats AS stats
+            SET units_count = stats.units_count - removed.units_count
+            FROM (
+                SELECT orders.user_id, sum(old_lines.quantity) AS units_count
+                FROM old_lines JOIN orders USING (order_id)
+                GROUP BY orders.user_id
+            ) AS removed
+            WHERE stats.user_id = removed.user_id;
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_truncated() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'orders' THEN
+            DELETE FROM user_order_stats;
+        ELSE
+            UPDATE user_order_stats SET units_count = 0 WHERE units_count <> 0;
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+)
+
+# * name, table and definition of each trigger.
+TRIGGERS = (
+    (
+        "user_order_stats_insert_orders",
+        "orders",
+        "AFTER INSERT ON orders REFERENCING NEW TABLE AS new_orders "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_orders_inserted()",
+    ),
+    (
+        "user_order_stats_update_orders",
+        "orders",
+        "AFTER UPDATE ON orders "
+        "REFERENCING OLD TABLE AS old_orders NEW TABLE AS new_orders "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_orders_updated()",
+    ),
+    (
+        "user_order_stats_delete_orders",
+        "orders",
+        "BEFORE DELETE ON orders FOR EACH ROW WHEN (OLD.user_id IS NOT NULL) "
+        "EXECUTE FUNCTION user_order_stats_order_deleted()",
+    ),
+    (
+        "user_order_stats_truncate_orders",
+        "orders",
+        "AFTER TRUNCATE ON orders "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_truncated()",
+    ),
+    (
+        "user_order_stats_insert_orderproducts",
+        "orderproducts",
+        "AFTER INSERT ON orderproducts REFERENCING NEW TABLE AS new_lines "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_lines_changed()",
+    ),
+    (
+        "user_order_stats_update_orderproducts",
+        "orderproducts",
+        "AFTER UPDATE ON orderproducts "
+        "REFERENCING OLD TABLE AS old_lines NEW TABLE AS new_lines "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_lines_changed()",
+    ),
+    (
+        "user_order_stats_delete_orderproducts",
+        "orderproducts",
+        "AFTER DELETE ON orderproducts REFERENCING OLD TABLE AS old_lines "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_lines_changed()",
+    ),
+    (
+        "user_order_stats_truncate_orderproducts",
+        "orderproducts",
+        "AFTER TRUNCATE ON orderproducts "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_truncated()",
+    ),
+)
+FUNCTION_NAMES = (
+    "user_order_stats_orders_inserted",
+    "user_order_stats_orders_updated",
+    "user_order_stats_order_deleted",
+    "user_order_stats_lines_changed",
+    "user_order_stats_truncated",
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "user_order_stats",
+        sa.Column("user_id", sa.BIGINT(), nullable=False),
+        sa.Column("orders_count", sa.BIGINT(), server_default="0", nullable=False),
+        sa.Column("units_count", sa.BIGINT(), server_default="0", nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.telegram_id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+    for function in FUNCTIONS:
+        op.execute(function)
+    for name, _, definition in TRIGGERS:
+        op.execute(f"CREATE TRIGGER {name} {definition}")
+
+    # * the orders written from now on are counted by the triggers, the
+    # * existing ones are counted once here.
+    op.execute(
+        """
+        INSERT INTO user_order_stats (user_id, orders_count, units_count)
+        SELECT orders.user_id, count(orders.order_id), coalesce(sum(units), 0)
+        FROM orders
+        LEFT JOIN (
+            SELECT order_id, sum(quantity) AS units
+            FROM orderproducts GROUP BY order_id
+        ) AS lines USING (order_id)
+        WHERE orders.user_id IS NOT NULL
+        GROUP BY orders.user_id
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name, table_name, _ in reversed(TRIGGERS):
+        op.execute(f"DROP TRIGGER {name} ON {table_name}")
+    for name in FUNCTION_NAMES:
+        op.execute(f"DROP FUNCTION {name}()")
+    op.drop_table("user_order_stats")
@@ -0,0 +1,43 @@
+"""add backfill checkpoints
+
+Revision ID: a6c2e9f4b781
+Revises: d3a8f1b6c924
+Create Date: 2026-10-18 16:42:09.318275
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "a6c2e9f4b781"
+down_revision: Union[str, Sequence[str], None] = "d3a8f1b6c924"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "backfill_checkpoints",
+        sa.Column("name", sa.VARCHAR(length=255), nullable=False),
+        sa.Column("last_key", sa.BIGINT(), nullable=True),
+        sa.Column("end_key", sa.BIGINT(), nullable=True),
+        sa.Column("rows", sa.BIGINT(), server_default="0", nullable=False),
+        sa.Column("done", sa.Boolean(), server_default=sa.false(), nullable=False),
+        sa.Column(
+            "updated_at",
+            sa.TIMESTAMP(),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("backfill_checkpoints")
@@ -0,0 +1,405 @@
+"""partition orders by month
+
+Revision ID: b4e9d2c7a615
+Revises: 8f2a6c4d1e37
+Create Date: 2026-10-18 14:26:50.731046
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b4e9d2c7a615"
+down_revision: Union[str, Sequence[str], None] = "8f2a6c4d1e37"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# * the functions joining the lines to their order, on the partition keys too.
+FUNCTIONS = (
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_orders_updated() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE user_order_stats AS stats
+        SET orders_count = stats.orders_count - moved.orders_count,
+            units_count = stats.units_count - moved.units_count
+        FROM (
+            SELECT old_orders.user_id,
+                   count(DISTINCT old_orders.order_id) AS orders_count,
+                   coalesce(sum(lines.quantity), 0) AS units_count
+            FROM old_orders
+            JOIN new_orders USING (order_id)
+            LEFT JOIN orderproducts AS lines
+              ON lines.order_id = new_orders.order_id
+             AND lines.order_created_at = new_orders.created_at
+            WHERE old_orders.user_id IS DISTINCT FROM new_orders.user_id
+            GROUP BY old_orders.user_id
+        ) AS moved
+        WHERE stats.user_id = moved.user_id;
+
+        INSERT INTO user_order_stats (user_id, orders_count, units_count)
+        SELECT new_orders.user_id, count(DISTINCT new_orders.order_id),
+               coalesce(sum(lines.quantity), 0)
+        FROM new_orders
+        JOIN old_orders USING (order_id)
+        LEFT JOIN orderproducts AS lines
+          ON lines.order_id = new_orders.order_id
+         AND lines.order_created_at = new_orders.created_at
+        WHERE new_orders.user_id IS NOT NULL
+          AND old_orders.user_id IS DISTINCT FROM new_orders.user_id
+        GROUP BY new_orders.user_id ORDER BY new_orders.user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET orders_count = user_order_stats.orders_count + excluded.orders_count,
+            units_count = user_order_stats.units_count + excluded.units_count;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_order_deleted() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE user_order_stats
+        SET orders_count = orders_count - 1,
+            units_count = units_count - coalesce(
+                (SELECT sum(quantity) FROM orderproducts
+                 WHERE order_id = OLD.order_id
+                   AND order_created_at = OLD.created_at), 0)
+        WHERE user_id = OLD.user_id;
+        RETURN OLD;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_lines_changed() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO user_order_stats (user_id, orders_count, units_count)
+            SELECT orders.user_id, 0, sum(new_lines.quantity)
+            FROM new_lines
+            JOIN orders
+              ON orders.order_id = new_lines.order_id
+             AND orders.created_at = new_lines.order_created_at
+            WHERE orders.user_id IS NOT NULL
+            GROUP BY orders.user_id ORDER BY orders.user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET units_count = user_order_stats.units_count + excluded.units_count;
+        END IF;
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE user_order_stats AS stats
+            SET units_count = stats.units_count - removed.units_count
+            FROM (
+                SELECT orders.user_id, sum(old_lines.quantity) AS units_count
+                FROM old_lines
+                JOIN orders
+                  ON orders.order_id = old_lines.order_id
+                 AND orders.created_at = old_lines.order_created_at
+                GROUP BY orders.user_id
+            ) AS removed
+            WHERE stats.user_id = removed.user_id;
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+)
+PREVIOUS_FUNCTIONS = (
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_orders_updated() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE user_order_stats AS stats
+        SET orders_count = stats.orders_count - moved.orders_count,
+            units_count = stats.units_count - moved.units_count
+        FROM (
+            SELECT old_orders.user_id, count(DISTINCT order_id) AS orders_count,
+                   coalesce(sum(lines.quantity), 0) AS units_count
+            FROM old_orders
+            JOIN new_orders USING (order_id)
+            LEFT JOIN orderproducts AS lines USING (order_id)
+            WHERE old_orders.user_id IS DISTINCT FROM new_orders.user_id
+            GROUP BY old_orders.user_id
+        ) AS moved
+        WHERE stats.user_id = moved.user_id;
+
+        INSERT INTO user_order_stats (user_id, orders_count, units_count)
+        SELECT new_orders.user_id, count(DISTINCT order_id),
+               coalesce(sum(lines.quantity), 0)
+        FROM new_orders
+        JOIN old_orders USING (order_id)
+        LEFT JOIN orderproducts AS lines USING (order_id)
+        WHERE new_orders.user_id IS NOT NULL
+          AND old_orders.user_id IS DISTINCT FROM new_orders.user_id
+        GROUP BY new_orders.user_id ORDER BY new_orders.user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET orders_count = user_order_stats.orders_count + excluded.orders_count,
+            units_count = user_order_stats.units_count + excluded.units_count;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_order_deleted() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE user_order_stats
+        SET orders_count = orders_count - 1,
+            units_count = units_count - coalesce(
+                (SELECT sum(quantity) FROM orderproducts
+                 WHERE order_id = OLD.order_id), 0)
+        WHERE user_id = OLD.user_id;
+        RETURN OLD;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_lines_changed() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO user_order_stats (user_id, orders_count, units_count)
+            SELECT orders.user_id, 0, sum(new_lines.quantity)
+            FROM new_lines JOIN orders USING (order_id)
+            WHERE orders.user_id IS NOT NULL
+            GROUP BY orders.user_id ORDER BY orders.user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET units_count = user_order_stats.units_count + excluded.units_count;
+        END IF;
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE user_order_stats AS stats
+            SET units_count = stats.units_count - removed.units_count
+            FROM (
+                SELECT orders.user_id, sum(old_lines.quantity) AS units_count
+                FROM old_lines JOIN orders USING (order_id)
+                GROUP BY orders.user_id
+            ) AS removed
+            WHERE stats.user_id = removed.user_id;
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+)
+
+# * name and definition of each trigger, dropped along with the old tables.
+TRIGGERS = (
+    (
+        "user_order_stats_insert_orders",
+        "AFTER INSERT ON orders REFERENCING NEW TABLE AS new_orders "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_orders_inserted()",
+    ),
+    (
+        "user_order_stats_update_orders",
+        "AFTER UPDATE ON orders "
+        "REFERENCING OLD TABLE AS old_orders NEW TABLE AS new_orders "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_orders_updated()",
+    ),
+    (
+        "user_order_stats_delete_orders",
+        "BEFORE DELETE ON orders FOR EACH ROW WHEN (OLD.user_id IS NOT NULL) "
+        "EXECUTE FUNCTION user_order_stats_order_deleted()",
+    ),
+    (
+        "user_order_stats_truncate_orders",
+        "AFTER TRUNCATE ON orders "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_truncated()",
+    ),
+    (
+        "user_order_stats_insert_orderproducts",
+        "AFTER INSERT ON orderproducts REFERENCING NEW TABLE AS new_lines "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_lines_changed()",
+    ),
+    (
+        "user_order_stats_update_orderproducts",
+        "AFTER UPDATE ON orderproducts "
+        "REFERENCING OLD TABLE AS old_lines NEW TABLE AS new_lines "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_lines_changed()",
+    ),
+    (
+        "user_order_stats_delete_orderproducts",
+        "AFTER DELETE ON orderproducts REFERENCING OLD TABLE AS old_lines "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_lines_changed()",
+    ),
+    (
+        "user_order_stats_truncate_orderproducts",
+        "AFTER TRUNCATE ON orderproducts "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_order_stats_truncated()",
+    ),
+)
+INDEXES = (
+    ("ix_orders_user_id", "orders", ["user_id"]),
+    ("ix_orderproducts_product_id", "orderproducts", ["product_id"]),
+)
+
+# * a partition per month from the oldest order to 3 months ahead, as
+# * partitions.ensure() creates them.
+CREATE_PARTITIONS = """
+DO $$
+DECLARE
+    month timestamp;
+BEGIN
+    FOR month IN
+        SELECT generate_series(
+            date_trunc('month', least(min(created_at), now())),
+            date_trunc('month', now()) + interval '3 months',
+            interval '1 month'
+        )
+        FROM previous_orders
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF orders FOR VALUES FROM (%L) TO (%L)',
+            'orders_' || to_char(month, 'YYYY_MM'),
+            month,
+            month + interval '1 month'
+        );
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF orderproducts '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'orderproducts_' || to_char(month, 'YYYY_MM'),
+            month,
+            month + interval '1 month'
+        );
+    END LOOP;
+END $$
+"""
+
+
+def _timestamps() -> list[sa.Column]:
+    return [
+        sa.Column(
+            "created_at",
+            sa.TIMESTAMP(),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column(
+            "updated_at",
+            sa.TIMESTAMP(),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+    ]
+
+
+def _order_id() -> sa.Column:
+    # * the sequence of the previous table, taken over.
+    return sa.Column(
+        "order_id",
+        sa.Integer(),
+        server_default=sa.text("nextval('orders_order_id_seq'::regclass)"),
+        nullable=False,
+    )
+
+
+def _rename_previous_tables() -> None:
+    """Free the names of the tables and of their indexes for the new ones."""
+
+    op.execute("LOCK TABLE orders, orderproducts IN ACCESS EXCLUSIVE MODE")
+    op.rename_table("orderproducts", "previous_orderproducts")
+    op.rename_table("orders", "previous_orders")
+    for name in ("orders_pkey", "orderproducts_pkey", *(n for n, _, _ in INDEXES)):
+        op.execute(f"ALTER INDEX {name} RENAME TO previous_{name}")
+
+
+def _drop_previous_tables() -> None:
+    op.execute("ALTER SEQUENCE orders_order_id_seq OWNED BY orders.order_id")
+    op.drop_table("previous_orderproducts")
+    op.drop_table("previous_orders")
+    for name, table_name, columns in INDEXES:
+        op.create_index(name, table_name, columns)
+    for name, definition in TRIGGERS:
+        op.execute(f"CREATE TRIGGER {name} {definition}")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # ! a table can't be partitioned in place: the rows are copied to new
+    # ! partitioned tables, the writes to the orders being blocked meanwhile.
+    _rename_previous_tables()
+
+    op.create_table(
+        "orders",
+        _order_id(),
+        sa.Column("user_id", sa.BIGINT(), autoincrement=False, nullable=True),
+        *_timestamps(),
+        sa.ForeignKeyConstraint(
+            ["user_id"], ["users.telegram_id"], ondelete="SET NULL"
+        ),
+        sa.PrimaryKeyConstraint("order_id", "created_at"),
+        postgresql_partition_by="RANGE (created_at)",
+    )
+    op.create_table(
+        "orderproducts",
+        sa.Column("order_id", sa.Integer(), nullable=False),
+        sa.Column("order_created_at", sa.TIMESTAMP(), nullable=False),
+        sa.Column("product_id", sa.Integer(), nullable=False),
+        sa.Column("quantity", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["order_id", "order_created_at"],
+            ["orders.order_id", "orders.created_at"],
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["product_id"], ["products.product_id"], ondelete="RESTRICT"
+        ),
+        sa.PrimaryKeyConstraint("order_id", "order_created_at", "product_id"),
+        postgresql_partition_by="RANGE (order_created_at)",
+    )
+    op.execute("CREATE TABLE orders_default PARTITION OF orders DEFAULT")
+    op.execute("CREATE TABLE orderproducts_default PARTITION OF orderproducts DEFAULT")
+    op.execute(CREATE_PARTITIONS)
+
+    op.execute(
+        "INSERT INTO orders (order_id, user_id, created_at, updated_at) "
+        "SELECT order_id, user_id, created_at, updated_at FROM previous_orders"
+    )
+    op.execute(
+        "INSERT INTO orderproducts "
+        "(order_id, order_created_at, product_id, quantity) "
+        "SELECT lines.order_id, orders.created_at, lines.product_id, lines.quantity "
+        "FROM previous_orderproducts AS lines "
+        "JOIN previous_orders AS orders USING (order_id)"
+    )
+    for function in FUNCTIONS:
+        op.execute(function)
+    # * the copied orders are already counted in user_order_stats.
+    _drop_previous_tables()
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    _rename_previous_tables()
+
+    op.create_table(
+        "orders",
+        _order_id(),
+        sa.Column("user_id", sa.BIGINT(), autoincrement=False, nullable=True),
+        *_timestamps(),
+        sa.ForeignKeyConstraint(
+            ["user_id"], ["users.telegram_id"], ondelete="SET NULL"
+        ),
+        sa.PrimaryKeyConstraint("order_id"),
+    )
+    op.create_table(
+        "orderproducts",
+        sa.Column("order_id", sa.Integer(), nullable=False),
+        sa.Column("product_id", sa.Integer(), nullable=False),
+        sa.Column("quantity", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["order_id"], ["orders.order_id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(
+            ["product_id"], ["products.product_id"], ondelete="RESTRICT"
+        ),
+        sa.PrimaryKeyConstraint("order_id", "product_id"),
+    )
+
+    op.execute(
+        "INSERT INTO orders (order_id, user_id, created_at, updated_at) "
+        "SELECT order_id, user_id, created_at, updated_at FROM previous_orders"
+    )
+    op.execute(
+        "INSERT INTO orderproducts (order_id, product_id, quantity) "
+        "SELECT order_id, product_id, quantity FROM previous_orderproducts"
+    )
+    for function in PREVIOUS_FUNCTIONS:
+        op.execute(function)
+    # * dropping the partitioned tables drops their partitions.
+    _drop_previous_tables()
@@ -0,0 +1,46 @@
+"""forbid moving orders across months
+
+Revision ID: c7e3b5a9d412
+Revises: a6c2e9f4b781
+Create Date: 2026-10-18 18:05:37.614820
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c7e3b5a9d412"
+down_revision: Union[str, Sequence[str], None] = "a6c2e9f4b781"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# ! an order moved to the partition of another month fires the BEFORE DELETE
+# ! trigger of user_order_stats, and is never added back: created_at can't change.
+FUNCTION = """
+CREATE OR REPLACE FUNCTION user_order_stats_created_at_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    RAISE EXCEPTION 'the created_at of order % can''t change', OLD.order_id
+        USING ERRCODE = 'check_violation';
+END $$
+"""
+TRIGGER = (
+    "CREATE TRIGGER user_order_stats_created_at_orders "
+    "BEFORE UPDATE OF created_at ON orders "
+    "FOR EACH ROW WHEN (OLD.created_at IS DISTINCT FROM NEW.created_at) "
+    "EXECUTE FUNCTION user_order_stats_created_at_changed()"
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute(FUNCTION)
+    op.execute(TRIGGER)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TRIGGER user_order_stats_created_at_orders ON orders")
+    op.execute("DROP FUNCTION user_order_stats_created_at_changed()")
@@ -0,0 +1,151 @@
+"""add user referrals closure
+
+Revision ID: d3a8f1b6c924
+Revises: b4e9d2c7a615
+Create Date: 2026-10-18 16:12:44.208315
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d3a8f1b6c924"
+down_revision: Union[str, Sequence[str], None] = "b4e9d2c7a615"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+FUNCTIONS = (
+    """
+    CREATE OR REPLACE FUNCTION user_referrals_users_inserted() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_advisory_xact_lock_shared(hashtext('user_referrals'));
+        -- the referrers inserted by the same statement are walked in new_users,
+        -- the others are linked to their own referrers already.
+        WITH RECURSIVE chain AS (
+            SELECT telegram_id AS ancestor_id, telegram_id AS descendant_id,
+                   0 AS depth, referrer_id AS next_id
+            FROM new_users
+            UNION ALL
+            SELECT new_users.telegram_id, chain.descendant_id, chain.depth + 1,
+                   new_users.referrer_id
+            FROM chain JOIN new_users ON new_users.telegram_id = chain.next_id
+        )
+        INSERT INTO user_referrals (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, descendant_id, depth FROM chain
+        UNION ALL
+        SELECT link.ancestor_id, chain.descendant_id, chain.depth + 1 + link.depth
+        FROM chain JOIN user_referrals AS link ON link.descendant_id = chain.next_id;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_referrals_referrer_changed() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtext('user_referrals'));
+        IF EXISTS (
+            SELECT FROM user_referrals
+            WHERE ancestor_id = NEW.telegram_id AND descendant_id = NEW.referrer_id
+        ) THEN
+            RAISE EXCEPTION 'user % can''t be referred by its referral %',
+                NEW.telegram_id, NEW.referrer_id
+                USING ERRCODE = 'check_violation';
+        END IF;
+
+        -- unlink the subtree of the user from the referrers above it...
+        DELETE FROM user_referrals AS link
+        USING user_referrals AS subtree
+        WHERE subtree.ancestor_id = NEW.telegram_id
+          AND link.descendant_id = subtree.descendant_id
+          AND link.ancestor_id NOT IN (
+              SELECT descendant_id FROM user_referrals
+              WHERE ancestor_id = NEW.telegram_id
+          );
+        -- ...and link it to the new ones.
+        INSERT INTO user_referrals (ancestor_id, descendant_id, depth)
+        SELECT above.ancestor_id, subtree.descendant_id,
+               above.depth + 1 + subtree.depth
+        FROM user_referrals AS above
+        JOIN user_referrals AS subtree ON subtree.ancestor_id = NEW.telegram_id
+        WHERE above.descendant_id = NEW.referrer_id;
+        RETURN NULL;
+    END $$
+    """,
+)
+
+# * name, table and definition of each trigger.
+TRIGGERS = (
+    (
+        "user_referrals_insert_users",
+        "users",
+        "AFTER INSERT ON users REFERENCING NEW TABLE AS new_users "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_referrals_users_inserted()",
+    ),
+    (
+        "user_referrals_update_users",
+        "users",
+        "AFTER UPDATE OF referrer_id ON users FOR EACH ROW "
+        "WHEN (OLD.referrer_id IS DISTINCT FROM NEW.referrer_id) "
+        "EXECUTE FUNCTION user_referrals_referrer_changed()",
+    ),
+)
+FUNCTION_NAMES = ("user_referrals_users_inserted", "user_referrals_referrer_changed")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "user_referrals",
+        sa.Column("ancestor_id", sa.BIGINT(), nullable=False),
+        sa.Column("descendant_id", sa.BIGINT(), nullable=False),
+        sa.Column("depth", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["ancestor_id"], ["users.telegram_id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(
+            ["descendant_id"], ["users.telegram_id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("ancestor_id", "descendant_id"),
+    )
+    op.create_index(
+        "ix_user_referrals_descendant_id_depth",
+        "user_referrals",
+        ["descendant_id", "depth"],
+        unique=False,
+    )
+    for function in FUNCTIONS:
+        op.execute(function)
+
+    # * no referrer changes between the walk below and the triggers.
+    op.execute("LOCK TABLE users IN SHARE MODE")
+    for name, _, definition in TRIGGERS:
+        op.execute(f"CREATE TRIGGER {name} {definition}")
+    op.execute(
+        """
+        INSERT INTO user_referrals (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE closure AS (
+            SELECT telegram_id AS ancestor_id, telegram_id AS descendant_id,
+                   0 AS depth
+            FROM users
+            UNION ALL
+            SELECT closure.ancestor_id, users.telegram_id, closure.depth + 1
+            FROM closure JOIN users ON users.referrer_id = closure.descendant_id
+        )
+        SELECT ancestor_id, descendant_id, depth FROM closure
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name, table_name, _ in reversed(TRIGGERS):
+        op.execute(f"DROP TRIGGER {name} ON {table_name}")
+    for name in FUNCTION_NAMES:
+        op.execute(f"DROP FUNCTION {name}()")
+    op.drop_index("ix_user_referrals_descendant_id_depth", table_name="user_referrals")
+    op.drop_table("user_referrals")
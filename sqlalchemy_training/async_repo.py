@@ -0,0 +1,413 @@
+"""Async repository:
+
+- Use AsyncSession built on asyncpg.
+- Same queries as the synchronous Repo from the third lesson.
+- Group several calls in a single transaction (unit of work).
+- Read in a read-only transaction.
+- Eager load relationships, as they can't be lazy loaded in asyncio.
+- Select many users in one round trip, see ``loader.UserLoader``.
+- Walk the referral tree, or read its closure.
+"""
+
+# ! AsyncRepo mirrors Repo on purpose.
+# pylint: disable=duplicate-code
+
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Iterable, Optional, Self, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.engine.row import Row
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from sqlalchemy_training import queries
+from sqlalchemy_training.instrumentation import instrumented
+from sqlalchemy_training.lesson_1 import get_async_session_maker
+from sqlalchemy_training.lesson_2 import Order, Product, User
+
+
+@instrumented
+class AsyncRepo:
+    """Collection of coroutines to work on the DB without blocking the loop.
+
+    With ``autocommit=False`` (or inside ``transaction()``) the coroutines join
+    the session transaction instead of committing after each statement.
+    Otherwise the writes commit, and the reads end their transaction without a
+    COMMIT.
+
+    With ``closure``, the referral trees are read from ``user_referrals``.
+    """
+
+    def __init__(
+        self, sess: AsyncSession, autocommit: bool = True, closure: bool = False
+    ) -> None:
+        self.session = sess
+        self.autocommit = autocommit
+        self.closure = closure
+        self._depth = 0
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Self]:
+        """Run the calls of the block in one transaction, committed at the end."""
+
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            if self._depth == 1:
+                await self.session.rollback()
+            raise
+        else:
+            if self._depth == 1:
+                await self.session.commit()
+        finally:
+            self._depth -= 1
+
+    @asynccontextmanager
+    async def read_only(self) -> AsyncIterator[Self]:
+        """Run the reads of the block in one read-only transaction."""
+
+        expire_on_commit = self.session.sync_session.expire_on_commit
+        self.session.sync_session.expire_on_commit = False
+        try:
+            async with self.transaction():
+                if not self.session.in_transaction():
+                    await self.session.execute(text("SET TRANSACTION READ ONLY"))
+                yield self
+        finally:
+            self.session.sync_session.expire_on_commit = expire_on_commit
+
+    async def _commit(self) -> None:
+        """Commit, unless the calls are grouped in a unit of work."""
+
+        if self.autocommit and not self._depth:
+            await self.session.commit()
+
+    async def _end_read(self) -> None:
+        """End the transaction of a read without a COMMIT, unless in a unit of work.
+
+        The transaction is closed rather than rolled back, which would expire
+        the loaded objects, that can't be refreshed lazily in asyncio. Its
+        connection is rolled back on its return to the pool.
+        """
+
+        if self.autocommit and not self._depth and self.session.in_transaction():
+            await self.session.run_sync(
+                lambda session: session.get_transaction().close()
+            )
+
+    async def add_user(
+        self,
+        /,
+        *,
+        telegram_id: int,
+        full_name: str,
+        lang: str,
+        username: Optional[str] = None,
+        referrer_id: Optional[int] = None,
+    ) -> User:
+        """Add new user to DB."""
+
+        stmt = queries.UPSERT_USER
+        params = {
+            "telegram_id": telegram_id,
+            "full_name": full_name,
+            "language_code": lang,
+            "user_name": username,
+            "referrer_id": referrer_id,
+        }
+
+        result = await self.session.scalars(stmt, params)
+        user = result.first()
+        await self._commit()
+
+        return user
+
+    async def get_user_by_id(self, telegram_id: int) -> Optional[User]:
+        """Select an user by its ID."""
+
+        stmt = queries.USER_BY_ID
+        result = await self.session.execute(stmt, {"telegram_id": telegram_id})
+        await self._end_read()
+
+        return result.scalars().first()
+
+    async def get_all_users(self) -> Sequence[User]:
+        """Select all users in DB."""
+
+        stmt = queries.all_users()
+        results = await self.session.execute(stmt)
+        await self._end_read()
+
+        return results.scalars().all()
+
+    async def get_last_ten_users(self) -> Sequence[User]:
+        """Select last ten users in DB."""
+
+        stmt = queries.last_ten_users()
+        results = await self.session.execute(stmt)
+        await self._end_read()
+
+        return results.scalars().all()
+
+    async def get_user_lang(self, telegram_id: int) -> Optional[str]:
+        """Select the language of an user by its ID."""
+
+        stmt = queries.USER_LANG
+        result = await self.session.execute(stmt, {"telegram_id": telegram_id})
+        await self._end_read()
+
+        return result.scalars().first()
+
+    async def get_users_by_ids(
+        self, telegram_ids: Iterable[int]
+    ) -> list[Optional[User]]:
+        """Select many users in one round trip, ``None`` for the missing ones."""
+
+        telegram_ids = list(telegram_ids)
+        stmt = queries.USERS_BY_IDS
+        result = await self.session.scalars(stmt, {"ids": list(set(telegram_ids))})
+        users = {user.telegram_id: user for user in result}
+        await self._end_read()
+
+        return [users.get(telegram_id) for telegram_id in telegram_ids]
+
+    async def get_user_langs_by_ids(
+        self, telegram_ids: Iterable[int]
+    ) -> list[Optional[str]]:
+        """Select the languages of many users in one round trip."""
+
+        telegram_ids = list(telegram_ids)
+        stmt = queries.USER_LANGS_BY_IDS
+        result = await self.session.execute(stmt, {"ids": list(set(telegram_ids))})
+        langs = dict(result.tuples().all())
+        await self._end_read()
+
+        return [langs.get(telegram_id) for telegram_id in telegram_ids]
+
+    async def get_users_with_orders(
+        self, loader: queries.Loader = "selectin"
+    ) -> Sequence[User]:
+        """Select all users with their orders and the products of the orders."""
+
+        stmt = queries.users_with_orders(loader)
+        result = await self.session.scalars(stmt)
+        users = result.unique().all()
+        await self._end_read()
+
+        return users
+
+    async def get_order_with_products(
+        self,
+        order_id: int,
+        loader: queries.Loader = "selectin",
+        created_at: Optional[datetime] = None,
+    ) -> Optional[Order]:
+        """Select an order with its products loaded up front."""
+
+        stmt = queries.order_with_products(order_id, loader, created_at)
+        result = await self.session.scalars(stmt)
+        orders = result.unique().all()
+        await self._end_read()
+
+        return orders[0] if orders else None
+
+    async def add_order(self, user_id: int) -> Order:
+        """Add a new order to the DB."""
+
+        stmt = queries.INSERT_ORDER
+
+        results = await self.session.scalars(stmt, {"user_id": user_id})
+        order = results.first()
+        await self._commit()
+
+        return order
+
+    async def add_product(
+        self,
+        title: str,
+        price: int,
+        description: Optional[str] = None,
+    ) -> Product:
+        """Add a new product to the DB."""
+        stmt = queries.insert_product(title, price, description)
+
+        results = await self.session.scalars(stmt)
+        product = results.first()
+        await self._commit()
+
+        return product
+
+    async def add_product_to_order(
+        self,
+        product_id: int,
+        order_id: int,
+        quantity: int,
+    ) -> None:
+        """Add a product to an order, ``NoResultFound`` if there's no such order."""
+        stmt = queries.INSERT_ORDER_PRODUCT
+
+        result = await self.session.execute(
+            stmt, {"product_id": product_id, "order_id": order_id, "quantity": quantity}
+        )
+        if not result.rowcount:
+            await self._check_order(order_id)
+        await self._commit()
+
+    async def place_order(self, user_id: int, lines: Iterable[dict[str, Any]]) -> Order:
+        """Add an order with all its lines in one statement, so one round trip."""
+
+        quantities: dict[int, int] = {}
+        for item in lines:
+            quantities[item["product_id"]] = (
+                quantities.get(item["product_id"], 0) + item["quantity"]
+            )
+
+        stmt = queries.PLACE_ORDER
+        params = {
+            "user_id": user_id,
+            "product_ids": list(quantities),
+            "quantities": list(quantities.values()),
+        }
+        result = await self.session.execute(stmt, params)
+        rows = result.all()
+        order = rows[0][0]
+        set_committed_value(
+            order, "products", [line for _, line in rows if line is not None]
+        )
+        await self._commit()
+
+        return order
+
+    async def select_all_invited_users(self) -> Sequence[Row[tuple[str, str]]]:
+        """Get all invited users."""
+
+        stmt = queries.invited_users()
+
+        results = await self.session.execute(stmt)
+        await self._end_read()
+        return results.all()
+
+    async def get_referrals(
+        self, telegram_id: int, max_depth: Optional[int] = None
+    ) -> Sequence[Row[tuple[User, int]]]:
+        """Get the referrals of an user at any depth, or down to ``max_depth``."""
+
+        stmt = queries.referrals_tree(telegram_id, max_depth, self.closure)
+
+        results = await self.session.execute(stmt)
+        await self._end_read()
+        return results.all()
+
+    async def get_referrers(self, telegram_id: int) -> Sequence[Row[tuple[User, int]]]:
+        """Get the referrer of an user, its referrer and so on up to the root."""
+
+        stmt = queries.referrers_chain(telegram_id, self.closure)
+
+        results = await self.session.execute(stmt)
+        await self._end_read()
+        return results.all()
+
+    async def get_referrals_stats(self, telegram_id: int) -> Row[tuple[int, int, int]]:
+        """Count the referrals of an user at any depth, their orders and units."""
+
+        stmt = queries.referrals_stats(telegram_id, self.closure)
+
+        result = await self.session.execute(stmt)
+        await self._end_read()
+        return result.one()
+
+    async def get_all_user_orders(
+        self,
+        telegram_id: int,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> Sequence[Row[tuple[Product, Order, str, int]]]:
+        """Get all orders from an user, created in ``[since, until)`` if given."""
+
+        stmt = queries.user_orders(telegram_id, since, until)
+        results = await self.session.execute(stmt)
+        await self._end_read()
+        return results.all()
+
+    async def get_total_of_orders(self, telegram_id: int) -> int:
+        """Get total number of orders from an user."""
+        stmt = queries.TOTAL_OF_ORDERS
+        result = await self.session.scalar(stmt, {"telegram_id": telegram_id})
+        await self._end_read()
+        return result
+
+    async def get_total_of_orders_per_user(self) -> Sequence[Row[tuple[int, str]]]:
+        """Get total number of orders per user."""
+        stmt = queries.total_of_orders_per_user()
+        result = await self.session.execute(stmt)
+        await self._end_read()
+        return result.all()
+
+    async def get_total_of_ordered_products_per_user(
+        self,
+    ) -> Sequence[Row[tuple[int, str]]]:
+        """Get total number of ordered products per user."""
+        stmt = queries.total_of_ordered_products_per_user()
+        result = await self.session.execute(stmt)
+        await self._end_read()
+        return result.all()
+
+    async def set_new_referrer(self, user_id: int, referrer_id: int) -> None:
+        """Update an user with new referrer ID."""
+        stmt = queries.SET_REFERRER
+        await self.session.execute(
+            stmt, {"user_id": user_id, "referrer_id": referrer_id}
+        )
+        await self._commit()
+
+    async def delete_user_by_id(self, user_id: int) -> None:
+        """Delete an user by its ID."""
+        stmt = queries.DELETE_USER
+        await self.session.execute(stmt, {"user_id": user_id})
+        await self._commit()
+
+    async def bulk_add_order_products(
+        self, order_id: int, products: list[dict[str, Any]]
+    ) -> None:
+        """Bulk add products to an order, in one statement.
+
+        Raises ``NoResultFound`` if there's no such order.
+        """
+        stmt = queries.INSERT_ORDER_PRODUCTS
+        params = {
+            "order_id": order_id,
+            "product_ids": [product["product_id"] for product in products],
+            "quantities": [product["quantity"] for product in products],
+        }
+        result = await self.session.execute(stmt, params)
+        if products and not result.rowcount:
+            await self._check_order(order_id)
+        await self._commit()
+
+    async def _check_order(self, order_id: int) -> None:
+        """Raise ``NoResultFound`` if there's no such order."""
+
+        if not await self.session.scalar(queries.ORDER_EXISTS, {"order_id": order_id}):
+            raise NoResultFound(f"No order {order_id}")
+
+
+async def main() -> None:
+    """Print the orders of an user."""
+
+    async with get_async_session_maker()() as session:
+        repo = AsyncRepo(session)
+
+        user_orders = await repo.get_all_user_orders(telegram_id=18)
+
+        for product, order, user_name, amount in user_orders:
+            print(
+                f"Product: {product.title} x {amount}: Order: {order.order_id}: {user_name}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,302 @@
+"""Backfill a table in keyset batches, each committed, resumable and throttled.
+
+A data migration running one statement over a whole table holds its locks, and
+loses its work on any failure, until the end. A backfill instead applies its
+statement to ``batch_size`` keys at a time, in key order, and commits each
+batch along with its progress in ``backfill_checkpoints``: once interrupted, it
+resumes after the last committed batch. Each batch runs under ``lock_timeout``
+and ``statement_timeout``, a batch waiting too long for a lock being retried.
+
+From a migration, out of its transaction so that each batch commits::
+
+    UPDATE_LANGS = sa.text(
+        "UPDATE users SET language_code = lower(language_code) "
+        "WHERE telegram_id > :after AND telegram_id <= :last"
+    )
+
+    def upgrade() -> None:
+        from sqlalchemy_training.backfill import Backfill, run
+
+        with op.get_context().autocommit_block():
+            run(
+                op.get_bind().engine,
+                Backfill("lower_langs", "users", "telegram_id", UPDATE_LANGS),
+                workers=4,
+            )
+
+The keys must be integers. With several workers, the keys are split in as many
+ranges, each with its own checkpoint, processed concurrently.
+
+Usage::
+
+    python -m sqlalchemy_training.backfill status lower_langs
+    python -m sqlalchemy_training.backfill reset lower_langs
+"""
+
+import argparse
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property, partial
+from time import sleep
+from typing import Callable, Optional, Sequence, TypeVar
+
+from sqlalchemy import (
+    Connection,
+    Engine,
+    Executable,
+    column,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    table,
+    update,
+)
+from sqlalchemy.engine.row import Row
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql.expression import ColumnClause
+
+from sqlalchemy_training.lesson_1 import create_engine_from_env
+from sqlalchemy_training.lesson_2 import BackfillCheckpoint
+from sqlalchemy_training.throughput import Pace, Throughput, measure
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+@dataclass(frozen=True)
+class Backfill:  # pylint: disable=too-many-instance-attributes
+    """A statement applied to a table one batch of keys at a time.
+
+    ``statement`` takes the keys of a batch as ``(:after, :last]``.
+    ``rows_per_second`` caps the throughput of all the workers together, and
+    the timeouts are in milliseconds. ``retries`` is the number of times a
+    batch is retried after a lock timeout.
+    """
+
+    name: str
+    table_name: str
+    key: str
+    statement: Executable
+    batch_size: int = 1_000
+    rows_per_second: Optional[float] = None
+    lock_timeout: Optional[int] = 1_000
+    statement_timeout: Optional[int] = 60_000
+    retries: int = 5
+
+    @cached_property
+    def keys(self) -> ColumnClause:
+        """The key column of the table, as of any revision: only it is needed."""
+
+        return table(self.table_name, column(self.key)).c[self.key]
+
+
+def checkpoints(connection: Connection, name: str) -> Sequence[Row]:
+    """Checkpoints of the ranges of a backfill, in key order."""
+
+    return connection.execute(
+        select(BackfillCheckpoint)
+        .where(
+            or_(
+                BackfillCheckpoint.name == name,
+                BackfillCheckpoint.name.like(f"{name}.%"),
+            )
+        )
+        .order_by(BackfillCheckpoint.last_key)
+    ).all()
+
+
+def plan(connection: Connection, backfill: Backfill, workers: int = 1) -> list[str]:
+    """Names of the unfinished ranges of a backfill, split on its first run.
+
+    A resumed backfill keeps the ranges of its first run, whatever ``workers``.
+    The last range is open-ended, so the rows added meanwhile are processed.
+    """
+
+    BackfillCheckpoint.__table__.create(connection, checkfirst=True)
+    existing = checkpoints(connection, backfill.name)
+    if existing:
+        return [row.name for row in existing if not row.done]
+
+    low, high = connection.execute(
+        select(func.min(backfill.keys), func.max(backfill.keys))
+    ).one()
+    if low is None:
+        connection.execute(
+            insert(BackfillCheckpoint).values(name=backfill.name, done=True)
+        )
+        return []
+
+    start = low - 1
+    if workers <= 1:
+        ranges = [{"name": backfill.name, "last_key": start, "end_key": None}]
+    else:
+        step = math.ceil((high - start) / workers)
+        ranges = [
+            {
+                "name": f"{backfill.name}.{index}",
+                "last_key": start + index * step,
+                "end_key": start + (index + 1) * step if index < workers - 1 else None,
+            }
+            for index in range(workers)
+        ]
+    connection.execute(insert(BackfillCheckpoint), ranges)
+    return [row["name"] for row in ranges]
+
+
+def set_timeouts(
+    connection: Connection,
+    lock_timeout: Optional[int] = None,
+    statement_timeout: Optional[int] = None,
+) -> None:
+    """Set the timeouts of the current transaction, in milliseconds."""
+
+    for setting, value in (
+        ("lock_timeout", lock_timeout),
+        ("statement_timeout", statement_timeout),
+    ):
+        if value is not None:
+            connection.exec_driver_sql(f"SET LOCAL {setting} = {int(value)}")
+
+
+def commit_batch(
+    connection: Connection,
+    work: Callable[[], T],
+    label: str,
+    *,
+    lock_timeout: Optional[int] = None,
+    statement_timeout: Optional[int] = None,
+    retries: int = 0,
+) -> T:
+    """Run and commit ``work`` in a transaction, retrying it after a lock timeout."""
+
+    for attempt in range(retries + 1):
+        try:
+            with connection.begin():
+                set_timeouts(connection, lock_timeout, statement_timeout)
+                return work()
+        except OperationalError as error:
+            if (
+                getattr(error.orig, "pgcode", None) != LOCK_NOT_AVAILABLE
+                or attempt == retries
+            ):
+                raise
+            logger.warning("%s: lock timeout, retrying the batch", label)
+            sleep(0.1 * 2**attempt)
+    raise AssertionError("unreachable")
+
+
+def _next_batch(connection: Connection, backfill: Backfill, name: str) -> Optional[int]:
+    """Process the next batch of a range, None once the range is done."""
+
+    checkpoint = connection.execute(
+        select(BackfillCheckpoint.last_key, BackfillCheckpoint.end_key)
+        .where(BackfillCheckpoint.name == name, BackfillCheckpoint.done.is_(False))
+        # * a range is processed by one worker at a time.
+        .with_for_update()
+    ).one_or_none()
+    if checkpoint is None:
+        return None
+
+    keys = select(backfill.keys).where(backfill.keys > checkpoint.last_key)
+    if checkpoint.end_key is not None:
+        keys = keys.where(backfill.keys <= checkpoint.end_key)
+    batch = keys.order_by(backfill.keys).limit(backfill.batch_size).subquery()
+    last = connection.scalar(select(func.max(batch.c[backfill.key])))
+
+    stmt = update(BackfillCheckpoint).where(BackfillCheckpoint.name == name)
+    if last is None:
+        connection.execute(stmt.values(done=True))
+        return None
+
+    rows = connection.execute(
+        backfill.statement, {"after": checkpoint.last_key, "last": last}
+    ).rowcount
+    connection.execute(stmt.values(last_key=last, rows=BackfillCheckpoint.rows + rows))
+    return rows
+
+
+def _batch(connection: Connection, backfill: Backfill, name: str) -> Optional[int]:
+    """Commit the next batch of a range, retrying it after a lock timeout."""
+
+    return commit_batch(
+        connection,
+        partial(_next_batch, connection, backfill, name),
+        name,
+        lock_timeout=backfill.lock_timeout,
+        statement_timeout=backfill.statement_timeout,
+        retries=backfill.retries,
+    )
+
+
+def run_range(
+    engine: Engine,
+    backfill: Backfill,
+    name: str,
+    rows_per_second: Optional[float] = None,
+) -> Throughput:
+    """Process a range batch by batch, at most at ``rows_per_second``."""
+
+    pace = Pace(f"backfill {name}", rows_per_second)
+    with measure(f"backfill {name}") as throughput, engine.connect() as connection:
+        while (rows := _batch(connection, backfill, name)) is not None:
+            throughput.rows += rows
+            pace(throughput)
+
+    return throughput
+
+
+def run(engine: Engine, backfill: Backfill, workers: int = 1) -> Throughput:
+    """Run or resume a backfill, its ranges processed by ``workers`` threads."""
+
+    with engine.begin() as connection:
+        names = plan(connection, backfill, workers)
+
+    with measure(f"backfill {backfill.name}") as throughput:
+        if not names:
+            return throughput
+        rate = backfill.rows_per_second and backfill.rows_per_second / len(names)
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            futures = [
+                pool.submit(run_range, engine, backfill, name, rate) for name in names
+            ]
+            throughput.rows = sum(future.result().rows for future in futures)
+
+    return throughput
+
+
+def main() -> None:
+    """Show or reset the checkpoints of a backfill from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["status", "reset"])
+    parser.add_argument("name")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = create_engine_from_env()
+    with engine.begin() as connection:
+        if args.command == "status":
+            for row in checkpoints(connection, args.name):
+                state = "done" if row.done else f"after {row.last_key}"
+                print(f"{row.name}: {row.rows} rows, {state}, {row.updated_at}")
+        else:
+            connection.execute(
+                delete(BackfillCheckpoint).where(
+                    or_(
+                        BackfillCheckpoint.name == args.name,
+                        BackfillCheckpoint.name.like(f"{args.name}.%"),
+                    )
+                )
+            )
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,558 @@
+"""Benchmark every Repo method against datasets of growing size.
+
+The schema of ``lesson_2`` is created in a dedicated database (the configured
+one suffixed with ``_benchmark``, created if missing), seeded by the generator
+at each scale, then every Repo method is timed. The results go to a JSON
+baseline file that can be compared with the one of another commit. The
+baseline also compares the throughput and the peak allocations of the reads
+returning ORM entities and the same reads returning DTOs, and the cold start
+of the modules, imported in a fresh interpreter.
+
+Usage::
+
+    python -m sqlalchemy_training.benchmark run --scales 1000 100000 1000000
+    python -m sqlalchemy_training.benchmark compare old.json new.json
+    python -m sqlalchemy_training.benchmark imports
+"""
+
+import argparse
+import json
+import logging
+import random
+import statistics
+import subprocess
+import sys
+import tracemalloc
+from collections.abc import Sized
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from itertools import count
+from time import perf_counter
+from typing import Any, Callable, Optional, Sequence
+
+from sqlalchemy import URL, Engine, create_engine, text
+from sqlalchemy.orm import Session
+
+from sqlalchemy_training import generator, partitions
+from sqlalchemy_training.generator import DatasetConfig
+from sqlalchemy_training.instrumentation import QueryStats
+from sqlalchemy_training.lesson_1 import build_database_url, create_engine_from_env
+from sqlalchemy_training.lesson_2 import Base
+from sqlalchemy_training.lesson_3 import Repo
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CaseResult:
+    """Timings of one Repo method at one scale."""
+
+    calls: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    queries_per_call: float
+    rows_per_second: float
+
+
+@dataclass
+class ProjectionResult:
+    """Cost of a read returning ORM entities or DTOs."""
+
+    rows_per_second: float
+    peak_kib: float
+
+
+class Cases:  # pylint: disable=missing-function-docstring
+    """One case per Repo method, each returning the number of rows it handled.
+
+    Writers run before the readers and deleters that use the rows they create.
+    """
+
+    def __init__(self, repo: Repo, config: DatasetConfig, seed: int = 0) -> None:
+        self.repo = repo
+        self.config = config
+        self.rng = random.Random(seed)
+        self.new_user_ids = count(config.users + 1)
+        self.added_users: list[int] = []
+        self.added_orders: list[int] = []
+
+    def _user_id(self) -> int:
+        return self.rng.randint(1, self.config.users)
+
+    def add_user(self) -> int:
+        telegram_id = next(self.new_user_ids)
+        self.repo.add_user(telegram_id=telegram_id, full_name="Bench", lang="en")
+        self.added_users.append(telegram_id)
+        return 1
+
+    def add_users_bulk(self) -> int:
+        users = [
+            {"telegram_id": next(self.new_user_ids), "full_name": "Bench", "lang": "en"}
+            for _ in range(1_000)
+        ]
+        self.repo.add_users_bulk(users)
+        self.added_users.extend(user["telegram_id"] for user in users)
+        return len(users)
+
+    def add_product(self) -> int:
+        self.repo.add_product(title="Bench", price=1)
+        return 1
+
+    def add_order(self) -> int:
+        self.added_orders.append(self.repo.add_order(self._user_id()).order_id)
+        return 1
+
+    def add_product_to_order(self) -> int:
+        self.repo.add_product_to_order(
+            product_id=self.rng.randint(1, self.config.products),
+            order_id=self.rng.randint(1, self.config.orders),
+            quantity=1,
+        )
+        return 1
+
+    def bulk_add_order_products(self) -> int:
+        products = [
+            {"product_id": product_id, "quantity": 1}
+            for product_id in range(1, min(self.config.products, 20) + 1)
+        ]
+        self.repo.bulk_add_order_products(self.added_orders.pop(), products)
+        return len(products)
+
+    def place_order(self) -> int:
+        lines = [
+            {"product_id": product_id, "quantity": 1}
+            for product_id in range(1, min(self.config.products, 20) + 1)
+        ]
+        self.repo.place_order(self._user_id(), lines)
+        return len(lines)
+
+    def get_user_by_id(self) -> int:
+        return int(self.repo.get_user_by_id(self._user_id()) is not None)
+
+    def get_user_lang(self) -> int:
+        return int(self.repo.get_user_lang(self._user_id()) is not None)
+
+    def get_users_by_ids(self) -> int:
+        users = self.repo.get_users_by_ids(self._user_id() for _ in range(50))
+        return sum(user is not None for user in users)
+
+    def get_user_langs_by_ids(self) -> int:
+        langs = self.repo.get_user_langs_by_ids(self._user_id() for _ in range(50))
+        return sum(lang is not None for lang in langs)
+
+    def get_last_ten_users(self) -> int:
+        return len(self.repo.get_last_ten_users())
+
+    def get_all_users(self) -> int:
+        return len(self.repo.get_all_users())
+
+    def stream_all_users(self) -> int:
+        return sum(1 for _ in self.repo.stream_all_users())
+
+    def get_users_page(self) -> int:
+        # * seek anywhere in the table, the cost must not depend on the depth.
+        offset = timedelta(days=self.rng.uniform(0, self.config.days))
+        after = (self.config.start + offset, self.config.users)
+        return len(self.repo.get_users_page(after))
+
+    def get_users_with_orders(self) -> int:
+        return len(self.repo.get_users_with_orders())
+
+    def get_order_with_products(self) -> int:
+        order_id = self.rng.randint(1, self.config.orders)
+        return int(self.repo.get_order_with_products(order_id) is not None)
+
+    def select_all_invited_users(self) -> int:
+        return len(self.repo.select_all_invited_users())
+
+    def get_referrals(self) -> int:
+        return len(self.repo.get_referrals(self._user_id()))
+
+    def get_referrers(self) -> int:
+        return len(self.repo.get_referrers(self._user_id()))
+
+    def get_referrals_stats(self) -> int:
+        self.repo.get_referrals_stats(self._user_id())
+        return 1
+
+    def get_all_user_orders(self) -> int:
+        return len(self.repo.get_all_user_orders(self._user_id()))
+
+    def get_recent_user_orders(self) -> int:
+        # * the last month only, the other partitions are pruned.
+        since = self.config.end - timedelta(days=30)
+        return len(self.repo.get_all_user_orders(self._user_id(), since=since))
+
+    def stream_all_user_orders(self) -> int:
+        return sum(1 for _ in self.repo.stream_all_user_orders(self._user_id()))
+
+    def get_total_of_orders(self) -> int:
+        self.repo.get_total_of_orders(self._user_id())
+        return 1
+
+    def get_total_of_orders_per_user(self) -> int:
+        return len(self.repo.get_total_of_orders_per_user())
+
+    def get_total_of_ordered_products_per_user(self) -> int:
+        return len(self.repo.get_total_of_ordered_products_per_user())
+
+    def stream_total_of_orders_per_user(self) -> int:
+        return sum(1 for _ in self.repo.stream_total_of_orders_per_user())
+
+    def stream_total_of_ordered_products_per_user(self) -> int:
+        return sum(1 for _ in self.repo.stream_total_of_ordered_products_per_user())
+
+    def set_new_referrer(self) -> int:
+        # * referrers keep preceding their referrals, the tree can't loop.
+        user_id = self.rng.randint(2, self.config.users)
+        self.repo.set_new_referrer(user_id, self.rng.randrange(1, user_id))
+        return 1
+
+    def delete_user_by_id(self) -> int:
+        self.repo.delete_user_by_id(self.added_users.pop())
+        return 1
+
+    # * methods scanning whole tables run fewer times.
+    FULL_SCANS = (
+        "get_all_users",
+        "stream_all_users",
+        "get_users_with_orders",
+        "select_all_invited_users",
+        "get_total_of_orders_per_user",
+        "stream_total_of_orders_per_user",
+        "get_total_of_ordered_products_per_user",
+        "stream_total_of_ordered_products_per_user",
+    )
+    ORDER = (
+        "add_user",
+        "add_users_bulk",
+        "add_product",
+        "add_order",
+        "add_product_to_order",
+        "bulk_add_order_products",
+        "place_order",
+        "get_user_by_id",
+        "get_user_lang",
+        "get_users_by_ids",
+        "get_user_langs_by_ids",
+        "get_last_ten_users",
+        "get_all_users",
+        "stream_all_users",
+        "get_users_page",
+        "get_users_with_orders",
+        "get_order_with_products",
+        "select_all_invited_users",
+        "get_referrals",
+        "get_referrers",
+        "get_referrals_stats",
+        "get_all_user_orders",
+        "get_recent_user_orders",
+        "stream_all_user_orders",
+        "get_total_of_orders",
+        "get_total_of_orders_per_user",
+        "stream_total_of_orders_per_user",
+        "get_total_of_ordered_products_per_user",
+        "stream_total_of_ordered_products_per_user",
+        "set_new_referrer",
+        "delete_user_by_id",
+    )
+    # * the Repo methods of the cases not named after theirs.
+    METHODS = {"get_recent_user_orders": "get_all_user_orders"}
+
+
+def time_case(
+    name: str, case: Callable[[], int], stats: QueryStats, iterations: int
+) -> CaseResult:
+    """Call a case repeatedly and summarize its latencies."""
+
+    timings, rows = [], 0
+    stats.reset()
+    for _ in range(iterations):
+        started = perf_counter()
+        rows += case()
+        timings.append(perf_counter() - started)
+
+    percentiles = statistics.quantiles(timings, n=100, method="inclusive")
+    method = stats.methods[f"Repo.{Cases.METHODS.get(name, name)}"]
+    return CaseResult(
+        calls=iterations,
+        p50_ms=percentiles[49] * 1_000,
+        p95_ms=percentiles[94] * 1_000,
+        p99_ms=percentiles[98] * 1_000,
+        queries_per_call=method.statements / iterations,
+        rows_per_second=rows / sum(timings),
+    )
+
+
+def time_projection(
+    call: Callable[[], Sized], session: Session, iterations: int
+) -> ProjectionResult:
+    """Throughput of a read, then its peak allocations traced on one more call."""
+
+    rows, started = 0, perf_counter()
+    for _ in range(iterations):
+        rows += len(call())
+    seconds = perf_counter() - started
+
+    session.expunge_all()
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return ProjectionResult(rows_per_second=rows / seconds, peak_kib=peak / 1024)
+
+
+def compare_projection(
+    repo: Repo, iterations: int = 5
+) -> dict[str, dict[str, ProjectionResult]]:
+    """Time the reads having a DTO projection, with and without it."""
+
+    calls: dict[str, Callable[[bool], Sized]] = {
+        "get_all_users": lambda dto: repo.get_all_users(dto=dto),
+        "get_all_user_orders": lambda dto: repo.get_all_user_orders(1, dto=dto),
+    }
+    return {
+        name: {
+            mode: time_projection(
+                lambda call=call, dto=dto: call(dto), repo.session, iterations
+            )
+            for mode, dto in (("orm", False), ("dto", True))
+        }
+        for name, call in calls.items()
+    }
+
+
+def compare_referrals(
+    session: Session, users: int, iterations: int = 20
+) -> dict[str, dict[str, float]]:
+    """Mean latency in ms of the referral reads, walked by CTEs or from the closure.
+
+    The first user refers the largest tree of the generated dataset, the last
+    one has the longest chain of referrers.
+    """
+
+    calls: dict[str, Callable[[Repo], Any]] = {
+        "get_referrals": lambda repo: repo.get_referrals(1),
+        "get_referrers": lambda repo: repo.get_referrers(users),
+        "get_referrals_stats": lambda repo: repo.get_referrals_stats(1),
+    }
+    results: dict[str, dict[str, float]] = {}
+    for name, call in calls.items():
+        results[name] = {}
+        for mode, closure in (("cte", False), ("closure", True)):
+            repo = Repo(session, closure=closure)
+            started = perf_counter()
+            for _ in range(iterations):
+                call(repo)
+            results[name][mode] = (perf_counter() - started) / iterations * 1_000
+    return results
+
+
+# * modules a command line or a spawned worker process imports when it starts.
+COLD_START_MODULES = (
+    "sqlalchemy_training.lesson_1",
+    "sqlalchemy_training.lesson_3",
+    "sqlalchemy_training.async_repo",
+    "sqlalchemy_training.seed",
+    "sqlalchemy_training.generator",
+)
+
+
+def import_times(
+    modules: Sequence[str] = COLD_START_MODULES, runs: int = 5
+) -> dict[str, float]:
+    """Median time in ms to start a fresh interpreter and import each module."""
+
+    times = {}
+    for module in modules:
+        timings = []
+        for _ in range(runs):
+            started = perf_counter()
+            subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+            timings.append(perf_counter() - started)
+        times[module] = statistics.median(timings) * 1_000
+    return times
+
+
+def benchmark_url(suffix: str = "_benchmark") -> URL:
+    """URL of the benchmark database, created if it doesn't exist yet."""
+
+    url = build_database_url()
+    url = url.set(database=f"{url.database}{suffix}")
+
+    admin = create_engine(url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+    with admin.connect() as connection:
+        exists = connection.scalar(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"),
+            {"name": url.database},
+        )
+        if not exists:
+            connection.execute(text(f'CREATE DATABASE "{url.database}"'))
+    admin.dispose()
+
+    return url
+
+
+def run_scale(
+    engine: Engine, config: DatasetConfig, iterations: int, workers: int
+) -> dict[str, CaseResult]:
+    """Seed a fresh schema at one scale and time every Repo method."""
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    # * the orders added by the cases are created now.
+    with engine.begin() as connection:
+        partitions.ensure(connection)
+    generator.generate(config, workers=workers, url=engine.url)
+    with engine.connect() as connection:
+        connection.execute(text("ANALYZE"))
+        connection.commit()
+
+    stats = QueryStats().install(engine)
+    results = {}
+    with Session(engine) as session:
+        cases = Cases(Repo(session), config)
+        for name in Cases.ORDER:
+            runs = max(iterations // 20, 3) if name in Cases.FULL_SCANS else iterations
+            results[name] = time_case(name, getattr(cases, name), stats, runs)
+            logger.info("%s users, %s: %s", config.users, name, results[name])
+    stats.uninstall(engine)
+
+    return results
+
+
+def git_revision() -> Optional[str]:
+    """Commit the benchmark runs on, if it runs in a git checkout."""
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    scales: list[int],
+    output: str,
+    iterations: int = 100,
+    orders_per_user: int = 2,
+    workers: int = 1,
+) -> dict[str, Any]:
+    """Benchmark each scale and write the results to a JSON baseline."""
+
+    url = benchmark_url()
+    engine = create_engine_from_env(url)
+
+    baseline: dict[str, Any] = {
+        "revision": git_revision(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "scales": {},
+        "projection": {},
+        "referrals": {},
+        "imports": import_times(),
+    }
+    for users in scales:
+        config = DatasetConfig(
+            users=users,
+            products=max(users // 100, 100),
+            orders=users * orders_per_user,
+        )
+        results = run_scale(engine, config, iterations, workers)
+        baseline["scales"][str(users)] = {
+            name: asdict(result) for name, result in results.items()
+        }
+
+        with Session(engine) as session:
+            projection = compare_projection(Repo(session))
+        logger.info("%s users, projection: %s", users, projection)
+        baseline["projection"][str(users)] = {
+            name: {mode: asdict(result) for mode, result in modes.items()}
+            for name, modes in projection.items()
+        }
+
+        with Session(engine) as session:
+            referrals = compare_referrals(session, users)
+        logger.info("%s users, referrals: %s", users, referrals)
+        baseline["referrals"][str(users)] = referrals
+
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(baseline, file, indent=2)
+    engine.dispose()
+
+    return baseline
+
+
+def compare(old: str, new: str, threshold: float = 0.2) -> list[str]:
+    """List the p95 latencies of ``new`` slower than ``old`` by ``threshold``."""
+
+    with open(old, encoding="utf-8") as file:
+        before = json.load(file)["scales"]
+    with open(new, encoding="utf-8") as file:
+        after = json.load(file)["scales"]
+
+    regressions = []
+    for scale, methods in after.items():
+        for name, result in methods.items():
+            previous = before.get(scale, {}).get(name)
+            if previous and result["p95_ms"] > previous["p95_ms"] * (1 + threshold):
+                regressions.append(
+                    f"{scale} users, {name}: p95 {previous['p95_ms']:.2f}ms "
+                    f"-> {result['p95_ms']:.2f}ms"
+                )
+
+    return regressions
+
+
+def main() -> None:
+    """Run or compare benchmarks from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument(
+        "--scales", type=int, nargs="+", default=[1_000, 100_000, 1_000_000]
+    )
+    run_parser.add_argument("--iterations", type=int, default=100)
+    run_parser.add_argument("--orders-per-user", type=int, default=2)
+    run_parser.add_argument("--workers", type=int, default=1)
+    run_parser.add_argument("--output", default="benchmark.json")
+
+    imports_parser = commands.add_parser("imports")
+    imports_parser.add_argument("--runs", type=int, default=5)
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.2)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "run":
+        run(
+            args.scales,
+            args.output,
+            iterations=args.iterations,
+            orders_per_user=args.orders_per_user,
+            workers=args.workers,
+        )
+    elif args.command == "imports":
+        for module, milliseconds in import_times(runs=args.runs).items():
+            print(f"{module}: {milliseconds:.0f}ms")
+    else:
+        regressions = compare(args.old, args.new, args.threshold)
+        print("\n".join(regressions) or "No regression.")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Read-through cache of the hot user lookups.
+
+``LRUCache`` keeps the rows in process, bounded in size and age. An optional
+shared backend, e.g. ``RedisBackend``, lets several processes share the rows
+they load; the local copies then stay stale for at most ``ttl`` seconds after
+another process changed them::
+
+    cache = LRUCache(max_size=10_000, ttl=60, shared=RedisBackend(redis.Redis()))
+    repo = Repo(session, cache=cache)
+    ...
+    cache.stats
+
+Rows are cached as dicts of column values rather than ORM objects, so they
+can be shared, and are merged back in the session without any query.
+"""
+
+import pickle
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+from typing import Any, Callable, Optional, Protocol
+
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from sqlalchemy_training.lesson_2 import User
+
+MISSING = object()
+
+
+class CacheBackend(Protocol):
+    """Storage of cached values, ``get`` returning ``MISSING`` when absent."""
+
+    def get(self, key: str) -> Any:
+        """Value of a key, or ``MISSING``."""
+
+    def set(self, key: str, value: Any) -> None:
+        """Store the value of a key."""
+
+    def delete(self, *keys: str) -> None:
+        """Forget keys, absent ones being ignored."""
+
+
+@dataclass
+class CacheStats:
+    """Counters to tune the size and the TTL of a cache."""
+
+    hits: int = 0
+    misses: int = 0
+    # * entries dropped to make room, a sign the cache is too small.
+    evictions: int = 0
+    expirations: int = 0
+    size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of the lookups served by the cache."""
+
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class RedisBackend:
+    """Shared backend storing pickled values in Redis, or any client alike."""
+
+    def __init__(self, client: Any, ttl: float = 60, prefix: str = "repo:") -> None:
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str) -> Any:
+        """Value of a key, or ``MISSING``."""
+
+        value = self.client.get(self.prefix + key)
+        return MISSING if value is None else pickle.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        """Store the value of a key, expiring after ``ttl`` seconds."""
+
+        self.client.set(self.prefix + key, pickle.dumps(value), px=int(self.ttl * 1000))
+
+    def delete(self, *keys: str) -> None:
+        """Forget keys, absent ones being ignored."""
+
+        if keys:
+            self.client.delete(*(self.prefix + key for key in keys))
+
+
+class LRUCache:
+    """In-process cache dropping the least recently used entries first.
+
+    Entries older than ``ttl`` seconds are never returned. Lookups missing
+    locally fall back to the ``shared`` backend, if any.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10_000,
+        ttl: float = 60,
+        shared: Optional[CacheBackend] = None,
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared = shared
+        self.clock = clock
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._stats = CacheStats()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        """Value of a key, or ``MISSING``."""
+
+        with self._lock:
+            value = self._get_local(key)
+            if value is not MISSING:
+                self._stats.hits += 1
+                return value
+
+        value = MISSING if self.shared is None else self.shared.get(key)
+        with self._lock:
+            if value is MISSING:
+                self._stats.misses += 1
+            else:
+                self._stats.hits += 1
+                self._set_local(key, value)
+
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Store the value of a key, locally and in the shared backend."""
+
+        with self._lock:
+            self._set_local(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def delete(self, *keys: str) -> None:
+        """Forget keys, locally and in the shared backend."""
+
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+        if self.shared is not None:
+            self.shared.delete(*keys)
+
+    def clear(self) -> None:
+        """Forget the local entries."""
+
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self) -> CacheStats:
+        """Copy of the counters."""
+
+        with self._lock:
+            return CacheStats(
+                hits=self._stats.hits,
+                misses=self._stats.misses,
+                evictions=self._stats.evictions,
+                expirations=self._stats.expirations,
+                size=len(self._entries),
+            )
+
+    def _get_local(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return MISSING
+
+        expires_at, value = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            self._stats.expirations += 1
+            return MISSING
+
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_local(self, key: str, value: Any) -> None:
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._stats.evictions += 1
+
+
+def user_keys(telegram_id: int) -> tuple[str, str]:
+    """Keys of the cached row and language of an user."""
+
+    return f"user:{telegram_id}", f"user_lang:{telegram_id}"
+
+
+def user_values(user: User) -> dict[str, Any]:
+    """Column values of an user, as cached."""
+
+    return {attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs}
+
+
+def merge_user(session: Session, values: dict[str, Any]) -> User:
+    """Attach a cached user to a session, without loading it again."""
+
+    user = User(**values)
+    make_transient_to_detached(user)
+    return session.merge(user, load=False)
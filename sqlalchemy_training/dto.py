@@ -0,0 +1,73 @@
+"""Lightweight read-only rows, built without the ORM.
+
+The read methods of ``Repo`` return them with ``dto=True``. Only the columns
+of the DTO are selected, and each row becomes a ``__slots__`` dataclass:
+no ORM instance is created, tracked in the identity map, nor expired on
+commit, which makes them much cheaper to build and to keep in memory.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, ClassVar, Iterable, Optional, Self
+
+from sqlalchemy import Select
+
+from sqlalchemy_training.lesson_2 import Order, OrderProduct, Product, User
+
+
+class DTO:
+    """Base of the DTOs, built from the rows of their ``columns``."""
+
+    __slots__ = ()
+
+    columns: ClassVar[tuple[Any, ...]]
+
+    @classmethod
+    def project(cls, stmt: Select) -> Select:
+        """Select only the columns of the DTO, keeping the joins and filters."""
+
+        return stmt.with_only_columns(*cls.columns)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple[Any, ...]]) -> list[Self]:
+        """Build the DTOs of rows selected by ``project``."""
+
+        return [cls(*row) for row in rows]
+
+
+@dataclass(slots=True, frozen=True)
+class UserDTO(DTO):
+    """Columns of an user."""
+
+    columns: ClassVar[tuple[Any, ...]] = (
+        User.telegram_id,
+        User.full_name,
+        User.user_name,
+        User.language_code,
+        User.referrer_id,
+        User.created_at,
+    )
+
+    telegram_id: int
+    full_name: str
+    user_name: Optional[str]
+    language_code: str
+    referrer_id: Optional[int]
+    created_at: datetime
+
+
+@dataclass(slots=True, frozen=True)
+class OrderLineDTO(DTO):
+    """A product ordered by an user."""
+
+    columns: ClassVar[tuple[Any, ...]] = (
+        Product.title,
+        Order.order_id,
+        User.user_name,
+        OrderProduct.quantity,
+    )
+
+    title: str
+    order_id: int
+    user_name: Optional[str]
+    quantity: int
@@ -0,0 +1,280 @@
+"""Stream the result of a select to CSV, Parquet or Arrow files.
+
+CSV goes through ``COPY (query) TO STDOUT``: PostgreSQL renders the rows and
+psycopg2 writes them to the file as they arrive, no row is ever built in
+Python. Parquet and Arrow read the rows ``batch_size`` at a time from a
+server-side cursor and write one record batch each, with pyarrow. Either way
+memory stays bounded whatever the size of the result.
+
+Any select works, e.g. the ones of the ``Repo`` methods from ``queries``, its
+columns named after their table (``orders_created_at``) unless labelled. An
+export over a range of dates can be split by month, one worker process per
+month, each reading the partitions of its month only.
+
+Usage::
+
+    python -m sqlalchemy_training.export order_lines --output exports \\
+        --since 2024-01-01 --until 2025-01-01 --format parquet --workers 4
+    python -m sqlalchemy_training.export users_order_stats --output exports
+"""
+
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+from functools import cache
+from pathlib import Path
+from typing import Any, Callable, Literal, Optional
+
+from sqlalchemy import (
+    LABEL_STYLE_TABLENAME_PLUS_COL,
+    URL,
+    Connection,
+    Engine,
+    Select,
+    types,
+)
+from sqlalchemy.pool import NullPool
+
+from sqlalchemy_training import queries
+from sqlalchemy_training.lesson_1 import create_engine_from_env
+from sqlalchemy_training.partitions import add_months, month_range
+from sqlalchemy_training.throughput import Throughput, measure
+
+logger = logging.getLogger(__name__)
+
+Format = Literal["csv", "parquet", "arrow"]
+
+# * the selects of the command line, those taking a range can be split by month.
+EXPORTS: dict[str, Callable[..., Select]] = {
+    "order_lines": queries.order_lines,
+    "users_order_stats": queries.users_order_stats,
+}
+RANGED = {"order_lines"}
+
+
+def flatten(stmt: Select) -> Select:
+    """Select the columns of the entities of a statement, named after their table."""
+
+    return stmt.with_only_columns(*stmt.selected_columns).set_label_style(
+        LABEL_STYLE_TABLENAME_PLUS_COL
+    )
+
+
+def copy_sql(connection: Connection, stmt: Select) -> str:
+    """COPY statement writing the rows of a select as CSV with a header.
+
+    COPY takes no parameters, so they are rendered in the query by psycopg2.
+    """
+
+    compiled = flatten(stmt).compile(
+        dialect=connection.dialect, compile_kwargs={"render_postcompile": True}
+    )
+    with connection.connection.cursor() as cursor:
+        query = cursor.mogrify(compiled.string, compiled.params).decode()
+    return f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+
+
+def to_csv(connection: Connection, stmt: Select, path: Path | str) -> Throughput:
+    """Write the rows of a select to a CSV file through COPY."""
+
+    sql = copy_sql(connection, stmt)
+    with (
+        measure(f"COPY to {path}") as throughput,
+        open(path, "w", encoding="utf-8", newline="") as file,
+        connection.connection.cursor() as cursor,
+    ):
+        cursor.copy_expert(sql, file)
+        throughput.rows = cursor.rowcount
+    return throughput
+
+
+def _pyarrow() -> Any:
+    """Import pyarrow, which only the Parquet and Arrow exports need."""
+
+    try:
+        # pylint: disable=import-outside-toplevel,import-error
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as error:
+        raise RuntimeError(
+            "Exporting to Parquet or Arrow requires pyarrow: pip install pyarrow"
+        ) from error
+    return pyarrow
+
+
+def _arrow_type(pa: Any, column_type: types.TypeEngine) -> Any:
+    """Arrow type of a column, so that batches of NULLs keep the schema."""
+
+    if isinstance(column_type, types.Numeric) and column_type.asdecimal:
+        return pa.decimal128(column_type.precision or 38, column_type.scale or 10)
+    try:
+        python_type = column_type.python_type
+    except NotImplementedError:
+        return pa.string()
+    arrow_types = {
+        bool: pa.bool_(),
+        int: pa.int64(),
+        float: pa.float64(),
+        Decimal: pa.decimal128(38, 10),
+        str: pa.string(),
+        datetime: pa.timestamp("us"),
+        date: pa.date32(),
+    }
+    return arrow_types.get(python_type, pa.string())
+
+
+def to_arrow(
+    connection: Connection,
+    stmt: Select,
+    path: Path | str,
+    file_format: Format = "parquet",
+    batch_size: int = 10_000,
+) -> Throughput:
+    """Write the rows of a select to a Parquet or Arrow file, batch by batch."""
+
+    pa = _pyarrow()
+    stmt = flatten(stmt)
+    schema = pa.schema(
+        [
+            (name, _arrow_type(pa, column.type))
+            for name, column in stmt.selected_columns.items()
+        ]
+    )
+    if file_format == "parquet":
+        writer = pa.parquet.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+
+    with writer, measure(f"{file_format} to {path}") as throughput:
+        result = connection.execution_options(yield_per=batch_size).execute(stmt)
+        for rows in result.partitions():
+            arrays = [
+                pa.array(values, type=field.type)
+                for values, field in zip(zip(*rows), schema)
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            throughput.rows += len(rows)
+    return throughput
+
+
+def export(
+    connection: Connection,
+    stmt: Select,
+    path: Path | str,
+    file_format: Format = "csv",
+    batch_size: int = 10_000,
+) -> Throughput:
+    """Write the rows of a select to a file of the given format."""
+
+    if file_format == "csv":
+        return to_csv(connection, stmt, path)
+    return to_arrow(connection, stmt, path, file_format, batch_size)
+
+
+@cache
+def _engine(url: Optional[URL] = None) -> Engine:
+    """One connection per worker process, never shared across a fork."""
+
+    return create_engine_from_env(url, poolclass=NullPool)
+
+
+def export_range(
+    name: str,
+    path: Path | str,
+    *,
+    file_format: Format = "csv",
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    url: Optional[URL] = None,
+) -> Throughput:
+    """Export one of ``EXPORTS``, in a range if it takes one, from a new connection."""
+
+    stmt = EXPORTS[name](since, until) if name in RANGED else EXPORTS[name]()
+    with _engine(url).connect() as connection:
+        connection.exec_driver_sql("SET TRANSACTION READ ONLY")
+        return export(connection, stmt, path, file_format)
+
+
+def export_by_month(
+    name: str,
+    directory: Path | str,
+    since: datetime,
+    until: datetime,
+    *,
+    file_format: Format = "csv",
+    workers: int = 1,
+) -> Throughput:
+    """Export one file per month of ``[since, until)``, in worker processes.
+
+    Each month is read in its own transaction, so the files are consistent
+    within a month, not across months.
+    """
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    tasks = [
+        {
+            "name": name,
+            "path": directory / f"{name}_{month:%Y_%m}.{file_format}",
+            "file_format": file_format,
+            "since": max(month, since),
+            "until": min(add_months(month, 1), until),
+        }
+        for month in month_range(since, until)
+    ]
+
+    with measure(f"export {name} by month") as throughput:
+        if workers <= 1:
+            throughput.rows = sum(export_range(**task).rows for task in tasks)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(export_range, **task) for task in tasks]
+                throughput.rows = sum(future.result().rows for future in futures)
+    return throughput
+
+
+def main() -> None:
+    """Export a select from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("name", choices=sorted(EXPORTS))
+    parser.add_argument("--output", default=".", help="directory of the files")
+    parser.add_argument("--format", choices=["csv", "parquet", "arrow"], default="csv")
+    parser.add_argument("--since", type=datetime.fromisoformat)
+    parser.add_argument("--until", type=datetime.fromisoformat)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.name not in RANGED and (args.since or args.until):
+        parser.error(f"{args.name} can't be restricted to a range")
+    if args.workers > 1 and not (args.since and args.until):
+        parser.error("--workers splits the range of --since and --until")
+
+    if args.workers > 1:
+        throughput = export_by_month(
+            args.name,
+            args.output,
+            args.since,
+            args.until,
+            file_format=args.format,
+            workers=args.workers,
+        )
+    else:
+        directory = Path(args.output)
+        directory.mkdir(parents=True, exist_ok=True)
+        throughput = export_range(
+            args.name,
+            directory / f"{args.name}.{args.format}",
+            file_format=args.format,
+            since=args.since,
+            until=args.until,
+        )
+    print(throughput)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""Generate reproducible fake datasets and load them in parallel.
+
+The rows are produced in chunks of ``batch_size``. Each chunk has its own random
+generator seeded from the dataset seed and the chunk number, so the output is
+the same whatever the number of workers. Chunks are loaded with COPY by a pool
+of worker processes.
+
+Usage::
+
+    python -m sqlalchemy_training.generator --users 1000000 --orders 10000000
+"""
+
+import argparse
+import logging
+import random
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from functools import cache
+from itertools import accumulate
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Optional
+
+from sqlalchemy import URL, Engine
+from sqlalchemy.pool import NullPool
+
+from sqlalchemy_training.copy_loader import CopyLoader
+from sqlalchemy_training.lesson_1 import create_engine_from_env
+from sqlalchemy_training.lesson_2 import Order, OrderProduct, Product, User
+from sqlalchemy_training.partitions import create_partitions
+from sqlalchemy_training.throughput import Throughput, measure
+
+if TYPE_CHECKING:
+    from faker import Faker
+
+USER_COLUMNS = (
+    "telegram_id",
+    "full_name",
+    "user_name",
+    "language_code",
+    "referrer_id",
+    "created_at",
+    "updated_at",
+)
+PRODUCT_COLUMNS = (
+    "product_id",
+    "title",
+    "description",
+    "price",
+    "created_at",
+    "updated_at",
+)
+ORDER_COLUMNS = ("order_id", "user_id", "created_at", "updated_at")
+ORDER_PRODUCT_COLUMNS = ("order_id", "order_created_at", "product_id", "quantity")
+
+
+@dataclass(frozen=True)
+class DatasetConfig:  # pylint: disable=too-many-instance-attributes
+    """Size and distribution knobs of a generated dataset."""
+
+    users: int = 1_000
+    products: int = 100
+    orders: int = 10_000
+    # * the number of lines of an order is uniform in [1, max_lines_per_order].
+    max_lines_per_order: int = 5
+    max_quantity: int = 10
+    # * share of the users invited by another user, building referral chains.
+    referral_rate: float = 0.3
+    # * exponent of the Zipf law of product popularity, 0 for uniform.
+    product_skew: float = 1.1
+    start: datetime = field(default_factory=lambda: datetime(2024, 1, 1))
+    days: int = 365
+    seed: int = 0
+    batch_size: int = 10_000
+
+    @property
+    def end(self) -> datetime:
+        """End of the period the rows are created in."""
+
+        return self.start + timedelta(days=self.days)
+
+    def chunks(self, rows: int) -> range:
+        """Chunk numbers needed to produce ``rows`` rows."""
+
+        return range(-(-rows // self.batch_size))
+
+    def bounds(self, chunk: int, rows: int) -> range:
+        """IDs, starting at 1, produced by a chunk."""
+
+        first = chunk * self.batch_size + 1
+        return range(first, min(first + self.batch_size, rows + 1))
+
+
+def _random(config: DatasetConfig, kind: str, chunk: int) -> random.Random:
+    return random.Random(f"{config.seed}:{kind}:{chunk}")
+
+
+def _faker(rng: random.Random) -> "Faker":
+    # * imported on first use, importing faker alone takes longer than the
+    # * rest of the package.
+    from faker import Faker  # pylint: disable=import-outside-toplevel
+
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(32))
+    return fake
+
+
+def _timestamp(config: DatasetConfig, rng: random.Random) -> datetime:
+    return config.start + timedelta(seconds=rng.uniform(0, config.days * 86_400))
+
+
+@cache
+def _product_weights(products: int, skew: float) -> list[float]:
+    """Cumulative Zipf weights, product 1 being the most popular."""
+
+    return list(accumulate(1 / rank**skew for rank in range(1, products + 1)))
+
+
+def generate_users(config: DatasetConfig, chunk: int) -> Iterator[tuple[Any, ...]]:
+    """Users of a chunk, referrers always invited earlier in the same chunk."""
+
+    rng = _random(config, "users", chunk)
+    fake = _faker(rng)
+    ids = config.bounds(chunk, config.users)
+
+    for telegram_id in ids:
+        referrer_id = None
+        if telegram_id > ids.start and rng.random() < config.referral_rate:
+            referrer_id = rng.randrange(ids.start, telegram_id)
+        created_at = _timestamp(config, rng)
+        yield (
+            telegram_id,
+            fake.name(),
+            fake.user_name(),
+            fake.language_code(),
+            referrer_id,
+            created_at,
+            created_at,
+        )
+
+
+def generate_products(config: DatasetConfig, chunk: int) -> Iterator[tuple[Any, ...]]:
+    """Products of a chunk."""
+
+    rng = _random(config, "products", chunk)
+    fake = _faker(rng)
+
+    for product_id in config.bounds(chunk, config.products):
+        created_at = _timestamp(config, rng)
+        yield (
+            product_id,
+            fake.word(),
+            fake.sentence(),
+            round(rng.uniform(1, 1_000), 2),
+            created_at,
+            created_at,
+        )
+
+
+def generate_orders(
+    config: DatasetConfig, chunk: int
+) -> tuple[list[tuple[Any, ...]], list[tuple[Any, ...]]]:
+    """Orders of a chunk and their lines, products picked by popularity."""
+
+    rng = _random(config, "orders", chunk)
+    weights = _product_weights(config.products, config.product_skew)
+    product_ids = range(1, config.products + 1)
+    orders, lines = [], []
+
+    for order_id in config.bounds(chunk, config.orders):
+        created_at = _timestamp(config, rng)
+        orders.append((order_id, rng.randint(1, config.users), created_at, created_at))
+
+        size = rng.randint(1, config.max_lines_per_order)
+        picked = rng.choices(product_ids, cum_weights=weights, k=size)
+        for product_id in dict.fromkeys(picked):
+            quantity = rng.randint(1, config.max_quantity)
+            lines.append((order_id, created_at, product_id, quantity))
+
+    return orders, lines
+
+
+@cache
+def _engine(url: Optional[URL] = None) -> Engine:
+    """One connection per worker process, never shared across a fork."""
+
+    return create_engine_from_env(url, poolclass=NullPool)
+
+
+def load_users(
+    config: DatasetConfig, chunk: int, upsert: bool, url: Optional[URL] = None
+) -> Throughput:
+    """Generate and copy a chunk of users."""
+
+    with _engine(url).begin() as connection:
+        loader = CopyLoader(connection)
+        copy = loader.upsert if upsert else loader.copy
+        return copy(User.__table__, generate_users(config, chunk), USER_COLUMNS)
+
+
+def load_products(
+    config: DatasetConfig, chunk: int, upsert: bool, url: Optional[URL] = None
+) -> Throughput:
+    """Generate and copy a chunk of products."""
+
+    with _engine(url).begin() as connection:
+        loader = CopyLoader(connection)
+        copy = loader.upsert if upsert else loader.copy
+        return copy(
+            Product.__table__, generate_products(config, chunk), PRODUCT_COLUMNS
+        )
+
+
+def load_orders(
+    config: DatasetConfig, chunk: int, upsert: bool, url: Optional[URL] = None
+) -> Throughput:
+    """Generate and copy a chunk of orders with their lines, in one transaction."""
+
+    orders, lines = generate_orders(config, chunk)
+    with _engine(url).begin() as connection:
+        loader = CopyLoader(connection)
+        copy = loader.upsert if upsert else loader.copy
+        throughput = copy(Order.__table__, orders, ORDER_COLUMNS)
+        lines_throughput = copy(OrderProduct.__table__, lines, ORDER_PRODUCT_COLUMNS)
+
+    throughput.rows += lines_throughput.rows
+    throughput.seconds += lines_throughput.seconds
+    return throughput
+
+
+def _run(
+    tasks: list[tuple[Callable[..., Throughput], int]],
+    config: DatasetConfig,
+    workers: int,
+    upsert: bool,
+    url: Optional[URL],
+) -> int:
+    """Run the chunk loaders, in worker processes when there are several."""
+
+    if workers <= 1:
+        return sum(load(config, chunk, upsert, url).rows for load, chunk in tasks)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(load, config, chunk, upsert, url) for load, chunk in tasks
+        ]
+        return sum(future.result().rows for future in futures)
+
+
+def generate(
+    config: DatasetConfig,
+    workers: int = 1,
+    upsert: bool = False,
+    url: Optional[URL] = None,
+) -> Throughput:
+    """Generate a dataset and load it, users and products before orders.
+
+    With ``upsert`` the rows replace existing ones with the same IDs, otherwise
+    the tables must not contain them yet. The rows go to the configured
+    database unless another ``url`` is given.
+    """
+
+    with measure(f"generate (seed={config.seed})") as throughput:
+        throughput.rows += _run(
+            [(load_users, chunk) for chunk in config.chunks(config.users)]
+            + [(load_products, chunk) for chunk in config.chunks(config.products)],
+            config,
+            workers,
+            upsert,
+            url,
+        )
+        # * before any order lands in the default partitions.
+        with _engine(url).begin() as connection:
+            create_partitions(connection, config.start, config.end)
+        throughput.rows += _run(
+            [(load_orders, chunk) for chunk in config.chunks(config.orders)],
+            config,
+            workers,
+            upsert,
+            url,
+        )
+
+        # * chunks commit concurrently, so only now are all IDs visible.
+        with _engine(url).begin() as connection:
+            loader = CopyLoader(connection)
+            loader.reset_sequence(Product.__table__, PRODUCT_COLUMNS)
+            loader.reset_sequence(Order.__table__, ORDER_COLUMNS)
+
+    return throughput
+
+
+def main() -> None:
+    """Generate a dataset from the command line."""
+
+    defaults = DatasetConfig()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--products", type=int, default=defaults.products)
+    parser.add_argument("--orders", type=int, default=defaults.orders)
+    parser.add_argument(
+        "--max-lines-per-order", type=int, default=defaults.max_lines_per_order
+    )
+    parser.add_argument("--max-quantity", type=int, default=defaults.max_quantity)
+    parser.add_argument("--referral-rate", type=float, default=defaults.referral_rate)
+    parser.add_argument("--product-skew", type=float, default=defaults.product_skew)
+    parser.add_argument("--days", type=int, default=defaults.days)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--batch-size", type=int, default=defaults.batch_size)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--upsert", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config = DatasetConfig(
+        users=args.users,
+        products=args.products,
+        orders=args.orders,
+        max_lines_per_order=args.max_lines_per_order,
+        max_quantity=args.max_quantity,
+        referral_rate=args.referral_rate,
+        product_skew=args.product_skew,
+        days=args.days,
+        seed=args.seed,
+        batch_size=args.batch_size,
+    )
+    generate(config, workers=args.workers, upsert=args.upsert)
+
+
+if __name__ == "__main__":
+    main()
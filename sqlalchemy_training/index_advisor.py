@@ -0,0 +1,232 @@
+"""Run EXPLAIN on the statements of every Repo method and flag missing indexes.
+
+The benchmark cases call each Repo method on the configured database while
+their statements are captured, in a transaction rolled back at the end. Each
+statement is then run again under ``EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)``
+in a savepoint, and the sequential scans reading many rows are reported along
+with the foreign keys no index starts with.
+
+Usage::
+
+    python -m sqlalchemy_training.index_advisor --min-rows 1000
+"""
+
+import argparse
+import logging
+import sys
+from dataclasses import dataclass
+from typing import Any, Iterator, Optional
+
+from sqlalchemy import Connection, Engine, event, func, inspect, select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from sqlalchemy_training.benchmark import Cases
+from sqlalchemy_training.generator import DatasetConfig
+from sqlalchemy_training.instrumentation import current_method
+from sqlalchemy_training.lesson_1 import create_engine_from_env
+from sqlalchemy_training.lesson_2 import Order, Product, User
+from sqlalchemy_training.lesson_3 import Repo
+
+logger = logging.getLogger(__name__)
+
+# * keys of the plan nodes telling why a table is read.
+CONDITIONS = ("Filter", "Hash Cond", "Merge Cond", "Join Filter", "Sort Key")
+
+
+@dataclass
+class Finding:
+    """A sequential scan a Repo method could avoid with an index."""
+
+    method: str
+    relation: str
+    rows: int
+    buffers: int
+    condition: Optional[str]
+    statement: str
+
+    def __str__(self) -> str:
+        condition = f" for {self.condition}" if self.condition else ""
+        return (
+            f"{self.method}: Seq Scan on {self.relation}{condition}, "
+            f"{self.rows} rows, {self.buffers} buffers"
+        )
+
+
+def dataset_config(session: Session) -> DatasetConfig:
+    """Bounds of the IDs the cases pick from, read from the tables."""
+
+    def last(column: Any) -> int:
+        return max(session.scalar(select(func.coalesce(func.max(column), 0))), 1)
+
+    return DatasetConfig(
+        users=last(User.telegram_id),
+        products=last(Product.product_id),
+        orders=last(Order.order_id),
+    )
+
+
+def capture_statements(session: Session, cases: Cases) -> dict[tuple[str, str], Any]:
+    """Call every case, keeping the first parameters of each method statement."""
+
+    captured: dict[tuple[str, str], Any] = {}
+
+    def before(  # pylint: disable=unused-argument,too-many-positional-arguments
+        conn, cursor, statement, parameters, context, executemany
+    ) -> None:
+        method = current_method.get()
+        if method and not executemany:
+            captured.setdefault((method, statement), parameters)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", before)
+    try:
+        for name in Cases.ORDER:
+            try:
+                with session.begin_nested():
+                    getattr(cases, name)()
+            # * a case fails when the one creating its rows failed too.
+            except (DBAPIError, LookupError) as error:
+                logger.warning("%s failed, skipped: %s", name, error)
+    finally:
+        event.remove(engine, "before_cursor_execute", before)
+
+    return captured
+
+
+def explain(session: Session, statement: str, parameters: Any) -> dict[str, Any]:
+    """Plan of a statement, run in a savepoint rolled back right after."""
+
+    savepoint = session.begin_nested()
+    try:
+        return (
+            session.connection()
+            .exec_driver_sql(
+                f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters
+            )
+            .scalar()[0]
+        )
+    finally:
+        savepoint.rollback()
+
+
+def _nodes(
+    node: dict[str, Any], ancestors: tuple[dict[str, Any], ...] = ()
+) -> Iterator[tuple[dict[str, Any], tuple[dict[str, Any], ...]]]:
+    yield node, ancestors
+    for child in node.get("Plans", []):
+        yield from _nodes(child, (node, *ancestors))
+
+
+def _condition(node: dict[str, Any], ancestors: tuple[dict[str, Any], ...]) -> Any:
+    """Closest filter, join or sort condition explaining why a node reads rows."""
+
+    for candidate in (node, *ancestors):
+        for key in CONDITIONS:
+            if key in candidate:
+                value = candidate[key]
+                return ", ".join(value) if isinstance(value, list) else value
+    return None
+
+
+def seq_scans(
+    method: str, statement: str, plan: dict[str, Any], min_rows: int
+) -> list[Finding]:
+    """Sequential scans of a plan reading at least ``min_rows`` rows."""
+
+    findings = []
+    for node, ancestors in _nodes(plan["Plan"]):
+        if node["Node Type"] != "Seq Scan":
+            continue
+        read = node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0)
+        rows = read * node.get("Actual Loops", 1)
+        if rows < min_rows:
+            continue
+        findings.append(
+            Finding(
+                method=method,
+                relation=node["Relation Name"],
+                rows=rows,
+                buffers=node.get("Shared Hit Blocks", 0)
+                + node.get("Shared Read Blocks", 0),
+                condition=_condition(node, ancestors),
+                statement=statement,
+            )
+        )
+
+    return findings
+
+
+def unindexed_foreign_keys(connection: Connection) -> list[str]:
+    """Foreign keys no index nor primary key starts with."""
+
+    inspector = inspect(connection)
+    missing = []
+    for table_name in inspector.get_table_names():
+        prefixes = [
+            index["column_names"] for index in inspector.get_indexes(table_name)
+        ]
+        prefixes.append(inspector.get_pk_constraint(table_name)["constrained_columns"])
+
+        for foreign_key in inspector.get_foreign_keys(table_name):
+            columns = foreign_key["constrained_columns"]
+            if not any(
+                set(prefix[: len(columns)]) == set(columns) for prefix in prefixes
+            ):
+                missing.append(
+                    f"{table_name}({', '.join(columns)}) "
+                    f"-> {foreign_key['referred_table']}"
+                )
+
+    return missing
+
+
+def advise(engine: Engine, min_rows: int = 1_000) -> tuple[list[Finding], list[str]]:
+    """Sequential scans of the Repo statements, and the unindexed foreign keys."""
+
+    findings = []
+    with Session(engine) as session:
+        cases = Cases(Repo(session, autocommit=False), dataset_config(session))
+        captured = capture_statements(session, cases)
+
+        for (method, statement), parameters in captured.items():
+            try:
+                plan = explain(session, statement, parameters)
+            except DBAPIError as error:
+                logger.warning("Can't explain %s: %s", method, error.orig)
+                continue
+            findings.extend(seq_scans(method, statement, plan, min_rows))
+
+        missing = unindexed_foreign_keys(session.connection())
+        session.rollback()
+
+    return findings, missing
+
+
+def main() -> None:
+    """Report the missing indexes from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--min-rows", type=int, default=1_000)
+    parser.add_argument("--verbose", action="store_true", help="print statements")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = create_engine_from_env()
+    findings, missing = advise(engine, args.min_rows)
+    engine.dispose()
+
+    for finding in findings:
+        print(finding)
+        if args.verbose:
+            print(f"    {' '.join(finding.statement.split())}")
+    for foreign_key in missing:
+        print(f"Unindexed foreign key: {foreign_key}")
+    if not findings and not missing:
+        print("No sequential scan nor unindexed foreign key.")
+
+    sys.exit(1 if findings or missing else 0)
+
+
+if __name__ == "__main__":
+    main()
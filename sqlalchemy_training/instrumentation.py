@@ -0,0 +1,314 @@
+"""Per-method and per-statement query statistics, and a slow query log.
+
+Statistics are gathered from the ``before_cursor_execute`` and
+``after_cursor_execute`` engine events, and attributed to the repository
+method running them thanks to the ``instrumented`` class decorator::
+
+    stats = QueryStats(slow_threshold=0.2).install(engine)
+    ...
+    stats.snapshot()
+    stats.cache_hit_rate()  # share of the statements found compiled already
+    serve_metrics(stats, port=9100)  # Prometheus text on /metrics, JSON on /stats
+"""
+
+import functools
+import inspect
+import json
+import logging
+import threading
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Any, Callable, Iterator, Optional, Self, TypeVar
+
+from sqlalchemy import Engine, event
+from sqlalchemy.engine.interfaces import CacheStats
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+slow_query_logger = logging.getLogger(f"{__name__}.slow_queries")
+
+current_method: ContextVar[Optional[str]] = ContextVar("current_method", default=None)
+
+T = TypeVar("T", bound=type)
+
+
+@dataclass
+class Stat:
+    """Counters of a method or a statement."""
+
+    calls: int = 0
+    statements: int = 0
+    seconds: float = 0.0
+    rows: int = 0
+    # * lookups of the statements in the compiled cache of the engine.
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+
+class QueryStats:
+    """Statistics of the statements run by one or several engines.
+
+    Method calls are recorded by the ``instrumented`` classes whatever the
+    engine, so a QueryStats should be installed on the engines they use.
+    """
+
+    def __init__(self, slow_threshold: Optional[float] = None) -> None:
+        self.slow_threshold = slow_threshold
+        self.methods: dict[str, Stat] = {}
+        self.statements: dict[str, Stat] = {}
+        self._lock = threading.Lock()
+        # * the start of a statement is kept on its execution context, under a
+        # * name of its own should several QueryStats time the same engine.
+        self._started = f"_query_started_{id(self)}"
+
+    def install(self, engine: Engine | AsyncEngine) -> Self:
+        """Start recording the statements of an engine."""
+
+        engine = getattr(engine, "sync_engine", engine)
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        event.listen(engine, "handle_error", self._error)
+        _installed.append(self)
+        return self
+
+    def uninstall(self, engine: Engine | AsyncEngine) -> None:
+        """Stop recording the statements of an engine."""
+
+        engine = getattr(engine, "sync_engine", engine)
+        event.remove(engine, "before_cursor_execute", self._before)
+        event.remove(engine, "after_cursor_execute", self._after)
+        event.remove(engine, "handle_error", self._error)
+        if self in _installed:
+            _installed.remove(self)
+
+    def _before(  # pylint: disable=unused-argument,too-many-positional-arguments
+        self, conn, cursor, statement, parameters, context, executemany
+    ) -> None:
+        if context is not None:
+            setattr(context, self._started, perf_counter())
+
+    def _after(  # pylint: disable=unused-argument,too-many-positional-arguments
+        self, conn, cursor, statement, parameters, context, executemany
+    ) -> None:
+        started = getattr(context, self._started, None)
+        if started is None:
+            return
+        delattr(context, self._started)
+        seconds = perf_counter() - started
+        rows = max(cursor.rowcount, 0)
+        method = current_method.get()
+        cache_hit = getattr(context, "cache_hit", None)
+        hits, misses = (
+            cache_hit is CacheStats.CACHE_HIT,
+            cache_hit is CacheStats.CACHE_MISS,
+        )
+
+        with self._lock:
+            stat = self.statements.setdefault(statement, Stat())
+            stat.calls += 1
+            stat.statements += 1
+            stat.seconds += seconds
+            stat.rows += rows
+            stat.cache_hits += hits
+            stat.cache_misses += misses
+            if method:
+                stat = self.methods.setdefault(method, Stat())
+                stat.statements += 1
+                stat.rows += rows
+                stat.cache_hits += hits
+                stat.cache_misses += misses
+
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            slow_query_logger.warning(
+                "%.3fs in %s: %s %r", seconds, method or "-", statement, parameters
+            )
+
+    def _error(self, exception_context) -> None:
+        """Forget the start of a failed statement, no after event follows."""
+
+        context = exception_context.execution_context
+        if context is not None and hasattr(context, self._started):
+            delattr(context, self._started)
+
+    def record_call(self, method: str, seconds: float) -> None:
+        """Add a call of an instrumented method."""
+
+        with self._lock:
+            stat = self.methods.setdefault(method, Stat())
+            stat.calls += 1
+            stat.seconds += seconds
+
+    def reset(self) -> None:
+        """Forget everything recorded so far."""
+
+        with self._lock:
+            self.methods.clear()
+            self.statements.clear()
+
+    def snapshot(self) -> dict[str, dict[str, dict[str, Any]]]:
+        """Copy of the counters, keyed by method and by statement."""
+
+        with self._lock:
+            return {
+                "methods": {name: asdict(s) for name, s in self.methods.items()},
+                "statements": {sql: asdict(s) for sql, s in self.statements.items()},
+            }
+
+    def cache_hit_rate(self) -> float:
+        """Share of the compiled cache lookups finding the statement compiled.
+
+        A rate well below 1 once warmed up means the cache is too small for
+        the statements in use, or that statements embed literal values.
+        """
+
+        with self._lock:
+            hits = sum(stat.cache_hits for stat in self.statements.values())
+            misses = sum(stat.cache_misses for stat in self.statements.values())
+
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def prometheus(self) -> str:
+        """Counters in the Prometheus text exposition format."""
+
+        lines = []
+        snapshot = self.snapshot()
+        for kind, label in (("methods", "method"), ("statements", "statement")):
+            for field in (
+                "calls",
+                "statements",
+                "seconds",
+                "rows",
+                "cache_hits",
+                "cache_misses",
+            ):
+                if kind == "statements" and field == "statements":
+                    continue
+                metric = f"sqlalchemy_{label}_{field}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for key, values in snapshot[kind].items():
+                    escaped = " ".join(key.split()).replace("\\", "\\\\")
+                    escaped = escaped.replace('"', '\\"')
+                    lines.append(f'{metric}{{{label}="{escaped}"}} {values[field]}')
+
+        return "\n".join(lines) + "\n"
+
+
+_installed: list[QueryStats] = []
+
+
+def compiled_cache_stats(engine: Engine | AsyncEngine) -> dict[str, int]:
+    """Number of statements in the compiled cache of an engine, and its capacity."""
+
+    engine = getattr(engine, "sync_engine", engine)
+    cache = engine._compiled_cache  # pylint: disable=protected-access
+    if cache is None:
+        return {"size": 0, "capacity": 0}
+    return {"size": len(cache), "capacity": cache.capacity}
+
+
+def instrumented(cls: T) -> T:
+    """Record the calls of the public methods of a class in the installed stats."""
+
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.isfunction(method):
+            continue
+        setattr(cls, name, _wrap(f"{cls.__name__}.{name}", method))
+
+    return cls
+
+
+def _wrap(name: str, method: Callable) -> Callable:
+    if inspect.iscoroutinefunction(method):
+
+        @functools.wraps(method)
+        async def async_wrapper(*args, **kwargs):
+            token = current_method.set(name)
+            started = perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                _record(name, perf_counter() - started)
+                current_method.reset(token)
+
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        token = current_method.set(name)
+        started = perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except BaseException:
+            _record(name, perf_counter() - started)
+            raise
+        finally:
+            current_method.reset(token)
+
+        if inspect.isgenerator(result):
+            return _iterate(name, result, perf_counter() - started)
+        _record(name, perf_counter() - started)
+        return result
+
+    return wrapper
+
+
+def _iterate(name: str, rows: Iterator[Any], seconds: float) -> Iterator[Any]:
+    """Attribute the statements run by a generator to its method.
+
+    Only the time spent in the generator counts, not the one of the caller
+    consuming the rows. The call is recorded once the generator is closed.
+    """
+
+    try:
+        while True:
+            token = current_method.set(name)
+            started = perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                seconds += perf_counter() - started
+                current_method.reset(token)
+            yield row
+    finally:
+        rows.close()
+        _record(name, seconds)
+
+
+def _record(name: str, seconds: float) -> None:
+    for stats in _installed:
+        stats.record_call(name, seconds)
+
+
+def serve_metrics(
+    stats: QueryStats, host: str = "127.0.0.1", port: int = 9100
+) -> ThreadingHTTPServer:
+    """Serve the stats in a background thread, on /metrics and /stats."""
+
+    class Handler(BaseHTTPRequestHandler):
+        """Render the stats for each GET request."""
+
+        def do_GET(self) -> None:  # pylint: disable=invalid-name
+            """Send the Prometheus text or the JSON snapshot."""
+
+            if self.path == "/metrics":
+                body, content_type = stats.prometheus(), "text/plain; version=0.0.4"
+            elif self.path == "/stats":
+                body, content_type = json.dumps(stats.snapshot()), "application/json"
+            else:
+                self.send_error(404)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+            """Don't log each scrape."""
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -3,24 +3,270 @@
 - Create DB connection.
 - Create a table.
 - Select columns from table.
+- Create an async DB connection.
+- Create a read-only session profile.
+- Configure the engine and its connection pool from the environment.
+- Build the URLs of the read replicas.
+- Build the engines and the session makers lazily, on first use.
 """
 
 import os
+from functools import cache
+from typing import Any, Callable, Optional
+from uuid import uuid4
 
 from dotenv import load_dotenv
-from sqlalchemy import URL, create_engine
-from sqlalchemy.orm import sessionmaker
-
-load_dotenv()
-
-database_url = URL.create(
-    drivername="postgresql+psycopg2",  # * postgresql + library we are using (psycopg2)
-    database=os.getenv("POSTGRES_DB"),
-    username=os.getenv("POSTGRES_USER"),
-    password=os.getenv("POSTGRES_PASSWORD"),
-    host=os.getenv("POSTGRES_HOST"),
-    port=os.getenv("POSTGRES_PORT"),
+from sqlalchemy import URL, Connection, Engine, create_engine, event
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
 )
+from sqlalchemy.orm import Session, SessionTransaction, sessionmaker
+from sqlalchemy.pool import QueuePool
 
-engine = create_engine(database_url, echo=True)
-session_maker = sessionmaker(engine)
+
+@cache
+def load_env() -> None:
+    """Load the ``.env`` file, once, before the first variable is read."""
+
+    load_dotenv()
+
+
+def _getenv(name: str, default: Optional[str] = None) -> Optional[str]:
+    load_env()
+    return os.getenv(name, default)
+
+
+def build_database_url(drivername: str = "postgresql+psycopg2") -> URL:
+    """Build the DB URL from the ``POSTGRES_*`` environment variables."""
+
+    return URL.create(
+        drivername=drivername,  # * postgresql + library we are using
+        database=_getenv("POSTGRES_DB"),
+        username=_getenv("POSTGRES_USER"),
+        password=_getenv("POSTGRES_PASSWORD"),
+        host=_getenv("POSTGRES_HOST"),
+        port=_getenv("POSTGRES_PORT"),
+    )
+
+
+def build_replica_urls(drivername: str = "postgresql+psycopg2") -> list[URL]:
+    """Build the URLs of the replicas listed in ``POSTGRES_REPLICA_HOSTS``.
+
+    The variable holds comma-separated ``host[:port]``, the other parts of the
+    URLs, the port included when absent, are the ones of the primary.
+    """
+
+    urls = []
+    for address in _getenv("POSTGRES_REPLICA_HOSTS", "").split(","):
+        host, _, port = address.strip().partition(":")
+        if not host:
+            continue
+        url = build_database_url(drivername).set(host=host)
+        urls.append(url.set(port=int(port)) if port else url)
+    return urls
+
+
+def _env_int(name: str, default: Optional[int] = None) -> Optional[int]:
+    value = _getenv(name)
+    return int(value) if value else default
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    value = _getenv(name)
+    return value.lower() in ("1", "true", "yes", "on") if value else default
+
+
+def engine_options(url: URL, **overrides: Any) -> dict[str, Any]:
+    """Engine keyword arguments read from the environment.
+
+    - ``POSTGRES_ECHO``: log every statement, off by default.
+    - ``POSTGRES_POOL_SIZE``, ``POSTGRES_MAX_OVERFLOW``, ``POSTGRES_POOL_TIMEOUT``
+      and ``POSTGRES_POOL_RECYCLE``: sizing of the ``QueuePool``.
+    - ``POSTGRES_POOL_PRE_PING``: test connections when they are checked out.
+    - ``POSTGRES_STATEMENT_TIMEOUT``: server-side timeout of statements in ms.
+    - ``POSTGRES_APPLICATION_NAME``: name shown in ``pg_stat_activity``.
+    - ``POSTGRES_PGBOUNCER``: the host is a PgBouncer in transaction pooling
+      mode, so no prepared statements and no session-level settings.
+    - ``POSTGRES_PREPARED_STATEMENT_CACHE_SIZE``: statements asyncpg keeps
+      prepared on the server, per connection.
+    - ``POSTGRES_PREPARE_THRESHOLD``: executions of a statement after which
+      psycopg (3) prepares it on the server. psycopg2 never prepares them.
+
+    The pool sizing is skipped when ``overrides`` chooses another pool class.
+    """
+
+    pgbouncer = _env_bool("POSTGRES_PGBOUNCER")
+    statement_timeout = _env_int("POSTGRES_STATEMENT_TIMEOUT")
+    application_name = _getenv("POSTGRES_APPLICATION_NAME", "sqlalchemy-training")
+    is_asyncpg = url.get_driver_name() == "asyncpg"
+    prepared_statement_cache_size = _env_int("POSTGRES_PREPARED_STATEMENT_CACHE_SIZE")
+    prepare_threshold = _env_int("POSTGRES_PREPARE_THRESHOLD")
+
+    options: dict[str, Any] = {
+        "echo": _env_bool("POSTGRES_ECHO"),
+        "pool_pre_ping": _env_bool("POSTGRES_POOL_PRE_PING"),
+    }
+    if "poolclass" not in overrides:
+        options.update(
+            pool_size=_env_int("POSTGRES_POOL_SIZE", 5),
+            max_overflow=_env_int("POSTGRES_MAX_OVERFLOW", 10),
+            pool_timeout=_env_int("POSTGRES_POOL_TIMEOUT", 30),
+            pool_recycle=_env_int("POSTGRES_POOL_RECYCLE", -1),
+        )
+
+    # * PgBouncer only forwards a few startup parameters, statement_timeout is
+    # * set per transaction by set_statement_timeout instead.
+    settings = {"application_name": application_name}
+    if statement_timeout is not None and not pgbouncer:
+        settings["statement_timeout"] = str(statement_timeout)
+
+    if is_asyncpg:
+        connect_args: dict[str, Any] = {"server_settings": settings}
+        if pgbouncer:
+            connect_args.update(
+                statement_cache_size=0,
+                prepared_statement_cache_size=0,
+                prepared_statement_name_func=lambda: f"__asyncpg_{uuid4()}__",
+            )
+        elif prepared_statement_cache_size is not None:
+            connect_args["prepared_statement_cache_size"] = (
+                prepared_statement_cache_size
+            )
+    else:
+        connect_args = {"application_name": settings.pop("application_name")}
+        if settings:
+            connect_args["options"] = " ".join(
+                f"-c {name}={value}" for name, value in settings.items()
+            )
+        if url.get_driver_name() == "psycopg" and pgbouncer:
+            # * None never prepares statements.
+            connect_args["prepare_threshold"] = None
+        elif url.get_driver_name() == "psycopg" and prepare_threshold is not None:
+            connect_args["prepare_threshold"] = prepare_threshold
+    options["connect_args"] = connect_args
+
+    options.update(overrides)
+    return options
+
+
+def set_statement_timeout(target: Engine) -> None:
+    """Set the statement timeout at the start of each transaction (PgBouncer)."""
+
+    statement_timeout = _env_int("POSTGRES_STATEMENT_TIMEOUT")
+    if statement_timeout is None or not _env_bool("POSTGRES_PGBOUNCER"):
+        return
+
+    @event.listens_for(target, "begin")
+    def _set_local(connection: Connection) -> None:
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {statement_timeout}")
+
+
+def create_engine_from_env(url: Optional[URL] = None, **overrides: Any) -> Engine:
+    """Create an engine configured by the ``POSTGRES_*`` environment variables."""
+
+    url = url or build_database_url()
+    new_engine = create_engine(url, **engine_options(url, **overrides))
+    set_statement_timeout(new_engine)
+    return new_engine
+
+
+def create_async_engine_from_env(
+    url: Optional[URL] = None, **overrides: Any
+) -> AsyncEngine:
+    """Create an asyncpg engine configured by the environment variables."""
+
+    url = url or build_database_url("postgresql+asyncpg")
+    new_engine = create_async_engine(url, **engine_options(url, **overrides))
+    set_statement_timeout(new_engine.sync_engine)
+    return new_engine
+
+
+def pool_stats(target: Engine | AsyncEngine) -> dict[str, Any]:
+    """Live checkout and overflow counters of the pool of an engine."""
+
+    pool = getattr(target, "sync_engine", target).pool
+    if not isinstance(pool, QueuePool):
+        return {"status": pool.status()}
+
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "timeout": pool.timeout(),
+    }
+
+
+def set_transaction_read_only(
+    session: Session,  # pylint: disable=unused-argument
+    transaction: SessionTransaction,  # pylint: disable=unused-argument
+    connection: Connection,
+) -> None:
+    """Open every transaction of the read-only sessions in READ ONLY mode."""
+
+    connection.exec_driver_sql("SET TRANSACTION READ ONLY")
+
+
+# * the engines and the session makers are built on first use, so importing the
+# * lessons, e.g. from a migration or a worker process, costs no engine.
+@cache
+def get_engine() -> Engine:
+    """Engine of the configured database."""
+
+    return create_engine_from_env(build_database_url())
+
+
+@cache
+def get_session_maker() -> sessionmaker[Session]:
+    """Session maker bound to ``get_engine()``."""
+
+    return sessionmaker(get_engine())
+
+
+@cache
+def get_read_only_session_maker() -> sessionmaker[Session]:
+    """Session maker opening READ ONLY transactions."""
+
+    # * reads don't modify objects, so keep them loaded after the transaction ends.
+    maker = sessionmaker(get_engine(), expire_on_commit=False)
+    event.listen(maker, "after_begin", set_transaction_read_only)
+    return maker
+
+
+@cache
+def get_async_engine() -> AsyncEngine:
+    """asyncpg engine of the configured database."""
+
+    return create_async_engine_from_env(build_database_url("postgresql+asyncpg"))
+
+
+@cache
+def get_async_session_maker() -> async_sessionmaker[AsyncSession]:
+    """Async session maker bound to ``get_async_engine()``."""
+
+    # ! objects can't lazy load attributes in asyncio, so don't expire them on commit.
+    return async_sessionmaker(get_async_engine(), expire_on_commit=False)
+
+
+_LAZY: dict[str, Callable[[], Any]] = {
+    "database_url": build_database_url,
+    "engine": get_engine,
+    "session_maker": get_session_maker,
+    "read_only_session_maker": get_read_only_session_maker,
+    "async_database_url": lambda: build_database_url("postgresql+asyncpg"),
+    "async_engine": get_async_engine,
+    "async_session_maker": get_async_session_maker,
+}
+
+
+def __getattr__(name: str) -> Any:
+    """Build the module-level engines and session makers when first accessed."""
+
+    try:
+        factory = _LAZY[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    return factory()
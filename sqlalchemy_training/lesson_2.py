@@ -5,6 +5,11 @@
 - Use Annotated to refactor codes.
 - Using SQLAlchemy to Create Tables in the Database.
 - Add relationships between tables.
+- Index the foreign keys and the sort keys.
+- Maintain per-user aggregates with triggers.
+- Partition the orders and their lines by month.
+- Maintain the closure of the referral tree with triggers.
+- Checkpoint the progress of the backfills.
 """
 
 from datetime import datetime
@@ -12,11 +17,16 @@ from typing import Annotated, Optional
 
 from sqlalchemy import (
     BIGINT,
+    DDL,
     DECIMAL,
     TIMESTAMP,
     VARCHAR,
     ForeignKey,
+    ForeignKeyConstraint,
+    Index,
     Integer,
+    event,
+    false,
     func,
 )
 from sqlalchemy.orm import (
@@ -34,6 +44,7 @@ user_pk = Annotated[
         ForeignKey("users.telegram_id", ondelete="SET NULL"),
         nullable=True,
         autoincrement=False,
+        index=True,
     ),
 ]
 str_255 = Annotated[str, mapped_column(VARCHAR(255))]
@@ -62,7 +73,7 @@ class TimestampMixin:
         TIMESTAMP,
         nullable=False,
         server_default=func.now(),
-        onupdate=func.now,
+        onupdate=func.now(),
     )
 
 
@@ -73,6 +84,11 @@ class Base(DeclarativeBase):
 class User(TimestampMixin, TableNameMixin, Base):
     """Telegram user."""
 
+    # * users are listed newest first, telegram_id breaking the ties.
+    __table_args__ = (
+        Index("ix_users_created_at_telegram_id", "created_at", "telegram_id"),
+    )
+
     telegram_id: Mapped[int] = mapped_column(
         BIGINT,
         primary_key=True,
@@ -95,28 +111,414 @@ class Product(TimestampMixin, TableNameMixin, Base):
 
 
 class Order(TimestampMixin, TableNameMixin, Base):
-    """Order"""
+    """Order, partitioned by month of creation, see ``partitions``."""
+
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
 
-    order_id: Mapped[int_pk]
+    order_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[user_pk]
+    # * the partition key must be part of the primary key.
+    created_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP,
+        primary_key=True,
+        server_default=func.now(),
+    )
 
     products: Mapped[list["OrderProduct"]] = relationship()
     user: Mapped[User] = relationship(back_populates="orders")
 
 
 class OrderProduct(TableNameMixin, Base):
-    """Intermediary table to link orders and products."""
+    """Intermediary table to link orders and products.
 
-    order_id: Mapped[int] = mapped_column(
-        Integer,
-        ForeignKey("orders.order_id", ondelete="CASCADE"),
-        primary_key=True,
+    The lines are partitioned along with their order, by its month of creation.
+    """
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["order_id", "order_created_at"],
+            ["orders.order_id", "orders.created_at"],
+            ondelete="CASCADE",
+        ),
+        {"postgresql_partition_by": "RANGE (order_created_at)"},
     )
+
+    order_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # * created_at of the order, so that the lines of an order share its month.
+    order_created_at: Mapped[datetime] = mapped_column(TIMESTAMP, primary_key=True)
     product_id: Mapped[int] = mapped_column(
         Integer,
         ForeignKey("products.product_id", ondelete="RESTRICT"),
         primary_key=True,
+        # * the primary key only covers lookups by order_id first.
+        index=True,
     )
     quantity: Mapped[int]
 
     product: Mapped[Product] = relationship()
+
+
+class UserOrderStats(Base):
+    """Orders and ordered units of an user, kept current by triggers."""
+
+    __tablename__ = "user_order_stats"
+
+    user_id: Mapped[int] = mapped_column(
+        BIGINT,
+        ForeignKey("users.telegram_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    orders_count: Mapped[int] = mapped_column(BIGINT, server_default="0")
+    units_count: Mapped[int] = mapped_column(BIGINT, server_default="0")
+
+
+class UserReferral(Base):
+    """Link of an user to each of its referrers, direct or not, kept by triggers.
+
+    Every user is linked to itself at depth 0, its referrer at depth 1, the
+    referrer of its referrer at depth 2 and so on: the referrals of an user, at
+    any depth, are the rows of its ``ancestor_id``.
+    """
+
+    __tablename__ = "user_referrals"
+    # * the primary key serves the subtrees, this index the chains.
+    __table_args__ = (
+        Index("ix_user_referrals_descendant_id_depth", "descendant_id", "depth"),
+    )
+
+    ancestor_id: Mapped[int] = mapped_column(
+        BIGINT,
+        ForeignKey("users.telegram_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    descendant_id: Mapped[int] = mapped_column(
+        BIGINT,
+        ForeignKey("users.telegram_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    depth: Mapped[int]
+
+
+class BackfillCheckpoint(Base):
+    """Progress of a backfill over a range of keys, see ``backfill``."""
+
+    __tablename__ = "backfill_checkpoints"
+
+    name: Mapped[str] = mapped_column(VARCHAR(255), primary_key=True)
+    # * the last key processed, the range being (last_key, end_key].
+    last_key: Mapped[Optional[int]] = mapped_column(BIGINT)
+    end_key: Mapped[Optional[int]] = mapped_column(BIGINT)
+    rows: Mapped[int] = mapped_column(BIGINT, server_default="0")
+    done: Mapped[bool] = mapped_column(server_default=false())
+    updated_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP,
+        server_default=func.now(),
+        onupdate=func.now(),
+    )
+
+
+# * statement triggers see the rows of a statement, COPY included, in transition
+# * tables: a bulk write costs one upsert per user, not one per row.
+# ! an order is subtracted before it is deleted, while its lines still exist, as
+# ! the lines deleted along by the cascade can't be matched to an user anymore.
+# ! the created_at of an order can't change: an order moved to the partition of
+# ! another month is deleted then inserted, subtracted without being added back.
+ORDER_STATS_FUNCTIONS = (
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_orders_inserted() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO user_order_stats (user_id, orders_count, units_count)
+        SELECT user_id, count(*), 0 FROM new_orders
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id ORDER BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET orders_count = user_order_stats.orders_count + excluded.orders_count;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_orders_updated() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE user_order_stats AS stats
+        SET orders_count = stats.orders_count - moved.orders_count,
+            units_count = stats.units_count - moved.units_count
+        FROM (
+            SELECT old_orders.user_id,
+                   count(DISTINCT old_orders.order_id) AS orders_count,
+                   coalesce(sum(lines.quantity), 0) AS units_count
+            FROM old_orders
+            JOIN new_orders USING (order_id)
+            LEFT JOIN orderproducts AS lines
+              ON lines.order_id = new_orders.order_id
+             AND lines.order_created_at = new_orders.created_at
+            WHERE old_orders.user_id IS DISTINCT FROM new_orders.user_id
+            GROUP BY old_orders.user_id
+        ) AS moved
+        WHERE stats.user_id = moved.user_id;
+
+        INSERT INTO user_order_stats (user_id, orders_count, units_count)
+        SELECT new_orders.user_id, count(DISTINCT new_orders.order_id),
+               coalesce(sum(lines.quantity), 0)
+        FROM new_orders
+        JOIN old_orders USING (order_id)
+        LEFT JOIN orderproducts AS lines
+          ON lines.order_id = new_orders.order_id
+         AND lines.order_created_at = new_orders.created_at
+        WHERE new_orders.user_id IS NOT NULL
+          AND old_orders.user_id IS DISTINCT FROM new_orders.user_id
+        GROUP BY new_orders.user_id ORDER BY new_orders.user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET orders_count = user_order_stats.orders_count + excluded.orders_count,
+            units_count = user_order_stats.units_count + excluded.units_count;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_order_deleted() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE user_order_stats
+        SET orders_count = orders_count - 1,
+            units_count = units_count - coalesce(
+                (SELECT sum(quantity) FROM orderproducts
+                 WHERE order_id = OLD.order_id
+                   AND order_created_at = OLD.created_at), 0)
+        WHERE user_id = OLD.user_id;
+        RETURN OLD;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_created_at_changed() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        RAISE EXCEPTION 'the created_at of order % can''t change', OLD.order_id
+            USING ERRCODE = 'check_violation';
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_lines_changed() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO user_order_stats (user_id, orders_count, units_count)
+            SELECT orders.user_id, 0, sum(new_lines.quantity)
+            FROM new_lines
+            JOIN orders
+              ON orders.order_id = new_lines.order_id
+             AND orders.created_at = new_lines.order_created_at
+            WHERE orders.user_id IS NOT NULL
+            GROUP BY orders.user_id ORDER BY orders.user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET units_count = user_order_stats.units_count + excluded.units_count;
+        END IF;
+        IF TG_OP IN ('DELETE', 'UPDATE') THEN
+            UPDATE user_order_stats AS stats
+            SET units_count = stats.units_count - removed.units_count
+            FROM (
+                SELECT orders.user_id, sum(old_lines.quantity) AS units_count
+                FROM old_lines
+                JOIN orders
+                  ON orders.order_id = old_lines.order_id
+                 AND orders.created_at = old_lines.order_created_at
+                GROUP BY orders.user_id
+            ) AS removed
+            WHERE stats.user_id = removed.user_id;
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_order_stats_truncated() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'orders' THEN
+            DELETE FROM user_order_stats;
+        ELSE
+            UPDATE user_order_stats SET units_count = 0 WHERE units_count <> 0;
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+)
+# * function, table, timing and options of each trigger.
+ORDER_STATS_TRIGGERS = (
+    (
+        "user_order_stats_orders_inserted",
+        "orders",
+        "AFTER INSERT",
+        "REFERENCING NEW TABLE AS new_orders FOR EACH STATEMENT",
+    ),
+    (
+        "user_order_stats_orders_updated",
+        "orders",
+        "AFTER UPDATE",
+        "REFERENCING OLD TABLE AS old_orders NEW TABLE AS new_orders "
+        "FOR EACH STATEMENT",
+    ),
+    (
+        "user_order_stats_order_deleted",
+        "orders",
+        "BEFORE DELETE",
+        "FOR EACH ROW WHEN (OLD.user_id IS NOT NULL)",
+    ),
+    (
+        "user_order_stats_created_at_changed",
+        "orders",
+        "BEFORE UPDATE OF created_at",
+        "FOR EACH ROW WHEN (OLD.created_at IS DISTINCT FROM NEW.created_at)",
+    ),
+    ("user_order_stats_truncated", "orders", "AFTER TRUNCATE", "FOR EACH STATEMENT"),
+    (
+        "user_order_stats_lines_changed",
+        "orderproducts",
+        "AFTER INSERT",
+        "REFERENCING NEW TABLE AS new_lines FOR EACH STATEMENT",
+    ),
+    (
+        "user_order_stats_lines_changed",
+        "orderproducts",
+        "AFTER UPDATE",
+        "REFERENCING OLD TABLE AS old_lines NEW TABLE AS new_lines FOR EACH STATEMENT",
+    ),
+    (
+        "user_order_stats_lines_changed",
+        "orderproducts",
+        "AFTER DELETE",
+        "REFERENCING OLD TABLE AS old_lines FOR EACH STATEMENT",
+    ),
+    (
+        "user_order_stats_truncated",
+        "orderproducts",
+        "AFTER TRUNCATE",
+        "FOR EACH STATEMENT",
+    ),
+)
+
+
+def order_stats_ddl() -> list[str]:
+    """Statements (re)creating the functions and the triggers of UserOrderStats."""
+
+    statements = list(ORDER_STATS_FUNCTIONS)
+    for function, table_name, timing, options in ORDER_STATS_TRIGGERS:
+        # * one trigger per event, as transition tables require.
+        event_name = timing.split()[-1].lower()
+        name = f"user_order_stats_{event_name}_{table_name}"
+        statements.append(f"DROP TRIGGER IF EXISTS {name} ON {table_name}")
+        statements.append(
+            f"CREATE TRIGGER {name} {timing} ON {table_name} {options} "
+            f"EXECUTE FUNCTION {function}()"
+        )
+    return statements
+
+
+# * the referrals of a subtree being moved are serialized with the new users by
+# * an advisory lock: the new users are linked to the referrers their referrer
+# * has, which a concurrent move could change meanwhile.
+# ! the referrer of an user can't be one of its referrals, the tree would loop.
+REFERRALS_FUNCTIONS = (
+    """
+    CREATE OR REPLACE FUNCTION user_referrals_users_inserted() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_advisory_xact_lock_shared(hashtext('user_referrals'));
+        -- the referrers inserted by the same statement are walked in new_users,
+        -- the others are linked to their own referrers already.
+        WITH RECURSIVE chain AS (
+            SELECT telegram_id AS ancestor_id, telegram_id AS descendant_id,
+                   0 AS depth, referrer_id AS next_id
+            FROM new_users
+            UNION ALL
+            SELECT new_users.telegram_id, chain.descendant_id, chain.depth + 1,
+                   new_users.referrer_id
+            FROM chain JOIN new_users ON new_users.telegram_id = chain.next_id
+        )
+        INSERT INTO user_referrals (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, descendant_id, depth FROM chain
+        UNION ALL
+        SELECT link.ancestor_id, chain.descendant_id, chain.depth + 1 + link.depth
+        FROM chain JOIN user_referrals AS link ON link.descendant_id = chain.next_id;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION user_referrals_referrer_changed() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtext('user_referrals'));
+        IF EXISTS (
+            SELECT FROM user_referrals
+            WHERE ancestor_id = NEW.telegram_id AND descendant_id = NEW.referrer_id
+        ) THEN
+            RAISE EXCEPTION 'user % can''t be referred by its referral %',
+                NEW.telegram_id, NEW.referrer_id
+                USING ERRCODE = 'check_violation';
+        END IF;
+
+        -- unlink the subtree of the user from the referrers above it...
+        DELETE FROM user_referrals AS link
+        USING user_referrals AS subtree
+        WHERE subtree.ancestor_id = NEW.telegram_id
+          AND link.descendant_id = subtree.descendant_id
+          AND link.ancestor_id NOT IN (
+              SELECT descendant_id FROM user_referrals
+              WHERE ancestor_id = NEW.telegram_id
+          );
+        -- ...and link it to the new ones.
+        INSERT INTO user_referrals (ancestor_id, descendant_id, depth)
+        SELECT above.ancestor_id, subtree.descendant_id,
+               above.depth + 1 + subtree.depth
+        FROM user_referrals AS above
+        JOIN user_referrals AS subtree ON subtree.ancestor_id = NEW.telegram_id
+        WHERE above.descendant_id = NEW.referrer_id;
+        RETURN NULL;
+    END $$
+    """,
+)
+# * name, table and definition of each trigger. The deleted users are unlinked
+# * by the cascade, their referrals by the SET NULL of their referrer_id.
+REFERRALS_TRIGGERS = (
+    (
+        "user_referrals_insert_users",
+        "users",
+        "AFTER INSERT ON users REFERENCING NEW TABLE AS new_users "
+        "FOR EACH STATEMENT EXECUTE FUNCTION user_referrals_users_inserted()",
+    ),
+    (
+        "user_referrals_update_users",
+        "users",
+        "AFTER UPDATE OF referrer_id ON users FOR EACH ROW "
+        "WHEN (OLD.referrer_id IS DISTINCT FROM NEW.referrer_id) "
+        "EXECUTE FUNCTION user_referrals_referrer_changed()",
+    ),
+)
+
+
+def referrals_ddl() -> list[str]:
+    """Statements (re)creating the functions and the triggers of UserReferral."""
+
+    statements = list(REFERRALS_FUNCTIONS)
+    for name, table_name, definition in REFERRALS_TRIGGERS:
+        statements.append(f"DROP TRIGGER IF EXISTS {name} ON {table_name}")
+        statements.append(f"CREATE TRIGGER {name} {definition}")
+    return statements
+
+
+# * create_all() also installs the triggers, drop_all() dropping them along with
+# * the tables.
+for _statement in order_stats_ddl() + referrals_ddl():
+    event.listen(
+        Base.metadata, "after_create", DDL(_statement).execute_if(dialect="postgresql")
+    )
+
+# * the partitions of each month are created by the partitions module, the
+# * default ones keeping the rows of the months without partition.
+for _table in (Order.__table__, OrderProduct.__table__):
+    event.listen(
+        _table,
+        "after_create",
+        DDL("CREATE TABLE %(table)s_default PARTITION OF %(table)s DEFAULT").execute_if(
+            dialect="postgresql"
+        ),
+    )
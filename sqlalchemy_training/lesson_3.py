@@ -8,24 +8,214 @@
 - Advanced select queries with join.
 - Aggregated Queries.
 - Update, delete and bulk insert.
+- Bulk upsert in multi-row batches.
+- Group several calls in a single transaction (unit of work).
+- Read in a read-only transaction without expiring the results.
+- Eager load relationships to avoid N+1 queries.
+- Cache the hot user lookups, invalidated by the writers.
+- Stream large results and paginate users on a key instead of an offset.
+- Project the reads into lightweight DTOs, bypassing the identity map.
+- Select many users in one round trip with ``= ANY(:ids)``.
+- Place an order with all its lines in one statement.
+- Prune the partitions of the orders out of the requested range.
+- Walk the referral tree with recursive CTEs, or read its closure.
 """
 
-from typing import Any, Optional, Sequence
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from itertools import batched
+from typing import Any, Iterable, Iterator, Optional, Self, Sequence
 
-from sqlalchemy import bindparam, create_engine, delete, func, select, update
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import Executable, Select, event, text
 from sqlalchemy.engine.row import Row
-from sqlalchemy.orm import Session, aliased, sessionmaker
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from sqlalchemy_training import queries
+from sqlalchemy_training.cache import (
+    MISSING,
+    CacheBackend,
+    merge_user,
+    user_keys,
+    user_values,
+)
+from sqlalchemy_training.dto import OrderLineDTO, UserDTO
+from sqlalchemy_training.instrumentation import instrumented
+from sqlalchemy_training.lesson_1 import get_session_maker
+from sqlalchemy_training.lesson_2 import Order, Product, User
+from sqlalchemy_training.throughput import measure
+
+
+@instrumented
+class Repo:
+    """Collection of methods to work on the DB.
 
-from sqlalchemy_training.lesson_1 import database_url
-from sqlalchemy_training.lesson_2 import Order, OrderProduct, Product, User
+    With ``autocommit=False`` (or inside ``transaction()``) the methods join the
+    session transaction instead of committing after each statement. Otherwise
+    the writes commit, and the reads end their transaction without a COMMIT,
+    leaving the loaded objects and the pending changes as they were.
 
+    With a ``cache``, ``get_user_by_id`` and ``get_user_lang`` are served from
+    it, and the methods writing users invalidate it once they committed.
 
-class Repo:
-    """Collection of methods to work on the DB."""
+    With ``closure``, the referral trees are read from ``user_referrals``
+    instead of being walked by recursive CTEs.
+    """
 
-    def __init__(self, sess: Session) -> None:
+    def __init__(
+        self,
+        sess: Session,
+        autocommit: bool = True,
+        cache: Optional[CacheBackend] = None,
+        closure: bool = False,
+    ) -> None:
         self.session = sess
+        self.autocommit = autocommit
+        self.cache = cache
+        self.closure = closure
+        self._depth = 0
+        # * users written by the unit of work, not cached until it is committed.
+        self._written: set[int] = set()
+        if cache is not None:
+            event.listen(sess, "after_commit", self._after_commit)
+            event.listen(sess, "after_rollback", self._after_rollback)
+
+    @contextmanager
+    def transaction(self) -> Iterator[Self]:
+        """Run the calls of the block in one transaction, committed at the end."""
+
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            if self._depth == 1:
+                self.session.rollback()
+            raise
+        else:
+            if self._depth == 1:
+                self.session.commit()
+        finally:
+            self._depth -= 1
+
+    @contextmanager
+    def read_only(self) -> Iterator[Self]:
+        """Run the reads of the block in one read-only transaction.
+
+        The transaction is committed once without expiring anything, so the
+        objects returned by the reads stay loaded and need no further query.
+        """
+
+        with self._keep_loaded(), self.transaction():
+            if not self.session.in_transaction():
+                self.session.execute(text("SET TRANSACTION READ ONLY"))
+            yield self
+
+    @contextmanager
+    def _keep_loaded(self) -> Iterator[None]:
+        """Don't expire the loaded objects when the session commits."""
+
+        expire_on_commit = self.session.expire_on_commit
+        self.session.expire_on_commit = False
+        try:
+            yield
+        finally:
+            self.session.expire_on_commit = expire_on_commit
+
+    def _commit(self, expire: bool = True) -> None:
+        """Commit, unless the calls are grouped in a unit of work."""
+
+        if self._in_unit_of_work():
+            return
+        if expire:
+            self.session.commit()
+        else:
+            with self._keep_loaded():
+                self.session.commit()
+
+    @contextmanager
+    def _read(self) -> Iterator[None]:
+        """Run the reads of the block, then end their transaction.
+
+        Out of a unit of work, the pending changes aren't flushed by the reads:
+        their transaction ends without a COMMIT, so they would be lost.
+        """
+
+        if self._in_unit_of_work():
+            yield
+            return
+        with self.session.no_autoflush:
+            yield
+        self._end_read()
+
+    def _end_read(self) -> None:
+        """End the transaction of a read without a COMMIT, unless in a unit of work.
+
+        The transaction is closed rather than rolled back, which would expire
+        the objects of the session and discard its pending changes. Its
+        connection is rolled back on its return to the pool.
+        """
+
+        if self._in_unit_of_work():
+            return
+        if (transaction := self.session.get_transaction()) is not None:
+            transaction.close()
+
+    def _in_unit_of_work(self) -> bool:
+        return not self.autocommit or bool(self._depth)
+
+    def _cacheable(self, telegram_id: int) -> bool:
+        return self.cache is not None and telegram_id not in self._written
+
+    def _after_commit(self, _: Session) -> None:
+        """Forget the users written by the unit of work again, now committed.
+
+        Meanwhile, a concurrent reader may have cached them as they were.
+        """
+
+        if self._written:
+            self.cache.delete(*(key for id_ in self._written for key in user_keys(id_)))
+        self._written.clear()
+
+    def _after_rollback(self, _: Session) -> None:
+        self._written.clear()
+
+    def _invalidate(self, *telegram_ids: int) -> None:
+        """Forget cached users, again once the unit of work is committed if any."""
+
+        if self.cache is None:
+            return
+        if self._in_unit_of_work():
+            self._written.update(telegram_ids)
+        self.cache.delete(*(key for id_ in telegram_ids for key in user_keys(id_)))
+
+    def _stream(
+        self,
+        stmt: Executable,
+        batch_size: int,
+        scalars: bool = False,
+        dto: Optional[type] = None,
+    ) -> Iterator[Any]:
+        """Yield rows fetched ``batch_size`` at a time from a server-side cursor.
+
+        The rows are built into ``dto`` if any. The transaction stays open while
+        they are consumed, and ends once they are exhausted or the iterator is
+        closed.
+        """
+
+        options = {"yield_per": batch_size}
+        execute = self.session.scalars if scalars else self.session.execute
+        no_autoflush = (
+            nullcontext() if self._in_unit_of_work() else self.session.no_autoflush
+        )
+        try:
+            with no_autoflush:
+                result = execute(stmt, execution_options=options)
+            with result:
+                for row in result:
+                    yield row if dto is None else dto(*row)
+        finally:
+            self._end_read()
 
     def add_user(
         self,
@@ -39,89 +229,259 @@ class Repo:
     ) -> User:
         """Add new user to DB."""
 
-        stmt = select(User).from_statement(
-            insert(User)
-            .values(
-                telegram_id=telegram_id,
-                full_name=full_name,
-                language_code=lang,
-                user_name=username,
-                referrer_id=referrer_id,
-            )
-            .on_conflict_do_update(
-                index_elements=[User.telegram_id],
-                set_={
-                    "user_name": username,
-                    "full_name": full_name,
-                },
-            )
-            .returning(User)
-        )
+        stmt = queries.UPSERT_USER
+        params = {
+            "telegram_id": telegram_id,
+            "full_name": full_name,
+            "language_code": lang,
+            "user_name": username,
+            "referrer_id": referrer_id,
+        }
 
-        result = self.session.scalars(stmt)
-        self.session.commit()
+        result = self.session.scalars(stmt, params)
+        self._commit()
+        self._invalidate(telegram_id)
 
         return result.first()
 
+    def add_users_bulk(
+        self,
+        users: Iterable[dict[str, Any]],
+        batch_size: int = 1000,
+        returning: bool = False,
+    ) -> Optional[list[User]]:
+        """Add or update many users, sent to the DB in multi-row batches.
+
+        Each dict takes the keyword arguments of ``add_user``. A referrer must be
+        in the same batch as the users it invited, or in an earlier one. When
+        ``returning`` is set, the upserted users are returned in input order.
+        """
+
+        stmt = queries.bulk_upsert_users()
+        if returning:
+            stmt = stmt.returning(User)
+        upserted: dict[int, User] = {}
+        input_ids: list[int] = []
+
+        with measure("add_users_bulk") as throughput:
+            for batch in batched(users, batch_size):
+                # * ON CONFLICT can't update the same row twice in one statement.
+                rows = {
+                    user["telegram_id"]: {
+                        "telegram_id": user["telegram_id"],
+                        "full_name": user["full_name"],
+                        "language_code": user["lang"],
+                        "user_name": user.get("username"),
+                        "referrer_id": user.get("referrer_id"),
+                    }
+                    for user in batch
+                }
+                execution_options = {"insertmanyvalues_page_size": batch_size}
+
+                if returning:
+                    input_ids.extend(user["telegram_id"] for user in batch)
+                    execution_options["populate_existing"] = True
+                    result = self.session.scalars(
+                        stmt, list(rows.values()), execution_options=execution_options
+                    )
+                    upserted.update((user.telegram_id, user) for user in result)
+                else:
+                    self.session.execute(
+                        stmt, list(rows.values()), execution_options=execution_options
+                    )
+                # * the users returned are loaded, don't expire them.
+                self._commit(expire=not returning)
+                self._invalidate(*rows)
+                throughput.rows += len(rows)
+
+        return (
+            [upserted[telegram_id] for telegram_id in input_ids] if returning else None
+        )
+
     def get_user_by_id(self, telegram_id: int) -> User:
         """Select an user by its ID."""
 
-        stmt = select(User).where(User.telegram_id == telegram_id)
-        result = self.session.execute(stmt)
-        self.session.commit()
+        key, _ = user_keys(telegram_id)
+        if self._cacheable(telegram_id):
+            values = self.cache.get(key)
+            if values is not MISSING:
+                return merge_user(self.session, values)
 
-        return result.scalars().first()
+        stmt = queries.USER_BY_ID
+        with self._read():
+            result = self.session.execute(stmt, {"telegram_id": telegram_id})
+        user = result.scalars().first()
 
-    def get_all_users(self) -> Sequence[User]:
-        """Select all users in DB."""
+        if user is not None and self._cacheable(telegram_id):
+            self.cache.set(key, user_values(user))
+        return user
 
-        stmt = select(
-            User,
-        ).order_by(
-            User.created_at.desc(),
-        )
-        results = self.session.execute(stmt)
-        self.session.commit()
+    def _select_users(self, stmt: Select, dto: bool) -> Sequence[User | UserDTO]:
+        if dto:
+            with self._read():
+                results = self.session.execute(UserDTO.project(stmt))
+            return UserDTO.from_rows(results)
+
+        with self._read():
+            results = self.session.execute(stmt)
 
         return results.scalars().all()
 
-    def get_last_ten_users(self) -> Sequence[User]:
+    def get_all_users(self, dto: bool = False) -> Sequence[User | UserDTO]:
+        """Select all users in DB, as ``UserDTO`` with ``dto``."""
+
+        return self._select_users(queries.all_users(), dto)
+
+    def stream_all_users(
+        self, batch_size: int = 1000, dto: bool = False
+    ) -> Iterator[User | UserDTO]:
+        """Yield all users in DB, newest first, with bounded memory.
+
+        Don't use the Repo until the users are consumed, or the iterator
+        closed: out of a unit of work, its calls would end the stream.
+        """
+
+        if dto:
+            stmt = UserDTO.project(queries.all_users())
+            return self._stream(stmt, batch_size, dto=UserDTO)
+        return self._stream(queries.all_users(), batch_size, scalars=True)
+
+    def get_users_page(
+        self,
+        after: Optional[tuple[datetime, int]] = None,
+        limit: int = 100,
+        dto: bool = False,
+    ) -> Sequence[User | UserDTO]:
+        """Select a page of users, newest first.
+
+        The next page starts after the ``(created_at, telegram_id)`` of the last
+        user of this one.
+        """
+
+        return self._select_users(queries.users_page(after, limit), dto)
+
+    def get_last_ten_users(self, dto: bool = False) -> Sequence[User | UserDTO]:
         """Select last ten users in DB."""
 
-        stmt = (
-            select(
-                User,
+        return self._select_users(queries.last_ten_users(), dto)
+
+    def get_user_lang(self, telegram_id: int) -> Optional[str]:
+        """Select the language of an user by its ID."""
+
+        _, key = user_keys(telegram_id)
+        if self._cacheable(telegram_id):
+            lang = self.cache.get(key)
+            if lang is not MISSING:
+                return lang
+
+        stmt = queries.USER_LANG
+        with self._read():
+            result = self.session.execute(stmt, {"telegram_id": telegram_id})
+        lang = result.scalars().first()
+
+        if lang is not None and self._cacheable(telegram_id):
+            self.cache.set(key, lang)
+        return lang
+
+    def get_users_by_ids(self, telegram_ids: Iterable[int]) -> list[Optional[User]]:
+        """Select many users in one round trip, ``None`` for the missing ones.
+
+        The users are returned in the order of ``telegram_ids``, duplicates
+        included. Only the users missing from the cache are selected.
+        """
+
+        telegram_ids = list(telegram_ids)
+        users: dict[int, User] = {}
+        missing = []
+        for telegram_id in dict.fromkeys(telegram_ids):
+            values = (
+                self.cache.get(user_keys(telegram_id)[0])
+                if self._cacheable(telegram_id)
+                else MISSING
             )
-            .order_by(
-                User.created_at.desc(),
+            if values is MISSING:
+                missing.append(telegram_id)
+            else:
+                users[telegram_id] = merge_user(self.session, values)
+
+        if missing:
+            stmt = queries.USERS_BY_IDS
+            with self._read():
+                result = self.session.scalars(stmt, {"ids": missing})
+            for user in result:
+                users[user.telegram_id] = user
+                if self._cacheable(user.telegram_id):
+                    self.cache.set(user_keys(user.telegram_id)[0], user_values(user))
+
+        return [users.get(telegram_id) for telegram_id in telegram_ids]
+
+    def get_user_langs_by_ids(self, telegram_ids: Iterable[int]) -> list[Optional[str]]:
+        """Select the languages of many users in one round trip."""
+
+        telegram_ids = list(telegram_ids)
+        langs: dict[int, str] = {}
+        missing = []
+        for telegram_id in dict.fromkeys(telegram_ids):
+            lang = (
+                self.cache.get(user_keys(telegram_id)[1])
+                if self._cacheable(telegram_id)
+                else MISSING
             )
-            .limit(10)
-        )
-        results = self.session.execute(stmt)
-        self.session.commit()
-
-        return results.scalars().all()
+            if lang is MISSING:
+                missing.append(telegram_id)
+            else:
+                langs[telegram_id] = lang
+
+        if missing:
+            stmt = queries.USER_LANGS_BY_IDS
+            with self._read():
+                result = self.session.execute(stmt, {"ids": missing})
+            for telegram_id, lang in result.tuples():
+                langs[telegram_id] = lang
+                if self._cacheable(telegram_id):
+                    self.cache.set(user_keys(telegram_id)[1], lang)
+
+        return [langs.get(telegram_id) for telegram_id in telegram_ids]
+
+    def get_users_with_orders(
+        self, loader: queries.Loader = "selectin"
+    ) -> Sequence[User]:
+        """Select all users with their orders and the products of the orders.
+
+        The whole graph is loaded up front, see ``queries.LOADERS`` for the
+        number of statements of each strategy.
+        """
+
+        stmt = queries.users_with_orders(loader)
+        with self._read():
+            users = self.session.scalars(stmt).unique().all()
+
+        return users
+
+    def get_order_with_products(
+        self,
+        order_id: int,
+        loader: queries.Loader = "selectin",
+        created_at: Optional[datetime] = None,
+    ) -> Optional[Order]:
+        """Select an order with its products loaded up front.
 
-    def get_user_lang(self, telegram_id: int) -> str:
-        """Select an user by its ID."""
+        Given the ``created_at`` of the order, only its partition is read.
+        """
 
-        stmt = select(
-            User.language_code,
-        ).where(
-            User.telegram_id == telegram_id,
-        )
-        result = self.session.execute(stmt)
-        self.session.commit()
+        stmt = queries.order_with_products(order_id, loader, created_at)
+        with self._read():
+            orders = self.session.scalars(stmt).unique().all()
 
-        return result.scalars()
+        return orders[0] if orders else None
 
     def add_order(self, user_id: int) -> Order:
         """Add a new order to the DB."""
 
-        stmt = insert(Order).values(user_id=user_id).returning(Order)
+        stmt = queries.INSERT_ORDER
 
-        results = self.session.scalars(stmt)
-        self.session.commit()
+        results = self.session.scalars(stmt, {"user_id": user_id})
+        self._commit()
 
         return results.first()
 
@@ -132,14 +492,10 @@ class Repo:
         description: Optional[str] = None,
     ) -> Product:
         """Add a new product to the DB."""
-        stmt = select(Product).from_statement(
-            insert(Product)
-            .values(title=title, description=description, price=price)
-            .returning(Product)
-        )
+        stmt = queries.insert_product(title, price, description)
 
         results = self.session.scalars(stmt)
-        self.session.commit()
+        self._commit()
 
         return results.first()
 
@@ -149,125 +505,227 @@ class Repo:
         order_id: int,
         quantity: int,
     ) -> None:
-        """Add a new product to the DB."""
-        stmt = (
-            insert(OrderProduct)
-            .values(
-                product_id=product_id,
-                order_id=order_id,
-                quantity=quantity,
+        """Add a product to an order, ``NoResultFound`` if there's no such order."""
+        stmt = queries.INSERT_ORDER_PRODUCT
+
+        result = self.session.execute(
+            stmt, {"product_id": product_id, "order_id": order_id, "quantity": quantity}
+        )
+        if not result.rowcount:
+            self._check_order(order_id)
+        self._commit()
+
+    def place_order(self, user_id: int, lines: Iterable[dict[str, Any]]) -> Order:
+        """Add an order with all its lines in one statement, so one round trip.
+
+        Each line is a dict with a ``product_id`` and a ``quantity``, the
+        quantities of the same product being added up. The order is returned
+        with its ``products`` loaded.
+        """
+
+        quantities: dict[int, int] = {}
+        for item in lines:
+            quantities[item["product_id"]] = (
+                quantities.get(item["product_id"], 0) + item["quantity"]
             )
-            .on_conflict_do_nothing()
+
+        stmt = queries.PLACE_ORDER
+        params = {
+            "user_id": user_id,
+            "product_ids": list(quantities),
+            "quantities": list(quantities.values()),
+        }
+        rows = self.session.execute(stmt, params).all()
+        order = rows[0][0]
+        set_committed_value(
+            order, "products", [line for _, line in rows if line is not None]
         )
+        self._commit(expire=False)
 
-        self.session.execute(stmt)
-        self.session.commit()
+        return order
 
     def select_all_invited_users(self) -> Sequence[Row[tuple[str, str]]]:
         """Get all invited users."""
 
-        ParentUser = aliased(User)
-        ReferralUser = aliased(User)
+        stmt = queries.invited_users()
+
+        with self._read():
+            results = self.session.execute(stmt)
+        return results.all()
+
+    def get_referrals(
+        self, telegram_id: int, max_depth: Optional[int] = None
+    ) -> Sequence[Row[tuple[User, int]]]:
+        """Get the referrals of an user at any depth, or down to ``max_depth``.
+
+        Each comes with its depth, 1 for the users it invited, sorted by depth.
+        """
+
+        stmt = queries.referrals_tree(telegram_id, max_depth, self.closure)
+
+        with self._read():
+            results = self.session.execute(stmt)
+        return results.all()
+
+    def get_referrers(self, telegram_id: int) -> Sequence[Row[tuple[User, int]]]:
+        """Get the referrer of an user, its referrer and so on up to the root."""
 
-        stmt = select(
-            ParentUser.full_name.label("parent_name"),
-            ReferralUser.full_name.label("referrer_name"),
-        ).join(ReferralUser, ReferralUser.referrer_id == ParentUser.telegram_id)
+        stmt = queries.referrers_chain(telegram_id, self.closure)
 
-        results = self.session.execute(stmt)
-        self.session.commit()
+        with self._read():
+            results = self.session.execute(stmt)
         return results.all()
 
+    def get_referrals_stats(self, telegram_id: int) -> Row[tuple[int, int, int]]:
+        """Count the referrals of an user at any depth, their orders and units."""
+
+        stmt = queries.referrals_stats(telegram_id, self.closure)
+
+        with self._read():
+            result = self.session.execute(stmt)
+        return result.one()
+
     def get_all_user_orders(
-        self, telegram_id: int
-    ) -> Sequence[Row[tuple[Order, User]]]:
-        """Get all orders from an user."""
-
-        stmt = (
-            select(
-                Product,
-                Order,
-                User.user_name,
-                OrderProduct.quantity,
-            )
-            .join(OrderProduct)
-            .join(Order)
-            .join(User)
-            .select_from(Product)
-            .where(
-                User.telegram_id == telegram_id,
-            )
-        )
-        results = self.session.execute(stmt)
-        self.session.commit()
+        self,
+        telegram_id: int,
+        dto: bool = False,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> Sequence[Row[tuple[Product, Order, str, int]] | OrderLineDTO]:
+        """Get all orders from an user, as ``OrderLineDTO`` with ``dto``.
+
+        With ``since`` or ``until``, only the orders created in this range are
+        selected, from the partitions of their months.
+        """
+
+        stmt = queries.user_orders(telegram_id, since, until)
+        if dto:
+            with self._read():
+                results = self.session.execute(OrderLineDTO.project(stmt))
+            return OrderLineDTO.from_rows(results)
+
+        with self._read():
+            results = self.session.execute(stmt)
         return results.all()
 
+    def stream_all_user_orders(  # pylint: disable=too-many-arguments
+        self,
+        telegram_id: int,
+        batch_size: int = 1000,
+        dto: bool = False,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> Iterator[Row[tuple[Product, Order, str, int]] | OrderLineDTO]:
+        """Yield all orders from an user with bounded memory.
+
+        Don't use the Repo until the orders are consumed, or the iterator
+        closed: out of a unit of work, its calls would end the stream.
+        """
+
+        stmt = queries.user_orders(telegram_id, since, until)
+        if dto:
+            stmt = OrderLineDTO.project(stmt)
+            return self._stream(stmt, batch_size, dto=OrderLineDTO)
+        return self._stream(stmt, batch_size)
+
     def get_total_of_orders(self, telegram_id: int) -> int:
         """Get total number of orders from an user."""
-        stmt = select(func.count(Order)).where(Order.user_id == telegram_id)
-        result = self.session.scalar(stmt)
-        self.session.commit()
+        stmt = queries.TOTAL_OF_ORDERS
+        with self._read():
+            result = self.session.scalar(stmt, {"telegram_id": telegram_id})
         return result
 
     def get_total_of_orders_per_user(self) -> Sequence[Row[tuple[int, str]]]:
         """Get total number of orders per user."""
-        stmt = (
-            select(func.count(Order), User.full_name)
-            .join(User)
-            .group_by(User.telegram_id)
-        )
-        result = self.session.execute(stmt)
-        self.session.commit()
+        stmt = queries.total_of_orders_per_user()
+        with self._read():
+            result = self.session.execute(stmt)
         return result.all()
 
     def get_total_of_ordered_products_per_user(
         self,
     ) -> Sequence[Row[tuple[int, str]]]:
         """Get total number of ordered  productsper user."""
-        stmt = (
-            select(
-                func.sum(OrderProduct.quantity).label("quantity"),
-                User.full_name,
-            )
-            .join(Order, Order.order_id == OrderProduct.order_id)
-            .join(User)
-            .group_by(User.telegram_id)
-        )
-        result = self.session.execute(stmt)
-        self.session.commit()
+        stmt = queries.total_of_ordered_products_per_user()
+        with self._read():
+            result = self.session.execute(stmt)
         return result.all()
 
+    def stream_total_of_orders_per_user(
+        self, batch_size: int = 1000
+    ) -> Iterator[Row[tuple[int, str]]]:
+        """Yield the total number of orders per user with bounded memory.
+
+        Don't use the Repo until the totals are consumed, or the iterator
+        closed: out of a unit of work, its calls would end the stream.
+        """
+
+        return self._stream(queries.total_of_orders_per_user(), batch_size)
+
+    def stream_total_of_ordered_products_per_user(
+        self, batch_size: int = 1000
+    ) -> Iterator[Row[tuple[int, str]]]:
+        """Yield the total number of ordered products per user with bounded memory.
+
+        Don't use the Repo until the totals are consumed, or the iterator
+        closed: out of a unit of work, its calls would end the stream.
+        """
+
+        return self._stream(queries.total_of_ordered_products_per_user(), batch_size)
+
     def set_new_referrer(self, user_id: int, referrer_id: int) -> None:
-        """Update an user with nre referrer ID."""
-        stmt = (
-            update(User)
-            .where(User.telegram_id == user_id)
-            .values(referrer_id=referrer_id)
-        )
-        self.session.execute(stmt)
-        self.session.commit()
+        """Update an user with nre referrer ID.
+
+        Referring an user by one of its referrals raises an ``IntegrityError``.
+        """
+        stmt = queries.SET_REFERRER
+        self.session.execute(stmt, {"user_id": user_id, "referrer_id": referrer_id})
+        self._commit()
+        self._invalidate(user_id)
 
     def delete_user_by_id(self, user_id: int) -> None:
-        """Delete an user by its ID."""
-        stmt = delete(User).where(User.telegram_id == user_id)
-        self.session.execute(stmt)
-        self.session.commit()
+        """Delete an user by its ID.
+
+        Its orders and referrals are detached in the same statement, see
+        ``purge.delete_user`` for users with many of them.
+        """
+        # * the referrer_id of the referrals is SET NULL along.
+        referrals = []
+        if self.cache is not None:
+            referrals = self.session.scalars(
+                queries.REFERRALS, {"user_id": user_id}
+            ).all()
+
+        stmt = queries.DELETE_USER
+        self.session.execute(stmt, {"user_id": user_id})
+        self._commit()
+        self._invalidate(user_id, *referrals)
 
     def bulk_add_order_products(self, order_id: int, products: list[dict[str, Any]]):
-        """Bulk add products to an order."""
-        stmt = insert(OrderProduct).values(
-            order_id=order_id,
-            product_id=bindparam("product_id"),
-            quantity=bindparam("quantity"),
-        )
-        self.session.execute(stmt, products)
-        self.session.commit()
+        """Bulk add products to an order, in one statement.
+
+        Raises ``NoResultFound`` if there's no such order.
+        """
+        stmt = queries.INSERT_ORDER_PRODUCTS
+        params = {
+            "order_id": order_id,
+            "product_ids": [product["product_id"] for product in products],
+            "quantities": [product["quantity"] for product in products],
+        }
+        result = self.session.execute(stmt, params)
+        if products and not result.rowcount:
+            self._check_order(order_id)
+        self._commit()
+
+    def _check_order(self, order_id: int) -> None:
+        """Raise ``NoResultFound`` if there's no such order."""
+
+        if not self.session.scalar(queries.ORDER_EXISTS, {"order_id": order_id}):
+            raise NoResultFound(f"No order {order_id}")
 
 
 if __name__ == "__main__":
-    engine = create_engine(database_url)
-    session_maker = sessionmaker(engine)
-    with session_maker() as session:
+    with get_session_maker()() as session:
         repo = Repo(session)
         # for row in repo.select_all_invited_users():
         #     print(f"Parent: {row.parent_name}, Referral: {row.referrer_name}")
@@ -281,13 +739,14 @@ if __name__ == "__main__":
         #         for product in order.products:
         #             print(f"    - Product: {product.product.title}")
 
-        user_orders = repo.get_all_user_orders(telegram_id=18)
+        user_orders = repo.get_all_user_orders(telegram_id=18, dto=True)
         # for row in user_orders:
         #     print(
         #         f"Product: {row.Product.title}: Order: {row.Order.order_id}: {row.user_name}"
         #     )
 
-        for product, order, user_name, amount in user_orders:
+        for line in user_orders:
             print(
-                f"Product: {product.title} x {amount}: Order: {order.order_id}: {user_name}"
+                f"Product: {line.title} x {line.quantity}: "
+                f"Order: {line.order_id}: {line.user_name}"
             )
@@ -0,0 +1,157 @@
+"""Coalesce concurrent single-key lookups into batched queries.
+
+The lookups awaited during the same short ``window`` are loaded together by
+one call of the batch function, e.g. ``AsyncRepo.get_users_by_ids``, each key
+once. As a DataLoader, a loader lives for one request, e.g. one Telegram
+update, and remembers the keys it already loaded::
+
+    loader = UserLoader(AsyncRepo(session))
+    users = await asyncio.gather(*(loader.get_user_by_id(id_) for id_ in ids))
+"""
+
+import asyncio
+from collections.abc import Hashable
+from typing import Awaitable, Callable, Generic, Optional, Sequence, TypeVar
+
+from sqlalchemy_training.async_repo import AsyncRepo
+from sqlalchemy_training.lesson_2 import User
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+BatchFunction = Callable[[list[K]], Awaitable[Sequence[V]]]
+
+
+class BatchLoader(Generic[K, V]):  # pylint: disable=too-many-instance-attributes
+    """Load the keys requested within ``window`` seconds with one batch call.
+
+    The batch function returns the values in the order of the keys. A batch is
+    sent early once it holds ``max_batch_size`` keys. With ``cache``, the keys
+    already requested are served by the same future, loaded or not.
+    """
+
+    def __init__(
+        self,
+        batch: BatchFunction[K, V],
+        window: float = 0.002,
+        max_batch_size: int = 1_000,
+        cache: bool = True,
+    ) -> None:
+        self.batch = batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.cache = cache
+        self._futures: dict[K, asyncio.Future[V]] = {}
+        self._pending: dict[K, asyncio.Future[V]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def load(self, key: K) -> asyncio.Future[V]:
+        """Future of the value of a key, loaded with the keys of its window.
+
+        Cancelling it cancels this lookup only, not those of the same key.
+        """
+
+        # * the same key requested twice shares the future of its batch.
+        future = self._futures.get(key) or self._pending.get(key)
+        if future is None or future.cancelled():
+            future = self._add(key)
+        return asyncio.shield(future)
+
+    def _add(self, key: K) -> asyncio.Future[V]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending[key] = future
+        if self.cache:
+            self._futures[key] = future
+
+        if len(self._pending) >= self.max_batch_size:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._dispatch)
+        return future
+
+    async def load_many(self, keys: Sequence[K]) -> list[V]:
+        """Values of several keys, in their order."""
+
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def clear(self, *keys: K) -> None:
+        """Forget the values of keys, e.g. after writing them."""
+
+        for key in keys:
+            self._futures.pop(key, None)
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        pending, self._pending = self._pending, {}
+        if pending:
+            task = asyncio.get_running_loop().create_task(self._run(pending))
+            # * keep a reference, the loop only keeps weak ones.
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, pending: dict[K, asyncio.Future[V]]) -> None:
+        keys = list(pending)
+        try:
+            values = await self.batch(keys)
+            if len(values) != len(keys):
+                raise ValueError(
+                    f"Batch returned {len(values)} values for {len(keys)} keys"
+                )
+        except asyncio.CancelledError:
+            # * the cancelled futures are replaced by the next lookups.
+            for future in pending.values():
+                future.cancel()
+            raise
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            for key, future in pending.items():
+                self._futures.pop(key, None)
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for future, value in zip(pending.values(), values):
+            if not future.done():
+                future.set_result(value)
+
+
+class UserLoader:
+    """Coalesced ``get_user_by_id`` and ``get_user_lang`` of an ``AsyncRepo``.
+
+    The batches run one at a time, since an AsyncSession can't run statements
+    concurrently.
+    """
+
+    def __init__(self, repo: AsyncRepo, window: float = 0.002) -> None:
+        self.repo = repo
+        self._lock = asyncio.Lock()
+        self.users = BatchLoader(self._load_users, window)
+        self.langs = BatchLoader(self._load_langs, window)
+
+    async def _load_users(self, telegram_ids: list[int]) -> list[Optional[User]]:
+        async with self._lock:
+            return await self.repo.get_users_by_ids(telegram_ids)
+
+    async def _load_langs(self, telegram_ids: list[int]) -> list[Optional[str]]:
+        async with self._lock:
+            return await self.repo.get_user_langs_by_ids(telegram_ids)
+
+    async def get_user_by_id(self, telegram_id: int) -> Optional[User]:
+        """Select an user by its ID, along with the concurrent lookups."""
+
+        return await self.users.load(telegram_id)
+
+    async def get_user_lang(self, telegram_id: int) -> Optional[str]:
+        """Select the language of an user, along with the concurrent lookups."""
+
+        return await self.langs.load(telegram_id)
+
+    def clear(self, *telegram_ids: int) -> None:
+        """Forget the loaded users, e.g. after changing them."""
+
+        self.users.clear(*telegram_ids)
+        self.langs.clear(*telegram_ids)
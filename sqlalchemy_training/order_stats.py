@@ -0,0 +1,154 @@
+"""Rebuild and verify the per-user aggregates of ``user_order_stats``.
+
+The triggers declared in ``lesson_2`` keep the aggregates current on every
+write. This module recomputes them from ``orders`` and ``orderproducts`` to
+catch any drift, e.g. after the triggers were disabled for a bulk load.
+
+Usage::
+
+    python -m sqlalchemy_training.order_stats verify
+    python -m sqlalchemy_training.order_stats rebuild
+"""
+
+import argparse
+import logging
+import sys
+from dataclasses import dataclass
+
+from sqlalchemy import Connection, Select, delete, func, insert, or_, select, text
+
+from sqlalchemy_training.lesson_1 import create_engine_from_env
+from sqlalchemy_training.lesson_2 import (
+    Order,
+    OrderProduct,
+    UserOrderStats,
+    order_stats_ddl,
+)
+from sqlalchemy_training.throughput import measure
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Drift:
+    """Aggregates of an user differing from the orders."""
+
+    user_id: int
+    orders_count: int
+    actual_orders_count: int
+    units_count: int
+    actual_units_count: int
+
+
+def actual_stats() -> Select:
+    """Aggregate the orders and the ordered units of each user."""
+
+    units = (
+        select(OrderProduct.order_id, func.sum(OrderProduct.quantity).label("units"))
+        .group_by(OrderProduct.order_id)
+        .subquery()
+    )
+    return (
+        select(
+            Order.user_id,
+            func.count(Order.order_id).label("orders_count"),
+            func.coalesce(func.sum(units.c.units), 0).label("units_count"),
+        )
+        .outerjoin(units, units.c.order_id == Order.order_id)
+        .where(Order.user_id.is_not(None))
+        .group_by(Order.user_id)
+    )
+
+
+def install(connection: Connection) -> None:
+    """(Re)create the functions and the triggers maintaining the aggregates."""
+
+    for statement in order_stats_ddl():
+        connection.exec_driver_sql(statement)
+
+
+def rebuild(connection: Connection) -> int:
+    """Recompute every aggregate, blocking the writes to the orders meanwhile."""
+
+    with measure("rebuild user_order_stats") as throughput:
+        connection.execute(text("LOCK TABLE orders, orderproducts IN SHARE MODE"))
+        connection.execute(delete(UserOrderStats))
+        actual = actual_stats().subquery()
+        result = connection.execute(
+            insert(UserOrderStats).from_select(
+                ["user_id", "orders_count", "units_count"], select(actual)
+            )
+        )
+        throughput.rows = result.rowcount
+
+    return throughput.rows
+
+
+def verify(connection: Connection, limit: int = 100) -> list[Drift]:
+    """Users whose aggregates differ from the orders, at most ``limit`` of them."""
+
+    actual = actual_stats().subquery()
+    # * a missing row counts as zeros, on either side of the full join.
+    orders_count, units_count, actual_orders_count, actual_units_count = (
+        func.coalesce(value, 0)
+        for value in (
+            UserOrderStats.orders_count,
+            UserOrderStats.units_count,
+            actual.c.orders_count,
+            actual.c.units_count,
+        )
+    )
+
+    stmt = (
+        select(
+            func.coalesce(UserOrderStats.user_id, actual.c.user_id),
+            orders_count,
+            actual_orders_count,
+            units_count,
+            actual_units_count,
+        )
+        .join_from(
+            UserOrderStats,
+            actual,
+            UserOrderStats.user_id == actual.c.user_id,
+            full=True,
+        )
+        .where(
+            or_(
+                orders_count != actual_orders_count,
+                units_count != actual_units_count,
+            )
+        )
+        .limit(limit)
+    )
+    return [Drift(*row) for row in connection.execute(stmt)]
+
+
+def main() -> None:
+    """Verify, rebuild or install the aggregates from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["verify", "rebuild", "install"])
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = create_engine_from_env()
+    with engine.begin() as connection:
+        if args.command == "install":
+            install(connection)
+        elif args.command == "rebuild":
+            rebuild(connection)
+        else:
+            drifts = verify(connection, args.limit)
+            for drift in drifts:
+                print(drift)
+            print(f"{len(drifts)} users drifted." if drifts else "No drift.")
+    engine.dispose()
+
+    if args.command == "verify" and drifts:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
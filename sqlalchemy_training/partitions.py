@@ -0,0 +1,288 @@
+"""Monthly range partitions of ``orders`` and ``orderproducts``.
+
+Both tables are partitioned by the month the order was created, the lines
+carrying it in ``order_created_at``, so an order and its lines always live in
+the partitions of the same month. The rows of a month without partitions land
+in the DEFAULT partitions, which should stay empty: the partitions of a month
+can't be created anymore once the default ones hold rows of that month.
+
+- ``ensure`` creates the partitions of the coming months, run it e.g. daily.
+- ``retain`` detaches the partitions of the months older than the retention
+  and drops them: old orders go away without a DELETE of each of their rows.
+
+Usage::
+
+    python -m sqlalchemy_training.partitions ensure --months-ahead 3
+    python -m sqlalchemy_training.partitions retain --keep-months 12
+"""
+
+import argparse
+import logging
+import re
+from datetime import datetime
+from typing import Iterator, Optional
+
+from sqlalchemy import Connection, Engine, text
+
+from sqlalchemy_training.lesson_1 import create_engine_from_env
+
+logger = logging.getLogger(__name__)
+
+# * partitioned tables and their partition key, parents first.
+PARTITIONED = {"orders": "created_at", "orderproducts": "order_created_at"}
+MONTH_SUFFIX = re.compile(r"_(\d{4})_(\d{2})$")
+
+
+def month_start(moment: datetime) -> datetime:
+    """First instant of the month of a moment."""
+
+    return datetime(moment.year, moment.month, 1)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    """First instant of the month ``months`` after the month of ``month``."""
+
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def month_range(start: datetime, end: datetime) -> Iterator[datetime]:
+    """First instants of the months overlapping ``[start, end)``."""
+
+    month = month_start(start)
+    while month < end:
+        yield month
+        month = add_months(month, 1)
+
+
+def partition_name(table_name: str, month: datetime) -> str:
+    """Name of the partition of a table holding the rows of a month."""
+
+    return f"{table_name}_{month:%Y_%m}"
+
+
+def partitions(connection: Connection, table_name: str) -> dict[datetime, str]:
+    """Monthly partitions of a table, by month, the default one excluded."""
+
+    names = connection.scalars(
+        text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = :table_name"
+        ),
+        {"table_name": table_name},
+    )
+    found = {}
+    for name in names:
+        match = MONTH_SUFFIX.search(name)
+        if match:
+            found[datetime(int(match[1]), int(match[2]), 1)] = name
+    return found
+
+
+def _default_has_rows(connection: Connection, table_name: str, month: datetime) -> bool:
+    key = PARTITIONED[table_name]
+    return connection.scalar(
+        text(
+            f'SELECT EXISTS (SELECT FROM "{table_name}_default" '
+            f"WHERE {key} >= :start AND {key} < :end)"
+        ),
+        {"start": month, "end": add_months(month, 1)},
+    )
+
+
+def create_partitions(
+    connection: Connection, start: datetime, end: datetime
+) -> list[str]:
+    """Create the missing partitions of the months overlapping ``[start, end)``.
+
+    The months whose rows are already in the default partitions are skipped
+    with a warning.
+    """
+
+    existing = {name: partitions(connection, name) for name in PARTITIONED}
+    created = []
+    for month in month_range(start, end):
+        for table_name in PARTITIONED:
+            if month in existing[table_name]:
+                continue
+            if _default_has_rows(connection, table_name, month):
+                logger.warning(
+                    "%s_default holds rows of %s, no partition created",
+                    table_name,
+                    f"{month:%Y-%m}",
+                )
+                continue
+
+            name = partition_name(table_name, month)
+            connection.exec_driver_sql(
+                f'CREATE TABLE "{name}" PARTITION OF "{table_name}" '
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') "
+                f"TO ('{add_months(month, 1):%Y-%m-%d}')"
+            )
+            created.append(name)
+            logger.info("Created partition %s", name)
+
+    return created
+
+
+def ensure(
+    connection: Connection, months_ahead: int = 3, now: Optional[datetime] = None
+) -> list[str]:
+    """Create the partitions of the current month and of the ``months_ahead`` next."""
+
+    start = month_start(now or datetime.now())
+    return create_partitions(connection, start, add_months(start, months_ahead + 1))
+
+
+def _forget_stats(
+    connection: Connection, orders: Optional[str], lines: Optional[str]
+) -> None:
+    """Subtract the orders and lines of detached partitions from the aggregates.
+
+    Detached rows aren't deleted, so the triggers of ``user_order_stats``
+    don't see them go.
+    """
+
+    if orders is None:
+        return
+    units = (
+        f'(SELECT order_id, sum(quantity) AS units FROM "{lines}" GROUP BY order_id)'
+        if lines is not None
+        else "(SELECT NULL::integer AS order_id, 0 AS units)"
+    )
+    connection.exec_driver_sql(
+        f"""
+        UPDATE user_order_stats AS stats
+        SET orders_count = stats.orders_count - gone.orders_count,
+            units_count = stats.units_count - gone.units_count
+        FROM (
+            SELECT orders.user_id, count(*) AS orders_count,
+                   coalesce(sum(lines.units), 0) AS units_count
+            FROM "{orders}" AS orders
+            LEFT JOIN {units} AS lines USING (order_id)
+            WHERE orders.user_id IS NOT NULL
+            GROUP BY orders.user_id
+        ) AS gone
+        WHERE stats.user_id = gone.user_id
+        """
+    )
+
+
+def _drop_foreign_keys(
+    connection: Connection, table_name: str, referenced: str
+) -> None:
+    """Drop the foreign keys of a table referencing another one."""
+
+    names = connection.scalars(
+        text(
+            "SELECT conname FROM pg_constraint "
+            "WHERE contype = 'f' AND conrelid = CAST(:table_name AS regclass) "
+            "AND confrelid = CAST(:referenced AS regclass)"
+        ),
+        {"table_name": f'"{table_name}"', "referenced": f'"{referenced}"'},
+    ).all()
+    for name in names:
+        connection.exec_driver_sql(
+            f'ALTER TABLE "{table_name}" DROP CONSTRAINT "{name}"'
+        )
+
+
+def retain_month(
+    connection: Connection,
+    orders: Optional[str],
+    lines: Optional[str],
+    drop: bool = True,
+) -> list[str]:
+    """Detach the partitions of the orders and of the lines of one month.
+
+    They are dropped, unless ``drop`` is false to archive them as plain tables,
+    the archived lines losing their foreign key to the orders.
+    ``DETACH PARTITION`` locks out the readers and writers of the parent
+    tables until the transaction ends, so commit right after.
+    """
+
+    # * the aggregates are read from the lines, before they are locked out.
+    _forget_stats(connection, orders, lines)
+
+    detached = []
+    # * lines first, the orders they reference can't be detached before.
+    if lines is not None:
+        connection.exec_driver_sql(
+            f'ALTER TABLE "orderproducts" DETACH PARTITION "{lines}"'
+        )
+        detached.append(lines)
+        # ! the detached lines keep their own foreign key to the orders,
+        # ! which would forbid detaching the partition of the orders.
+        if drop:
+            connection.exec_driver_sql(f'DROP TABLE "{lines}"')
+        else:
+            _drop_foreign_keys(connection, lines, "orders")
+    if orders is not None:
+        connection.exec_driver_sql(f'ALTER TABLE "orders" DETACH PARTITION "{orders}"')
+        detached.append(orders)
+        if drop:
+            connection.exec_driver_sql(f'DROP TABLE "{orders}"')
+    return detached
+
+
+def retain(
+    engine: Engine,
+    keep_months: int,
+    now: Optional[datetime] = None,
+    drop: bool = True,
+) -> list[str]:
+    """Detach the partitions of the months older than ``keep_months``.
+
+    Each month is detached by ``retain_month`` in its own transaction, so the
+    parent tables are locked out for one month at a time.
+    """
+
+    cutoff = add_months(month_start(now or datetime.now()), -keep_months)
+    with engine.connect() as connection:
+        found = {name: partitions(connection, name) for name in PARTITIONED}
+    expired = sorted(
+        {month for by_month in found.values() for month in by_month if month < cutoff}
+    )
+
+    detached = []
+    for month in expired:
+        with engine.begin() as connection:
+            detached += retain_month(
+                connection,
+                found["orders"].get(month),
+                found["orderproducts"].get(month),
+                drop,
+            )
+        logger.info("%s partitions of %s", "Dropped" if drop else "Detached", month)
+
+    return detached
+
+
+def main() -> None:
+    """Create or retain the partitions from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["ensure", "retain"])
+    parser.add_argument("--months-ahead", type=int, default=3)
+    parser.add_argument("--keep-months", type=int, default=12)
+    parser.add_argument(
+        "--detach-only", action="store_true", help="keep the detached tables"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = create_engine_from_env()
+    if args.command == "ensure":
+        with engine.begin() as connection:
+            names = ensure(connection, args.months_ahead)
+    else:
+        names = retain(engine, args.keep_months, drop=not args.detach_only)
+    engine.dispose()
+
+    print("\n".join(names) if names else "Nothing to do.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""Delete many rows without holding locks for minutes.
+
+One ``DELETE`` over many rows locks them all until it commits, cascades in the
+same statement, and loses its work on any failure. Here the rows go
+``batch_size`` keys at a time, in key order, each batch committed under
+``lock_timeout`` and ``statement_timeout``: an interrupted purge is simply run
+again, the rows already deleted being gone.
+
+- ``truncate`` empties the tables at once, for full resets.
+- ``purge_orders`` drops the partitions of the months older than the
+  retention, then deletes the older orders left in batches, their lines
+  cascading along.
+- ``delete_user`` detaches the orders and the referrals of an user in batches,
+  then deletes it.
+
+Usage::
+
+    python -m sqlalchemy_training.purge truncate
+    python -m sqlalchemy_training.purge orders --keep-months 12
+    python -m sqlalchemy_training.purge user 42 --rows-per-second 5000
+"""
+
+# ! Batching mirrors the settings of backfill.Backfill on purpose.
+# pylint: disable=duplicate-code
+
+import argparse
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from functools import partial
+from typing import Any, Callable, Iterable, Optional
+
+from sqlalchemy import (
+    ColumnElement,
+    Connection,
+    Engine,
+    Executable,
+    Select,
+    delete,
+    func,
+    select,
+    text,
+    true,
+    update,
+)
+
+from sqlalchemy_training.backfill import commit_batch
+from sqlalchemy_training.lesson_1 import create_engine_from_env
+from sqlalchemy_training.lesson_2 import Order, User
+from sqlalchemy_training.partitions import (
+    PARTITIONED,
+    add_months,
+    month_start,
+    partitions,
+    retain,
+)
+from sqlalchemy_training.throughput import Pace, Throughput, measure
+
+logger = logging.getLogger(__name__)
+
+# * the tables emptied by a reset, those referencing them follow by CASCADE.
+RESET_TABLES = ("orderproducts", "orders", "products", "users")
+
+ESTIMATED_ROWS = text(
+    "SELECT coalesce(sum(n_live_tup), 0) FROM pg_stat_user_tables "
+    "WHERE relid IN (SELECT relid FROM pg_partition_tree(CAST(:name AS regclass)))"
+)
+
+
+@dataclass(frozen=True)
+class Batching:
+    """How a purge splits its work, the timeouts being in milliseconds."""
+
+    batch_size: int = 1_000
+    rows_per_second: Optional[float] = None
+    lock_timeout: Optional[int] = 1_000
+    statement_timeout: Optional[int] = 60_000
+    retries: int = 5
+
+
+def estimated_rows(connection: Connection, table_name: str) -> int:
+    """Rows of a table and of its partitions, as last counted by the statistics."""
+
+    return connection.scalar(ESTIMATED_ROWS, {"name": table_name})
+
+
+def truncate(
+    connection: Connection, tables: Iterable[str] = RESET_TABLES
+) -> Throughput:
+    """Empty the tables and those referencing them, restarting their sequences.
+
+    ``TRUNCATE`` removes the files of the tables instead of deleting each row,
+    but locks them out entirely meanwhile, and fires no delete trigger. The
+    rows reported are estimates.
+    """
+
+    tables = list(tables)
+    with measure(f"truncate {', '.join(tables)}") as throughput:
+        throughput.rows = sum(estimated_rows(connection, name) for name in tables)
+        names = ", ".join(f'"{name}"' for name in tables)
+        connection.exec_driver_sql(f"TRUNCATE {names} RESTART IDENTITY CASCADE")
+    return throughput
+
+
+def _next_batch(
+    connection: Connection,
+    keys: Select,
+    statement: Callable[[ColumnElement[bool]], Executable],
+    after: Any,
+) -> tuple[Any, int]:
+    """Apply the statement to the next keys after ``after``, and the last of them."""
+
+    key = keys.selected_columns[0]
+    if after is not None:
+        keys = keys.where(key > after)
+    batch = keys.subquery()
+    last = connection.scalar(select(func.max(batch.c[0])))
+    if last is None:
+        return None, 0
+
+    in_batch = key <= last if after is None else (key > after) & (key <= last)
+    return last, connection.execute(statement(in_batch)).rowcount
+
+
+def in_batches(
+    engine: Engine,
+    keys: Select,
+    statement: Callable[[ColumnElement[bool]], Executable],
+    label: str,
+    batching: Batching = Batching(),
+) -> Throughput:
+    """Apply a statement to the keys selected, one committed batch at a time.
+
+    ``keys`` selects the keys of the rows to process, ``statement`` builds the
+    statement processing them from a condition on the keys of a batch.
+    """
+
+    keys = keys.order_by(keys.selected_columns[0]).limit(batching.batch_size)
+    pace = Pace(label, batching.rows_per_second)
+    with measure(label) as throughput, engine.connect() as connection:
+        after = None
+        while True:
+            after, rows = commit_batch(
+                connection,
+                partial(_next_batch, connection, keys, statement, after),
+                label,
+                lock_timeout=batching.lock_timeout,
+                statement_timeout=batching.statement_timeout,
+                retries=batching.retries,
+            )
+            if after is None:
+                break
+            throughput.rows += rows
+            pace(throughput)
+
+    return throughput
+
+
+def delete_in_batches(
+    engine: Engine,
+    key: Any,
+    where: ColumnElement[bool] = true(),
+    batching: Batching = Batching(),
+) -> Throughput:
+    """Delete the rows matching ``where`` in batches of keys, ``key`` first.
+
+    The rows referencing them cascade or are set null in the same batch.
+    """
+
+    table = key.table
+    return in_batches(
+        engine,
+        select(key).where(where),
+        lambda in_batch: delete(table).where(where, in_batch),
+        f"delete from {table.name}",
+        batching,
+    )
+
+
+def update_in_batches(
+    engine: Engine,
+    key: Any,
+    values: dict[str, Any],
+    where: ColumnElement[bool] = true(),
+    batching: Batching = Batching(),
+) -> Throughput:
+    """Update the rows matching ``where`` with ``values``, in batches of keys."""
+
+    table = key.table
+    return in_batches(
+        engine,
+        select(key).where(where),
+        lambda in_batch: update(table).where(where, in_batch).values(values),
+        f"update {table.name}",
+        batching,
+    )
+
+
+def purge_orders(
+    engine: Engine,
+    keep_months: int,
+    now: Optional[datetime] = None,
+    drop: bool = True,
+    batching: Batching = Batching(),
+) -> Throughput:
+    """Remove the orders of the months older than ``keep_months``, and their lines.
+
+    The partitions of these months go with ``partitions.retain``, one month
+    per transaction, the rows reported for them being estimates. The older
+    orders left, e.g. in the default partition, are deleted in batches.
+    """
+
+    cutoff = add_months(month_start(now or datetime.now()), -keep_months)
+    with measure("purge orders") as throughput:
+        with engine.connect() as connection:
+            for table_name in PARTITIONED:
+                throughput.rows += sum(
+                    estimated_rows(connection, name)
+                    for month, name in partitions(connection, table_name).items()
+                    if month < cutoff
+                )
+        retain(engine, keep_months, now, drop)
+
+        throughput.rows += delete_in_batches(
+            engine, Order.order_id, Order.created_at < cutoff, batching
+        ).rows
+
+    return throughput
+
+
+def delete_user(
+    engine: Engine, telegram_id: int, batching: Batching = Batching()
+) -> Throughput:
+    """Delete an user, detaching its orders and its referrals in batches first.
+
+    Same outcome as ``Repo.delete_user_by_id``, whose ``DELETE`` sets null the
+    ``user_id`` of all the orders of the user and the ``referrer_id`` of all
+    its referrals in one statement.
+    """
+
+    with measure(f"delete user {telegram_id}") as throughput:
+        throughput.rows += update_in_batches(
+            engine,
+            Order.order_id,
+            {"user_id": None},
+            Order.user_id == telegram_id,
+            batching,
+        ).rows
+        throughput.rows += update_in_batches(
+            engine,
+            User.telegram_id,
+            {"referrer_id": None},
+            User.referrer_id == telegram_id,
+            batching,
+        ).rows
+        throughput.rows += delete_in_batches(
+            engine, User.telegram_id, User.telegram_id == telegram_id, batching
+        ).rows
+
+    return throughput
+
+
+def main() -> None:
+    """Truncate the tables, purge the old orders or delete an user."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("truncate", help="empty all the tables")
+    orders = subparsers.add_parser("orders", help="remove the old orders")
+    orders.add_argument("--keep-months", type=int, default=12)
+    orders.add_argument(
+        "--detach-only", action="store_true", help="keep the detached partitions"
+    )
+    user = subparsers.add_parser("user", help="delete an user")
+    user.add_argument("telegram_id", type=int)
+    for subparser in (orders, user):
+        subparser.add_argument("--batch-size", type=int, default=1_000)
+        subparser.add_argument("--rows-per-second", type=float)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = create_engine_from_env()
+    if args.command == "truncate":
+        with engine.begin() as connection:
+            throughput = truncate(connection)
+    else:
+        batching = Batching(args.batch_size, args.rows_per_second)
+        if args.command == "orders":
+            throughput = purge_orders(
+                engine, args.keep_months, drop=not args.detach_only, batching=batching
+            )
+        else:
+            throughput = delete_user(engine, args.telegram_id, batching)
+    engine.dispose()
+
+    print(throughput)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+"""Statements shared by the synchronous and the async repositories.
+
+The statements of the hot paths are built once, at import, with named
+parameters given at execution. They skip the construction of a new statement
+and the computation of its cache key on each call; the cache key is still
+looked up in the compiled cache, whose hit rate ``QueryStats`` reports.
+"""
+
+from datetime import datetime
+from typing import Callable, Literal, Optional
+
+from sqlalchemy import (
+    ARRAY,
+    BigInteger,
+    Integer,
+    Select,
+    any_,
+    bindparam,
+    delete,
+    exists,
+    func,
+    literal_column,
+    select,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects.postgresql import Insert, insert
+from sqlalchemy.orm import aliased, joinedload, selectinload, subqueryload
+from sqlalchemy.orm.strategy_options import _AbstractLoad
+from sqlalchemy.sql.selectable import CTE, TypedReturnsRows
+
+from sqlalchemy_training.lesson_2 import (
+    Order,
+    OrderProduct,
+    Product,
+    User,
+    UserOrderStats,
+    UserReferral,
+)
+
+Loader = Literal["selectin", "joined", "subquery"]
+
+# * statements issued for each relationship level, whatever the number of rows:
+# * - selectin: one SELECT ... WHERE id IN (...) per 500 parents.
+# * - joined: none, the level is LEFT OUTER JOINed to the main statement.
+# * - subquery: one SELECT re-running the parent query as a subquery.
+LOADERS: dict[str, Callable[..., _AbstractLoad]] = {
+    "selectin": selectinload,
+    "joined": joinedload,
+    "subquery": subqueryload,
+}
+
+
+def bulk_upsert_users() -> Insert:
+    """Insert many users, updating the names of the existing ones."""
+
+    stmt = insert(User)
+    return stmt.on_conflict_do_update(
+        index_elements=[User.telegram_id],
+        set_={
+            "user_name": stmt.excluded.user_name,
+            "full_name": stmt.excluded.full_name,
+        },
+    )
+
+
+# * hot paths, see the docstring of the module.
+
+# * telegram_id, full_name, language_code, user_name and referrer_id.
+UPSERT_USER = select(User).from_statement(
+    bulk_upsert_users()
+    .values(
+        telegram_id=bindparam("telegram_id"),
+        full_name=bindparam("full_name"),
+        language_code=bindparam("language_code"),
+        user_name=bindparam("user_name"),
+        referrer_id=bindparam("referrer_id"),
+    )
+    .returning(User)
+)
+USER_BY_ID = select(User).where(User.telegram_id == bindparam("telegram_id"))
+USER_LANG = select(User.language_code).where(
+    User.telegram_id == bindparam("telegram_id")
+)
+# * one statement whatever the number of IDs, unlike IN (...), and typed for asyncpg.
+USERS_BY_IDS = select(User).where(
+    User.telegram_id == any_(bindparam("ids", type_=ARRAY(BigInteger)))
+)
+USER_LANGS_BY_IDS = select(User.telegram_id, User.language_code).where(
+    User.telegram_id == any_(bindparam("ids", type_=ARRAY(BigInteger)))
+)
+INSERT_ORDER = insert(Order).values(user_id=bindparam("user_id")).returning(Order)
+# * ignores the products already in the order. The lines take the created_at
+# * of their order, looked up by the primary key index of each partition.
+INSERT_ORDER_PRODUCT = (
+    insert(OrderProduct)
+    .from_select(
+        ["order_id", "order_created_at", "product_id", "quantity"],
+        select(
+            Order.order_id,
+            Order.created_at,
+            bindparam("product_id", type_=Integer),
+            bindparam("quantity", type_=Integer),
+        ).where(Order.order_id == bindparam("order_id")),
+    )
+    .on_conflict_do_nothing()
+)
+
+
+def _order_lines() -> Insert:
+    """Insert many lines into an order, given as arrays, in one statement."""
+
+    line = (
+        func.unnest(
+            bindparam("product_ids", type_=ARRAY(Integer)),
+            bindparam("quantities", type_=ARRAY(Integer)),
+        )
+        .table_valued("product_id", "quantity")
+        .render_derived(name="line")
+    )
+    return insert(OrderProduct).from_select(
+        ["order_id", "order_created_at", "product_id", "quantity"],
+        select(
+            Order.order_id, Order.created_at, line.c.product_id, line.c.quantity
+        ).where(Order.order_id == bindparam("order_id")),
+    )
+
+
+# * order_id, product_ids and quantities.
+INSERT_ORDER_PRODUCTS = _order_lines()
+# * the inserts of lines add none to a missing order, instead of failing.
+ORDER_EXISTS = select(exists().where(Order.order_id == bindparam("order_id")))
+
+
+def _place_order() -> Select:
+    """Insert an order and its lines in one statement, returning both.
+
+    The lines are given as two arrays, ``product_ids`` and ``quantities``,
+    unnested into rows inserted with the ID of the new order.
+    """
+
+    new_order = insert(Order).values(user_id=bindparam("user_id")).returning(Order)
+    new_order = new_order.cte("new_order")
+    line = (
+        func.unnest(
+            bindparam("product_ids", type_=ARRAY(Integer)),
+            bindparam("quantities", type_=ARRAY(Integer)),
+        )
+        .table_valued("product_id", "quantity")
+        .render_derived(name="line")
+    )
+    new_lines = (
+        insert(OrderProduct)
+        .from_select(
+            ["order_id", "order_created_at", "product_id", "quantity"],
+            select(
+                new_order.c.order_id,
+                new_order.c.created_at,
+                line.c.product_id,
+                line.c.quantity,
+            ),
+        )
+        .returning(OrderProduct)
+        .cte("new_lines")
+    )
+
+    NewOrder = aliased(Order, new_order)
+    NewLine = aliased(OrderProduct, new_lines)
+    return select(NewOrder, NewLine).outerjoin(
+        NewLine,
+        (NewLine.order_id == NewOrder.order_id)
+        & (NewLine.order_created_at == NewOrder.created_at),
+    )
+
+
+# * user_id, product_ids and quantities.
+PLACE_ORDER = _place_order()
+# * from the maintained aggregates.
+TOTAL_OF_ORDERS = select(
+    func.coalesce(
+        select(UserOrderStats.orders_count)
+        .where(UserOrderStats.user_id == bindparam("telegram_id"))
+        .scalar_subquery(),
+        0,
+    )
+)
+SET_REFERRER = (
+    update(User)
+    .where(User.telegram_id == bindparam("user_id"))
+    .values(referrer_id=bindparam("referrer_id"))
+)
+REFERRALS = select(User.telegram_id).where(User.referrer_id == bindparam("user_id"))
+DELETE_USER = delete(User).where(User.telegram_id == bindparam("user_id"))
+
+
+def all_users() -> Select:
+    """Select all users, newest first."""
+
+    return select(
+        User,
+    ).order_by(
+        User.created_at.desc(),
+    )
+
+
+def last_ten_users() -> Select:
+    """Select the last ten users."""
+
+    return all_users().limit(10)
+
+
+def users_page(after: Optional[tuple[datetime, int]], limit: int) -> Select:
+    """Select the users following the ``(created_at, telegram_id)`` key ``after``.
+
+    The page seeks on the key instead of skipping rows with OFFSET, so every
+    page costs the same. ``telegram_id`` breaks the ties of ``created_at``.
+    """
+
+    stmt = (
+        select(User)
+        .order_by(User.created_at.desc(), User.telegram_id.desc())
+        .limit(limit)
+    )
+    if after is not None:
+        stmt = stmt.where(tuple_(User.created_at, User.telegram_id) < tuple_(*after))
+    return stmt
+
+
+def users_with_orders(loader: Loader = "selectin") -> Select:
+    """Select all users with their orders, order lines and products."""
+
+    load = LOADERS[loader]
+    return all_users().options(
+        load(User.orders).options(
+            load(Order.products).options(load(OrderProduct.product))
+        )
+    )
+
+
+def order_with_products(
+    order_id: int,
+    loader: Loader = "selectin",
+    created_at: Optional[datetime] = None,
+) -> Select:
+    """Select an order with its lines and their products.
+
+    With its ``created_at``, only the partition of the order is read.
+    """
+
+    load = LOADERS[loader]
+    stmt = (
+        select(Order)
+        .where(Order.order_id == order_id)
+        .options(load(Order.products).options(load(OrderProduct.product)))
+    )
+    if created_at is not None:
+        stmt = stmt.where(Order.created_at == created_at)
+    return stmt
+
+
+def created_between(
+    stmt: Select, since: Optional[datetime], until: Optional[datetime]
+) -> Select:
+    """Restrict a statement on orders and lines to the orders created in a range.
+
+    Both partition keys are filtered, so that the partitions of the orders and
+    of the lines out of ``[since, until)`` are pruned.
+    """
+
+    if since is not None:
+        stmt = stmt.where(
+            Order.created_at >= since, OrderProduct.order_created_at >= since
+        )
+    if until is not None:
+        stmt = stmt.where(
+            Order.created_at < until, OrderProduct.order_created_at < until
+        )
+    return stmt
+
+
+def insert_product(
+    title: str,
+    price: int,
+    description: Optional[str] = None,
+) -> TypedReturnsRows:
+    """Insert a product."""
+
+    return select(Product).from_statement(
+        insert(Product)
+        .values(title=title, description=description, price=price)
+        .returning(Product)
+    )
+
+
+def invited_users() -> Select:
+    """Select the names of referrers and their referrals."""
+
+    ParentUser = aliased(User)
+    ReferralUser = aliased(User)
+
+    return select(
+        ParentUser.full_name.label("parent_name"),
+        ReferralUser.full_name.label("referrer_name"),
+    ).join(ReferralUser, ReferralUser.referrer_id == ParentUser.telegram_id)
+
+
+def _referrals_tree(telegram_id: int, max_depth: Optional[int]) -> CTE:
+    """Walk the referrals of an user down, level by level."""
+
+    tree = (
+        select(User.telegram_id, literal_column("1", Integer).label("depth"))
+        .where(User.referrer_id == telegram_id)
+        .cte("referrals_tree", recursive=True)
+    )
+    referral = aliased(User)
+    step = select(referral.telegram_id, tree.c.depth + 1).where(
+        referral.referrer_id == tree.c.telegram_id
+    )
+    if max_depth is not None:
+        step = step.where(tree.c.depth < max_depth)
+    return tree.union_all(step)
+
+
+def referrals_tree(
+    telegram_id: int, max_depth: Optional[int] = None, closure: bool = False
+) -> Select:
+    """Select the referrals of an user at any depth, or down to ``max_depth``.
+
+    With ``closure``, they are read from ``user_referrals`` instead of being
+    walked by a recursive CTE. ``max_depth`` is at least 1, the users invited.
+    """
+
+    if max_depth is not None and max_depth < 1:
+        raise ValueError(f"max_depth must be at least 1, not {max_depth}")
+    if closure:
+        stmt = (
+            select(User, UserReferral.depth)
+            .join(UserReferral, UserReferral.descendant_id == User.telegram_id)
+            .where(UserReferral.ancestor_id == telegram_id, UserReferral.depth > 0)
+        )
+        if max_depth is not None:
+            stmt = stmt.where(UserReferral.depth <= max_depth)
+        return stmt.order_by(UserReferral.depth, User.telegram_id)
+
+    tree = _referrals_tree(telegram_id, max_depth)
+    return (
+        select(User, tree.c.depth)
+        .join(tree, tree.c.telegram_id == User.telegram_id)
+        .order_by(tree.c.depth, User.telegram_id)
+    )
+
+
+def referrers_chain(telegram_id: int, closure: bool = False) -> Select:
+    """Select the referrer of an user, its referrer and so on up to the root."""
+
+    if closure:
+        return (
+            select(User, UserReferral.depth)
+            .join(UserReferral, UserReferral.ancestor_id == User.telegram_id)
+            .where(UserReferral.descendant_id == telegram_id, UserReferral.depth > 0)
+            .order_by(UserReferral.depth)
+        )
+
+    chain = (
+        select(
+            User.referrer_id.label("telegram_id"),
+            literal_column("1", Integer).label("depth"),
+        )
+        .where(User.telegram_id == telegram_id, User.referrer_id.is_not(None))
+        .cte("referrers_chain", recursive=True)
+    )
+    referrer = aliased(User)
+    chain = chain.union_all(
+        select(referrer.referrer_id, chain.c.depth + 1).where(
+            referrer.telegram_id == chain.c.telegram_id,
+            referrer.referrer_id.is_not(None),
+        )
+    )
+    return (
+        select(User, chain.c.depth)
+        .join(chain, chain.c.telegram_id == User.telegram_id)
+        .order_by(chain.c.depth)
+    )
+
+
+def referrals_stats(telegram_id: int, closure: bool = False) -> Select:
+    """Count the referrals of an user at any depth, their orders and units.
+
+    With ``closure``, it is one range of the primary key of ``user_referrals``
+    joined to the maintained aggregates.
+    """
+
+    if closure:
+        referrals = (
+            select(UserReferral.descendant_id.label("telegram_id"))
+            .where(UserReferral.ancestor_id == telegram_id, UserReferral.depth > 0)
+            .subquery()
+        )
+    else:
+        referrals = _referrals_tree(telegram_id, None)
+
+    return select(
+        func.count().label("users_count"),
+        func.coalesce(func.sum(UserOrderStats.orders_count), 0).label("orders_count"),
+        func.coalesce(func.sum(UserOrderStats.units_count), 0).label("units_count"),
+    ).select_from(
+        referrals.outerjoin(
+            UserOrderStats, UserOrderStats.user_id == referrals.c.telegram_id
+        )
+    )
+
+
+def user_orders(
+    telegram_id: int,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+) -> Select:
+    """Select the ordered products of an user, of the orders created in a range."""
+
+    stmt = (
+        select(
+            Product,
+            Order,
+            User.user_name,
+            OrderProduct.quantity,
+        )
+        .join(OrderProduct)
+        .join(Order)
+        .join(User)
+        .select_from(Product)
+        .where(
+            User.telegram_id == telegram_id,
+        )
+    )
+    return created_between(stmt, since, until)
+
+
+def order_lines(
+    since: Optional[datetime] = None, until: Optional[datetime] = None
+) -> Select:
+    """Select the ordered products of every user, of the orders created in a range."""
+
+    stmt = (
+        select(
+            Order.order_id,
+            Order.created_at,
+            Order.user_id,
+            User.user_name,
+            Product.product_id,
+            Product.title,
+            Product.price,
+            OrderProduct.quantity,
+        )
+        .select_from(Order)
+        .join(Order.products)
+        .join(OrderProduct.product)
+        .outerjoin(Order.user)
+    )
+    return created_between(stmt, since, until)
+
+
+def users_order_stats() -> Select:
+    """Select the maintained aggregates of every user along with its names."""
+
+    return select(
+        User.telegram_id,
+        User.full_name,
+        User.user_name,
+        UserOrderStats.orders_count,
+        UserOrderStats.units_count,
+    ).join(UserOrderStats)
+
+
+def total_of_orders_per_user() -> Select:
+    """Count the orders of each user, from the maintained aggregates."""
+
+    return (
+        select(UserOrderStats.orders_count.label("count"), User.full_name)
+        .join(User)
+        .where(UserOrderStats.orders_count > 0)
+    )
+
+
+def total_of_ordered_products_per_user() -> Select:
+    """Sum the ordered quantities of each user, from the maintained aggregates."""
+
+    return (
+        select(UserOrderStats.units_count.label("quantity"), User.full_name)
+        .join(User)
+        .where(UserOrderStats.units_count > 0)
+    )
@@ -0,0 +1,148 @@
+"""Rebuild and verify the closure of the referral tree in ``user_referrals``.
+
+The triggers declared in ``lesson_2`` keep the closure current on every write
+to ``users.referrer_id``. This module recomputes it from the referrers with a
+recursive CTE to catch any drift, e.g. after the triggers were disabled.
+
+Usage::
+
+    python -m sqlalchemy_training.referrals verify
+    python -m sqlalchemy_training.referrals rebuild
+"""
+
+# ! the CLI mirrors order_stats on purpose.
+# pylint: disable=duplicate-code
+
+import argparse
+import logging
+import sys
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import (
+    CTE,
+    Connection,
+    Integer,
+    delete,
+    func,
+    insert,
+    literal_column,
+    or_,
+    select,
+    text,
+)
+
+from sqlalchemy_training.lesson_1 import create_engine_from_env
+from sqlalchemy_training.lesson_2 import User, UserReferral, referrals_ddl
+from sqlalchemy_training.throughput import measure
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Drift:
+    """Link of the closure missing, unexpected or at the wrong depth."""
+
+    ancestor_id: int
+    descendant_id: int
+    depth: Optional[int]
+    actual_depth: Optional[int]
+
+
+def actual_closure() -> CTE:
+    """Link every user to itself and to each of its referrers, walking up."""
+
+    closure = select(
+        User.telegram_id.label("ancestor_id"),
+        User.telegram_id.label("descendant_id"),
+        literal_column("0", Integer).label("depth"),
+    ).cte("closure", recursive=True)
+    return closure.union_all(
+        select(closure.c.ancestor_id, User.telegram_id, closure.c.depth + 1).where(
+            User.referrer_id == closure.c.descendant_id
+        )
+    )
+
+
+def install(connection: Connection) -> None:
+    """(Re)create the functions and the triggers maintaining the closure."""
+
+    for statement in referrals_ddl():
+        connection.exec_driver_sql(statement)
+
+
+def rebuild(connection: Connection) -> int:
+    """Recompute the whole closure, blocking the writes to the users meanwhile."""
+
+    with measure("rebuild user_referrals") as throughput:
+        connection.execute(text("LOCK TABLE users IN SHARE MODE"))
+        connection.execute(delete(UserReferral))
+        closure = actual_closure()
+        result = connection.execute(
+            insert(UserReferral).from_select(
+                ["ancestor_id", "descendant_id", "depth"], select(closure)
+            )
+        )
+        throughput.rows = result.rowcount
+
+    return throughput.rows
+
+
+def verify(connection: Connection, limit: int = 100) -> list[Drift]:
+    """Links differing from the referrers, at most ``limit`` of them."""
+
+    actual = actual_closure()
+    stmt = (
+        select(
+            func.coalesce(UserReferral.ancestor_id, actual.c.ancestor_id),
+            func.coalesce(UserReferral.descendant_id, actual.c.descendant_id),
+            UserReferral.depth,
+            actual.c.depth,
+        )
+        .join_from(
+            UserReferral,
+            actual,
+            (UserReferral.ancestor_id == actual.c.ancestor_id)
+            & (UserReferral.descendant_id == actual.c.descendant_id),
+            full=True,
+        )
+        .where(
+            or_(
+                UserReferral.depth.is_(None),
+                actual.c.depth.is_(None),
+                UserReferral.depth != actual.c.depth,
+            )
+        )
+        .limit(limit)
+    )
+    return [Drift(*row) for row in connection.execute(stmt)]
+
+
+def main() -> None:
+    """Verify, rebuild or install the closure from the command line."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["verify", "rebuild", "install"])
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = create_engine_from_env()
+    with engine.begin() as connection:
+        if args.command == "install":
+            install(connection)
+        elif args.command == "rebuild":
+            rebuild(connection)
+        else:
+            drifts = verify(connection, args.limit)
+            for drift in drifts:
+                print(drift)
+            print(f"{len(drifts)} links drifted." if drifts else "No drift.")
+    engine.dispose()
+
+    if args.command == "verify" and drifts:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
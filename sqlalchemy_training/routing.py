@@ -0,0 +1,174 @@
+"""Session sending the reads to replicas and the writes to the primary.
+
+``RoutingSession.get_bind`` picks the engine of each statement:
+
+- flushes, INSERT, UPDATE, DELETE, ``SELECT ... FOR UPDATE``, SELECTs of
+  data-modifying CTEs and textual SQL go to the primary, but
+  ``SET TRANSACTION``, e.g. of ``Repo.read_only``.
+- other SELECTs go to a replica, chosen by a ``ReplicaPicker`` once per
+  transaction, so that its reads see the same snapshot.
+- once a transaction wrote, its reads go to the primary too, since the
+  replicas may not have replayed the write yet (read-your-writes). With
+  ``stick_for``, the reads following the commit of a write stay on the primary
+  for that many seconds, to cover the replication lag.
+
+The replicas are read from ``POSTGRES_REPLICA_HOSTS``::
+
+    Repo(routing_session_maker()())
+"""
+
+import itertools
+import threading
+from time import monotonic
+from typing import Any, Literal, Optional, Sequence
+
+from sqlalchemy import CTE, Engine, TextClause, event
+from sqlalchemy.orm import Session, SessionTransaction, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import ClauseElement, visitors
+
+from sqlalchemy_training.lesson_1 import (
+    build_replica_urls,
+    create_engine_from_env,
+    get_engine,
+)
+
+Strategy = Literal["round_robin", "least_connections"]
+
+# * keys of session.info.
+WROTE = "routing_wrote"
+REPLICA = "routing_replica"
+
+
+def _checked_out(replica: Engine) -> int:
+    pool = replica.pool
+    return pool.checkedout() if isinstance(pool, QueuePool) else 0
+
+
+class ReplicaPicker:
+    """Spread the transactions of the sessions over the replicas.
+
+    - ``round_robin``: each replica in turn.
+    - ``least_connections``: the replica with the fewest connections checked
+      out of its pool, in turn on ties.
+    """
+
+    def __init__(
+        self, replicas: Sequence[Engine], strategy: Strategy = "round_robin"
+    ) -> None:
+        if strategy not in ("round_robin", "least_connections"):
+            raise ValueError(f"Unknown strategy {strategy!r}")
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self._turns = itertools.cycle(range(len(self.replicas)))
+        self._lock = threading.Lock()
+
+    def pick(self) -> Optional[Engine]:
+        """Replica for a new transaction, ``None`` without replicas."""
+
+        if not self.replicas:
+            return None
+
+        with self._lock:
+            start = next(self._turns)
+        order = self.replicas[start:] + self.replicas[:start]
+        if self.strategy == "round_robin":
+            return order[0]
+        # * min keeps the first replica of the rotation on ties.
+        return min(order, key=_checked_out)
+
+
+def is_write(clause: Optional[ClauseElement]) -> bool:
+    """Whether a statement must run on the primary."""
+
+    if clause is None:
+        return True
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().upper().startswith("SET TRANSACTION")
+    # * ORM statements wrapping DML, e.g. select(User).from_statement(insert()).
+    element = getattr(clause, "element", clause)
+    if getattr(element, "is_dml", False):
+        return True
+    if getattr(clause, "is_select", False):
+        if getattr(clause, "_for_update_arg", None) is not None:
+            return True
+        # * SELECTs of data-modifying CTEs, e.g. queries.PLACE_ORDER.
+        return any(
+            isinstance(element, CTE) and element.element.is_dml
+            for element in visitors.iterate(clause)
+        )
+    return True
+
+
+class RoutingSession(Session):
+    """Session routing its statements between a primary and its replicas."""
+
+    def __init__(
+        self,
+        *args: Any,
+        primary: Engine,
+        picker: ReplicaPicker,
+        stick_for: float = 0,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.primary = primary
+        self.picker = picker
+        self.stick_for = stick_for
+        self._sticky_until = 0.0
+
+    def get_bind(  # type: ignore[override]  # pylint: disable=unused-argument
+        self,
+        mapper: Any = None,
+        *,
+        clause: Optional[ClauseElement] = None,
+        **kwargs: Any,
+    ) -> Engine:
+        """Engine running a statement, see the docstring of the module."""
+
+        if self._flushing or is_write(clause):
+            self.info[WROTE] = True
+            return self.primary
+        if self.info.get(WROTE) or monotonic() < self._sticky_until:
+            return self.primary
+
+        if REPLICA not in self.info:
+            self.info[REPLICA] = self.picker.pick() or self.primary
+        return self.info[REPLICA]
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def reset_routing(session: Session, transaction: SessionTransaction) -> None:
+    """Forget the replica and the writes of a transaction once it ends."""
+
+    if transaction.parent is not None or not isinstance(session, RoutingSession):
+        return
+    if session.info.pop(WROTE, False) and session.stick_for:
+        session._sticky_until = (  # pylint: disable=protected-access
+            monotonic() + session.stick_for
+        )
+    session.info.pop(REPLICA, None)
+
+
+def routing_session_maker(
+    primary: Optional[Engine] = None,
+    replicas: Optional[Sequence[Engine]] = None,
+    strategy: Strategy = "round_robin",
+    stick_for: float = 0,
+    **kwargs: Any,
+) -> sessionmaker[RoutingSession]:
+    """Factory of routing sessions, on the replicas of the environment by default.
+
+    Without replica, every statement runs on the primary.
+    """
+
+    if replicas is None:
+        replicas = [create_engine_from_env(url) for url in build_replica_urls()]
+
+    return sessionmaker(
+        class_=RoutingSession,
+        primary=primary or get_engine(),
+        picker=ReplicaPicker(replicas, strategy),
+        stick_for=stick_for,
+        **kwargs,
+    )
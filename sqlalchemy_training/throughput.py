@@ -0,0 +1,71 @@
+"""Measure and report how many rows per second a bulk operation processes."""
+
+import logging
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from time import perf_counter, sleep
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Throughput:
+    """Rows processed during a period of time."""
+
+    rows: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        """Average number of rows processed per second."""
+
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.rows} rows in {self.seconds:.2f}s "
+            f"({self.rows_per_second:,.0f} rows/s)"
+        )
+
+
+@contextmanager
+def measure(label: str) -> Iterator[Throughput]:
+    """Time the block and log the rows it added to the yielded counter."""
+
+    throughput = Throughput()
+    started = perf_counter()
+    try:
+        yield throughput
+    finally:
+        throughput.seconds = perf_counter() - started
+        logger.info("%s: %s", label, throughput)
+
+
+@dataclass
+class Pace:
+    """Throttle a loop of batches to ``rows_per_second``, logging its progress.
+
+    Call it after each batch with the rows processed so far.
+    """
+
+    label: str
+    rows_per_second: Optional[float] = None
+    # * seconds between two progress logs.
+    every: float = 10.0
+    started: float = field(default_factory=perf_counter)
+    logged: float = field(default_factory=perf_counter)
+
+    def __call__(self, throughput: Throughput) -> None:
+        if self.rows_per_second:
+            # * sleep off the time the batches took less than their quota.
+            elapsed = perf_counter() - self.started
+            sleep(max(throughput.rows / self.rows_per_second - elapsed, 0))
+        if perf_counter() - self.logged >= self.every:
+            self.logged = perf_counter()
+            logger.info(
+                "%s: %s rows (%s rows/s)",
+                self.label,
+                throughput.rows,
+                f"{throughput.rows / (self.logged - self.started):,.0f}",
+            )
@@ -0,0 +1,56 @@
+"""Tests of the in-process LRU cache."""
+
+from sqlalchemy_training.cache import MISSING, LRUCache
+
+
+class Clock:
+    """Clock moved by hand."""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_evicts_least_recently_used():
+    """The entry read last survives, the one left alone goes."""
+
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats.evictions == 1
+    assert cache.stats.size == 2
+
+
+def test_expires_after_ttl():
+    """Entries are served until their TTL, never after."""
+
+    clock = Clock()
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.set("a", 1)
+
+    clock.now = 9.9
+    assert cache.get("a") == 1
+    clock.now = 10
+    assert cache.get("a") is MISSING
+    assert cache.stats.expirations == 1
+    assert cache.stats.size == 0
+
+
+def test_counts_hits_and_misses():
+    """The hit rate reflects the lookups."""
+
+    cache = LRUCache()
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+    assert cache.stats.hit_rate == 0.5
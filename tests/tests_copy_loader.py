@@ -0,0 +1,27 @@
+"""Tests of the CSV rendering of the rows streamed to COPY."""
+
+import csv
+import io
+
+from sqlalchemy_training.copy_loader import NULL, CsvStream
+
+
+def test_escapes_values():
+    """Separators, quotes and newlines are quoted, None is NULL."""
+
+    stream = CsvStream([(1, 'say "hi", bye', None), (2, "two\nlines", "")])
+
+    assert stream.read() == '1,"say ""hi"", bye",\\N\n2,"two\nlines",\n'
+    assert stream.count == 2
+
+
+def test_reads_in_chunks():
+    """Chunks of any size add up to the same rows."""
+
+    rows = [(index, f"name, {index}", None) for index in range(100)]
+    stream = CsvStream(rows)
+    chunks = iter(lambda: stream.read(7), "")
+    parsed = list(csv.reader(io.StringIO("".join(chunks))))
+
+    assert parsed == [[str(index), f"name, {index}", NULL] for index in range(100)]
+    assert stream.read() == ""
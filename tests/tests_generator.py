@@ -0,0 +1,41 @@
+"""Tests of the reproducibility of the generated datasets."""
+
+from sqlalchemy_training.generator import DatasetConfig, generate_orders
+
+CONFIG = DatasetConfig(users=50, products=20, orders=250, batch_size=100)
+
+
+def test_same_seed_same_rows():
+    """A chunk is the same from one run to the other."""
+
+    assert generate_orders(CONFIG, 1) == generate_orders(CONFIG, 1)
+
+
+def test_other_seed_other_rows():
+    """The seed changes the rows."""
+
+    other = DatasetConfig(users=50, products=20, orders=250, batch_size=100, seed=1)
+    assert generate_orders(CONFIG, 1) != generate_orders(other, 1)
+
+
+def test_chunks_are_independent():
+    """A chunk doesn't depend on the chunks generated before, or by workers."""
+
+    alone = generate_orders(CONFIG, 2)
+    for chunk in CONFIG.chunks(CONFIG.orders):
+        generate_orders(CONFIG, chunk)
+    assert generate_orders(CONFIG, 2) == alone
+
+
+def test_chunks_cover_the_ids():
+    """The chunks produce every ID once, in lines within bounds."""
+
+    order_ids, lines = [], []
+    for chunk in CONFIG.chunks(CONFIG.orders):
+        orders, chunk_lines = generate_orders(CONFIG, chunk)
+        order_ids += [order[0] for order in orders]
+        lines += chunk_lines
+
+    assert order_ids == list(range(1, CONFIG.orders + 1))
+    assert all(1 <= line[2] <= CONFIG.products for line in lines)
+    assert all(1 <= line[3] <= CONFIG.max_quantity for line in lines)
@@ -0,0 +1,53 @@
+"""Tests of the detection of sequential scans in plans."""
+
+from sqlalchemy_training.index_advisor import seq_scans
+
+PLAN = {
+    "Plan": {
+        "Node Type": "Hash Join",
+        "Hash Cond": "(orders.user_id = users.telegram_id)",
+        "Plans": [
+            {
+                "Node Type": "Seq Scan",
+                "Relation Name": "orders",
+                "Actual Rows": 900,
+                "Rows Removed by Filter": 4_100,
+                "Actual Loops": 2,
+                "Filter": "(created_at > now())",
+                "Shared Hit Blocks": 10,
+                "Shared Read Blocks": 5,
+            },
+            {
+                "Node Type": "Hash",
+                "Plans": [
+                    {
+                        "Node Type": "Seq Scan",
+                        "Relation Name": "users",
+                        "Actual Rows": 50,
+                        "Actual Loops": 1,
+                    }
+                ],
+            },
+        ],
+    }
+}
+
+
+def test_reports_large_seq_scans():
+    """Scans count the rows filtered out, in every loop."""
+
+    findings = seq_scans("Repo.get_all_user_orders", "SELECT", PLAN, min_rows=1_000)
+
+    assert len(findings) == 1
+    finding = findings[0]
+    assert (finding.relation, finding.rows, finding.buffers) == ("orders", 10_000, 15)
+    assert finding.condition == "(created_at > now())"
+
+
+def test_condition_of_ancestor():
+    """Scans without filter take the condition of the closest ancestor."""
+
+    findings = seq_scans("Repo.get_all_user_orders", "SELECT", PLAN, min_rows=10)
+
+    assert [finding.relation for finding in findings] == ["orders", "users"]
+    assert findings[1].condition == "(orders.user_id = users.telegram_id)"
@@ -0,0 +1,27 @@
+"""Tests of the statistics of the statements run by an engine."""
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from sqlalchemy_training.instrumentation import QueryStats
+
+
+def test_failed_statement_leaves_no_timing_behind():
+    """Statements after a failed one are timed from their own start."""
+
+    engine = create_engine("sqlite://")
+    first, second = QueryStats().install(engine), QueryStats().install(engine)
+    try:
+        with engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM missing"))
+            connection.rollback()
+            connection.execute(text("SELECT 1"))
+    finally:
+        first.uninstall(engine)
+        second.uninstall(engine)
+
+    for stats in (first, second):
+        assert list(stats.statements) == ["SELECT 1"]
+        assert stats.statements["SELECT 1"].calls == 1
@@ -0,0 +1,138 @@
+"""Tests of the transactions of the Repo methods."""
+
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import Session
+
+from sqlalchemy_training.cache import MISSING, LRUCache, user_keys
+from sqlalchemy_training.lesson_2 import User
+from sqlalchemy_training.lesson_3 import Repo
+
+
+def _engine_and_log():
+    engine = create_engine("sqlite://")
+    User.__table__.create(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            User.__table__.insert(),
+            {"telegram_id": 1, "full_name": "Ann", "language_code": "en"},
+        )
+
+    log: list[str] = []
+    event.listen(engine, "commit", lambda connection: log.append("COMMIT"))
+    event.listen(engine, "rollback", lambda connection: log.append("ROLLBACK"))
+    return engine, log
+
+
+def test_reads_emit_no_commit():
+    """Each read ends its own transaction with a ROLLBACK."""
+
+    engine, log = _engine_and_log()
+    with Session(engine) as session:
+        repo = Repo(session)
+        assert repo.get_user_by_id(1).full_name == "Ann"
+        assert repo.get_user_lang(1) == "en"
+        assert not session.in_transaction()
+
+    assert log == ["ROLLBACK", "ROLLBACK"]
+
+
+def test_unit_of_work_commits_once():
+    """The calls of a unit of work share one transaction, committed at the end."""
+
+    engine, log = _engine_and_log()
+    with Session(engine) as session:
+        repo = Repo(session)
+        with repo.transaction():
+            repo.get_user_lang(1)
+            repo.get_user_by_id(1)
+            assert not log
+
+    assert log == ["COMMIT"]
+
+
+def test_reads_keep_the_session_state():
+    """A read neither expires the loaded objects nor loses the pending changes."""
+
+    engine, _ = _engine_and_log()
+    with engine.begin() as connection:
+        connection.execute(
+            User.__table__.insert(),
+            {"telegram_id": 2, "full_name": "Bob", "language_code": "fr"},
+        )
+
+    statements: list[str] = []
+    event.listen(
+        engine, "before_cursor_execute", lambda *args: statements.append(args[2])
+    )
+    with Session(engine, expire_on_commit=False) as session:
+        repo = Repo(session)
+        user = repo.get_user_by_id(1)
+        user.full_name = "Changed"
+        assert repo.get_user_lang(2) == "fr"
+        assert len(statements) == 2
+        assert user.full_name == "Changed"
+        assert not session.in_transaction()
+        assert user in session.dirty
+        session.commit()
+
+    stmt = select(User.full_name).where(User.telegram_id == 1)
+    with engine.connect() as connection:
+        assert connection.scalar(stmt) == "Changed"
+
+
+def test_bulk_upsert_returns_loaded_users():
+    """The users returned by a bulk upsert need no further query."""
+
+    engine, _ = _engine_and_log()
+    statements: list[str] = []
+    event.listen(
+        engine, "before_cursor_execute", lambda *args: statements.append(args[2])
+    )
+    with Session(engine) as session:
+        users = Repo(session).add_users_bulk(
+            [
+                {"telegram_id": 1, "full_name": "Anna", "lang": "en"},
+                {"telegram_id": 2, "full_name": "Bob", "lang": "fr"},
+            ],
+            returning=True,
+        )
+        assert [user.full_name for user in users] == ["Anna", "Bob"]
+        assert len(statements) == 1
+        assert not session.in_transaction()
+
+
+def test_written_users_are_cached_again_once_committed():
+    """Out of ``transaction()``, the users written are forgotten on commit."""
+
+    engine, _ = _engine_and_log()
+    cache = LRUCache()
+    with Session(engine) as session:
+        repo = Repo(session, autocommit=False, cache=cache)
+        repo.add_user(telegram_id=1, full_name="Anna", lang="en")
+        # * a concurrent reader caching the user as it was before the commit.
+        cache.set(user_keys(1)[1], "stale")
+        assert repo.get_user_lang(1) == "en"
+        session.commit()
+
+        assert cache.get(user_keys(1)[1]) is MISSING
+        assert repo.get_user_lang(1) == "en"
+        assert cache.get(user_keys(1)[1]) == "en"
+
+        repo.add_user(telegram_id=1, full_name="Ann", lang="fr")
+        session.rollback()
+        assert repo.get_user_lang(1) == "en"
+        assert cache.get(user_keys(1)[1]) == "en"
+
+
+def test_closing_a_stream_ends_its_transaction():
+    """A stream left before its end doesn't leave its transaction open."""
+
+    engine, _ = _engine_and_log()
+    with Session(engine) as session:
+        repo = Repo(session)
+        for dto in (False, True):
+            users = repo.stream_all_users(batch_size=1, dto=dto)
+            assert next(users).full_name == "Ann"
+            assert session.in_transaction()
+            users.close()
+            assert not session.in_transaction()
@@ -0,0 +1,89 @@
+"""Tests of the coalescing of lookups by BatchLoader."""
+
+import asyncio
+
+from sqlalchemy_training.loader import BatchLoader
+
+
+def _loader(**kwargs) -> tuple[BatchLoader[int, int], list[list[int]]]:
+    batches: list[list[int]] = []
+
+    async def double(keys: list[int]) -> list[int]:
+        batches.append(keys)
+        return [key * 2 for key in keys]
+
+    return BatchLoader(double, **kwargs), batches
+
+
+def test_coalesces_concurrent_lookups():
+    """Lookups of the same window go in one batch, each key once."""
+
+    async def run() -> tuple[list[int], list[list[int]]]:
+        loader, batches = _loader()
+        values = await asyncio.gather(*(loader.load(key) for key in (1, 2, 1, 3)))
+        return values, batches
+
+    values, batches = asyncio.run(run())
+    assert values == [2, 4, 2, 6]
+    assert batches == [[1, 2, 3]]
+
+
+def test_splits_at_max_batch_size():
+    """A full batch is sent without waiting for its window."""
+
+    async def run() -> list[list[int]]:
+        loader, batches = _loader(max_batch_size=2)
+        await loader.load_many([1, 2, 3])
+        return batches
+
+    assert asyncio.run(run()) == [[1, 2], [3]]
+
+
+def test_caches_loaded_keys_until_cleared():
+    """A key loaded once is served again, unless cleared."""
+
+    async def run() -> list[list[int]]:
+        loader, batches = _loader()
+        await loader.load(1)
+        await loader.load(1)
+        loader.clear(1)
+        await loader.load(1)
+        return batches
+
+    assert asyncio.run(run()) == [[1], [1]]
+
+
+def test_fails_the_lookups_of_a_failed_batch():
+    """Every lookup of a batch gets its error."""
+
+    async def fail(keys: list[int]) -> list[int]:
+        raise RuntimeError(f"no {keys}")
+
+    async def run() -> list[BaseException]:
+        loader = BatchLoader(fail)
+        return await asyncio.gather(
+            loader.load(1), loader.load(2), return_exceptions=True
+        )
+
+    errors = asyncio.run(run())
+    assert [str(error) for error in errors] == ["no [1, 2]", "no [1, 2]"]
+
+
+def test_cancelling_a_lookup_spares_the_others():
+    """A cancelled lookup cancels neither the other lookups nor the cached key."""
+
+    async def run() -> tuple[bool, int, int, list[list[int]]]:
+        loader, batches = _loader()
+
+        async def lookup() -> int:
+            return await loader.load(1)
+
+        first = asyncio.create_task(lookup())
+        second = asyncio.create_task(lookup())
+        await asyncio.sleep(0)
+        first.cancel()
+        value = await second
+        await asyncio.gather(first, return_exceptions=True)
+        return first.cancelled(), value, await loader.load(1), batches
+
+    assert asyncio.run(run()) == (True, 2, 2, [[1]])
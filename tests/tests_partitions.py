@@ -0,0 +1,31 @@
+"""Tests of the month arithmetic of the partitions."""
+
+from datetime import datetime
+
+from sqlalchemy_training.partitions import add_months, month_range, partition_name
+
+
+def test_add_months_across_years():
+    """Months roll over the years, both ways."""
+
+    assert add_months(datetime(2024, 11, 1), 3) == datetime(2025, 2, 1)
+    assert add_months(datetime(2024, 1, 1), -1) == datetime(2023, 12, 1)
+    assert add_months(datetime(2024, 5, 17, 8), 0) == datetime(2024, 5, 1)
+
+
+def test_month_range_overlapping_months():
+    """Months overlapping the range, the end excluded."""
+
+    months = list(month_range(datetime(2024, 11, 15), datetime(2025, 2, 1)))
+    assert months == [
+        datetime(2024, 11, 1),
+        datetime(2024, 12, 1),
+        datetime(2025, 1, 1),
+    ]
+    assert not list(month_range(datetime(2024, 3, 1), datetime(2024, 3, 1)))
+
+
+def test_partition_name():
+    """Partitions are named after their month."""
+
+    assert partition_name("orders", datetime(2024, 3, 1)) == "orders_2024_03"
@@ -0,0 +1,67 @@
+"""Tests of the statements of the queries module, run on SQLite."""
+
+import pytest
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+from sqlalchemy_training import queries
+from sqlalchemy_training.lesson_2 import User, UserReferral
+
+
+def _referrals_engine():
+    """Users 1 <- 2 <- 3 <- 4, each referred by the previous one."""
+
+    engine = create_engine("sqlite://")
+    User.__table__.create(engine)
+    UserReferral.__table__.create(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            insert(User),
+            [
+                {
+                    "telegram_id": id_,
+                    "full_name": f"User {id_}",
+                    "language_code": "en",
+                    "referrer_id": id_ - 1 if id_ > 1 else None,
+                }
+                for id_ in range(1, 5)
+            ],
+        )
+        # * the links the triggers keep on PostgreSQL.
+        connection.execute(
+            insert(UserReferral),
+            [
+                {"ancestor_id": ancestor, "descendant_id": descendant, "depth": depth}
+                for descendant in range(1, 5)
+                for depth, ancestor in enumerate(range(descendant, 0, -1))
+            ],
+        )
+    return engine
+
+
+@pytest.mark.parametrize("max_depth", [None, 1, 2, 5])
+def test_referrals_tree_modes_agree(max_depth):
+    """The recursive CTE and the closure find the same referrals."""
+
+    engine = _referrals_engine()
+    with Session(engine) as session:
+        found = [
+            [
+                (user.telegram_id, depth)
+                for user, depth in session.execute(
+                    queries.referrals_tree(1, max_depth, closure)
+                )
+            ]
+            for closure in (False, True)
+        ]
+
+    expected = [(2, 1), (3, 2), (4, 3)][:max_depth]
+    assert found == [expected, expected]
+
+
+@pytest.mark.parametrize("closure", [False, True])
+def test_referrals_tree_rejects_depths_below_one(closure):
+    """No depth below the users invited, in either mode."""
+
+    with pytest.raises(ValueError):
+        queries.referrals_tree(1, 0, closure)
@@ -0,0 +1,41 @@
+"""Tests of the routing of the statements between the primary and replicas."""
+
+from sqlalchemy import text
+
+from sqlalchemy_training import queries
+from sqlalchemy_training.routing import is_write
+
+
+def test_selects_are_reads():
+    """Plain selects may run on a replica."""
+
+    assert not is_write(queries.USER_BY_ID)
+    assert not is_write(queries.referrals_tree(1))
+
+
+def test_dml_is_write():
+    """INSERT, UPDATE and DELETE run on the primary."""
+
+    assert is_write(queries.SET_REFERRER)
+    assert is_write(queries.DELETE_USER)
+    assert is_write(queries.INSERT_ORDER)
+
+
+def test_select_for_update_is_write():
+    """Row locks are taken on the primary."""
+
+    assert is_write(queries.USER_BY_ID.with_for_update())
+
+
+def test_select_of_dml_ctes_is_write():
+    """PLACE_ORDER selects the rows its CTEs insert."""
+
+    assert is_write(queries.PLACE_ORDER)
+
+
+def test_textual_sql():
+    """Textual SQL is a write, but SET TRANSACTION."""
+
+    assert is_write(text("VACUUM users"))
+    assert not is_write(text("  set transaction read only"))
+    assert is_write(None)